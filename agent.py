@@ -18,6 +18,7 @@ import time
 import contextlib
 import io
 import glob
+import hashlib
 from urllib.parse import quote_plus
 
 # Ensure lyra_project is on sys.path so the jadro package can be imported.
@@ -35,12 +36,33 @@ import openai
 # ======= IMPORTY TWOICH MODUŁÓW =======
 from modules.system import run as system_run
 from modules.intent_router import detect_intent
-from modules.model_router import query_model, get_last_stats
+from modules.model_router import query_model, query_model_stream, get_last_stats, _get_local_backend
+from modules.structured_output import StructuredOutputError
+from modules import cloud_client
+from modules import connection_manager as conn
+from modules.deadline import Deadline, DEFAULT_DEADLINE_SEC
+from modules import draft_models
+from modules import gguf_index
+from modules import llama_pool
+from modules import llama_supervisor
+from modules import llama_swap
+from modules import latency_router
+from modules import llama_probe
+from modules import model_residency
+from modules import batch_runner
+from modules import perf_store
+from modules import request_scheduler
+from modules import response_cache
+from modules import single_flight
+from modules import slot_store
+from modules import vram_planner
+from modules.async_router import query_many
+from modules.token_budget import build_context, estimate_tokens
 from modules.model_paths import load_models
 from modules.mode_manager import load_state
 from modules.memory_store import remember
 from modules.status_monitor import tool_STATUS_MONITOR
-from modules.memory_commands import handle_memory_command, record_context_line, build_memory_context
+from modules.memory_commands import handle_memory_command, record_context_line, memory_items
 from modules.command_catalog import ensure_command, format_command_list
 # ####--- RDZEŃ LYRY: INTEGRACJA DUSZY I PAMIĘCI ---####
 # Łączymy system z plikami, które masz w folderze /jądro
@@ -64,7 +86,7 @@ except ImportError as e:
 # Zarządzanie modelami
 from modules.model_switcher import tool_MODEL_SWITCHER, get_active_local_model_name, tool_SCAN_MODELS
 from modules.model_list import tool_MODEL_LIST
-from modules.model_profiles import choose_best_model
+from modules.model_profiles import TASK_MODELS, candidate_models, task_class
 
 # Narzędzia (Tools)
 from modules.app_tools import tool_APP_CONTROL
@@ -100,6 +122,7 @@ FORCE_LOCAL = False
 FORCED_CLOUD_MODEL = None
 BASELINE_GPU_USED = None
 LYRA_CONTEXT_PATH = BAZOWY_KATALOG / "lyra_project" / "jądro" / "LyraKontekst.json"
+HISTORY_MAX_TURNS = 20
 COMMAND_LOG_PATH = BAZOWY_KATALOG / "logs" / "commands.log"
 LLAMA_SERVER_BIN = Path.home() / "lyra_agent" / "llama.cpp" / "build" / "bin" / "llama-server"
 LLAMA_DEFAULT_MODEL = "gemma-2-2b-it-q4_k_m"
@@ -329,49 +352,53 @@ def _stop_ollama():
         return False, f"Ollama stop error: {e}"
 
 def _resolve_model_path(model_name):
-    data = load_models()
-    available = data.get("available", {})
-    if model_name in available:
-        return available[model_name]
-    # Try case-insensitive match
-    for name, path in available.items():
-        if name.lower() == str(model_name).lower():
-            return path
-    return None
+    # Nazwa bez rozroznienia wielkosci liter, logiczna nazwa modelu dzielonego na shardy
+    # albo stara nazwa shardu – zawsze sciezka pierwszej czesci (llama-server doczyta reszte).
+    return gguf_index.model_path(model_name)
+
+def _llama_port():
+    """Port aktywnej instancji (llama_port zmienia sie przy podmianie modelu blue/green)."""
+    try:
+        return int(get_config_field("llama_port", 11435) or 11435)
+    except Exception:
+        return 11435
 
 def _start_llama_server(model_name=None):
     try:
+        port = _llama_port()
         if get_config_field("llama_run_as_root", False):
             try:
                 subprocess.run(["sudo", "systemctl", "start", "lyra-llama.service"], check=False)
                 time.sleep(1)
-                if _port_open("127.0.0.1", 11435):
+                if _port_open("127.0.0.1", port):
+                    llama_probe.probe(force=True)
                     return True, "Llama-server uruchomiony jako root (systemd)."
             except Exception:
                 pass
-        if _port_open("127.0.0.1", 11435):
+        if _port_open("127.0.0.1", port):
             # If llama-server already runs, accept it as OK.
             try:
-                r = requests.post(
-                    "http://127.0.0.1:11435/v1/chat/completions",
+                r = conn.post(
+                    "llama",
+                    "/v1/chat/completions",
                     json={"model": "", "messages": [{"role": "user", "content": "ping"}]},
                     timeout=2,
                 )
                 if r.status_code in [200, 400]:
                     # If ollama responds, do not treat it as llama-server.
                     try:
-                        o = requests.get("http://127.0.0.1:11435/api/tags", timeout=2)
+                        o = conn.get("llama", "/api/tags", timeout=2)
                         if o.status_code == 200:
-                            return False, "Port 11435 zajety przez Ollama."
+                            return False, f"Port {port} zajety przez Ollama."
                     except Exception:
                         pass
+                    llama_probe.probe(force=True)
                     return True, "Llama-server juz dziala."
             except Exception:
                 pass
-            return False, "Port 11435 zajety (zatrzymaj Ollama lub inny serwer)."
+            return False, f"Port {port} zajety (zatrzymaj Ollama lub inny serwer)."
         model_name = model_name or get_config_field("llama_model", LLAMA_DEFAULT_MODEL)
-        gpu_layers = int(get_config_field("llama_gpu_layers", LLAMA_DEFAULT_GPU_LAYERS))
-        tensor_split = str(get_config_field("llama_tensor_split", LLAMA_DEFAULT_TENSOR_SPLIT))
+        parallel = conn.parallel_slots("llama")
         model_path = _resolve_model_path(model_name)
         if not model_path:
             return False, f"Brak modelu w liscie: {model_name}"
@@ -380,39 +407,178 @@ def _start_llama_server(model_name=None):
             return False, f"Brak pliku modelu: {model_path}"
         if not LLAMA_SERVER_BIN.exists():
             return False, f"Brak binarki llama-server: {LLAMA_SERVER_BIN}"
-        LLAMA_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
-        with open(LLAMA_LOG_PATH, "ab") as out:
-            subprocess.Popen(
-                [
-                    str(LLAMA_SERVER_BIN),
-                    "-m",
-                    str(model_path),
-                    "--port",
-                    "11435",
-                    "--gpu-layers",
-                    str(gpu_layers),
-                    "--tensor-split",
-                    tensor_split,
-                ],
-                stdout=out,
-                stderr=out,
-                preexec_fn=os.setsid,
-            )
-        for _ in range(15):
-            if _port_open("127.0.0.1", 11435):
-                return True, f"Llama-server uruchomiony: {model_name}"
-            time.sleep(1)
-        return False, "Llama-server nie wystartowal (sprawdz logs/llama_server.log)."
+        # Dekodowanie spekulatywne: maly model z tej samej rodziny slownika.
+        extra, draft_name = draft_models.draft_args(model_name, model_path)
+        draft_note = f" (draft: {draft_name})" if draft_name else ""
+        pool_mode = llama_pool.pool_mode()
+        if pool_mode == "on" or (pool_mode == "auto" and _model_fits_single_gpu(model_path, parallel)):
+            return _start_llama_pool(model_name, model_path, parallel, extra, draft_note)
+        # Duzy model: jedna instancja rozlozona na karty wg planu VRAM.
+        ok, placement, plan_note = _llama_placement(model_path, parallel, extra)
+        if not ok:
+            return False, f"Llama-server nie uruchomiony: {plan_note}"
+        args = _llama_args(model_path, port, parallel, placement) + extra
+        _spawn_llama(args)
+        if _wait_llama_ready(port):
+            llama_pool.clear()
+            conn.set_pool_size("llama", parallel)
+            llama_probe.probe(force=True)
+            return True, f"Llama-server uruchomiony: {model_name}{draft_note} ({plan_note})"
+        state = (llama_supervisor.state(port) or {}).get("state")
+        return False, f"Llama-server nie wystartowal (stan: {state}, sprawdz logs/llama_server.log)."
     except Exception as e:
         return False, f"Llama start error: {e}"
 
+def _llama_args(model_path, port, parallel, placement):
+    args = [
+        str(LLAMA_SERVER_BIN),
+        "-m",
+        str(model_path),
+        "--port",
+        str(port),
+    ] + list(placement)
+    if parallel > 1:
+        args += ["--parallel", str(parallel)]
+    # Zapis/odczyt slotow sesji – KV cache promptu przezywa restart procesu i serwera.
+    args += slot_store.server_args()
+    return args
+
+def _llama_placement(model_path, parallel, extra=None, card_list=None):
+    """
+    (ok, flagi, opis): --gpu-layers, -c, --tensor-split i typ KV cache z planu VRAM
+    (metadane GGUF + wolna VRAM kart). ok=False, gdy model sie nie zmiesci – bez startu.
+    Bez metadanych/sysfs albo przy llama_plan=off – stale wartosci z config.
+    """
+    legacy = ["--gpu-layers", str(get_config_field("llama_gpu_layers", LLAMA_DEFAULT_GPU_LAYERS))]
+    if card_list is None:
+        legacy += ["--tensor-split", str(get_config_field("llama_tensor_split", LLAMA_DEFAULT_TENSOR_SPLIT))]
+    if not vram_planner.enabled():
+        return True, legacy, "plan VRAM wylaczony"
+    plan = vram_planner.plan(model_path, parallel, card_list, extra_bytes=vram_planner.draft_bytes(extra))
+    if plan.get("unknown"):
+        return True, legacy, f"{plan.get('reason')} – ustawienia z config"
+    if not plan.get("ok"):
+        return False, [], vram_planner.describe(plan)
+    return True, vram_planner.server_args(plan, LLAMA_SERVER_BIN), vram_planner.describe(plan)
+
+def _spawn_llama(args, env=None):
+    """llama-server pod nadzorca: restart po awarii, rotacja logu, stan w logs/llama_supervisor/."""
+    port = int(args[args.index("--port") + 1])
+    return llama_supervisor.spawn(args, port, env=env)
+
+def _wait_llama_ready(port):
+    """Czeka na /health = 200 (model zaladowany), a nie tylko na otwarty port."""
+    return llama_supervisor.wait_ready(port) == "ready"
+
+def _model_fits_single_gpu(model_path, parallel=1):
+    """Czy model z pelnym kontekstem (plan VRAM) miesci sie w calosci na najmniejszej karcie."""
+    card_list = vram_planner.cards()
+    if len(card_list) < 2:
+        return False
+    smallest = min(card_list, key=lambda c: c["free_mb"])
+    return vram_planner.full_offload(vram_planner.plan(model_path, parallel, [smallest]))
+
+def _start_llama_pool(model_name, model_path, parallel, extra=None, draft_note=""):
+    """Jedna instancja llama-server na GPU (HIP_VISIBLE_DEVICES), kolejne porty od 11435."""
+    plan = llama_pool.plan_instances()
+    busy = [port for port, _ in plan if _port_open("127.0.0.1", port)]
+    if busy:
+        return False, f"Porty puli zajete: {', '.join(str(p) for p in busy)}"
+    card_list = vram_planner.cards()
+    placements = []
+    for port, gpu in plan:
+        # Plan osobno dla karty instancji (indeks HIP = kolejnosc kart w sysfs).
+        card = [card_list[int(gpu)]] if gpu.isdigit() and int(gpu) < len(card_list) else []
+        ok, placement, plan_note = _llama_placement(model_path, parallel, extra, card)
+        if not ok:
+            return False, f"Pula llama-server nie uruchomiona (GPU {gpu}): {plan_note}"
+        placements.append(placement)
+    procs = []
+    for (port, gpu), placement in zip(plan, placements):
+        env = os.environ.copy()
+        env["HIP_VISIBLE_DEVICES"] = gpu
+        proc = _spawn_llama(_llama_args(model_path, port, parallel, placement) + list(extra or []), env=env)
+        procs.append((port, gpu, proc))
+    started = []
+    for port, gpu, proc in procs:
+        if _wait_llama_ready(port):
+            conn.set_pool_size("llama", parallel, base_url=f"http://127.0.0.1:{port}")
+            started.append({"port": port, "gpu": gpu, "model": model_name, "pid": proc.pid})
+    llama_pool.register(started)
+    if not started:
+        return False, "Pula llama-server nie wystartowala (sprawdz logs/llama_server.log)."
+    llama_probe.probe(force=True)
+    return True, f"Pula llama-server uruchomiona: {model_name} x{len(started)}/{len(plan)} (GPU {', '.join(i['gpu'] for i in started)}){draft_note}"
+
 def _stop_llama_server():
     try:
-        subprocess.run(["pkill", "-f", "llama-server"], check=False)
+        llama_probe.invalidate()
+        llama_pool.clear()
+        # Nadzorca konczy swoj llama-server (SIGTERM, po czasie SIGKILL) i nie restartuje go.
+        if llama_supervisor.stop():
+            return True, "Llama-server zatrzymany."
+        if _port_open("127.0.0.1", _llama_port()):
+            # Serwer uruchomiony poza nadzorca (starsza wersja, reczny start).
+            subprocess.run(["pkill", "-f", "llama-server"], check=False)
         return True, "Llama-server zatrzymany."
     except Exception as e:
         return False, f"Llama stop error: {e}"
 
+def _swap_llama_model(model_name):
+    """
+    Podmiana modelu bez przerwy: nowy model na drugim porcie, rozgrzanie, przepiecie
+    llama_port (router, probe, inne procesy), wygaszenie i zatrzymanie starej instancji.
+    Gdy oba modele nie mieszcza sie w VRAM (albo dziala pula / systemd) – stop + start.
+    """
+    try:
+        caps = llama_probe.probe(force=True)
+        if not caps:
+            return _start_llama_server(model_name)
+        model_path = _resolve_model_path(model_name)
+        if not model_path or not Path(model_path).exists():
+            return False, f"Brak modelu lub pliku: {model_name}"
+        model_path = Path(model_path)
+        if Path(str(caps.get("model") or "")).name == model_path.name:
+            return True, f"Model {model_name} jest juz zaladowany."
+        if llama_pool.active() or get_config_field("llama_run_as_root", False) \
+                or llama_pool.pool_mode() == "on":
+            _stop_llama_server()
+            return _start_llama_server(model_name)
+        parallel = conn.parallel_slots("llama")
+        extra, draft_name = draft_models.draft_args(model_name, model_path)
+        # Plan liczony z wolnej VRAM teraz – obok dzialajacego modelu; podmiana tylko przy pelnym offloadzie.
+        plan = vram_planner.plan(model_path, parallel, extra_bytes=vram_planner.draft_bytes(extra)) \
+            if vram_planner.enabled() else {}
+        if not vram_planner.full_offload(plan):
+            _stop_llama_server()
+            ok, msg = _start_llama_server(model_name)
+            return ok, f"{msg} (stop+start: {vram_planner.describe(plan) if plan else 'plan VRAM wylaczony'})"
+        old_port, old_base = int(caps["port"]), caps["base"]
+        new_port = llama_swap.side_port(old_port)
+        if _port_open("127.0.0.1", new_port):
+            return False, f"Port zapasowy {new_port} zajety – podmiana niemozliwa."
+        placement = vram_planner.server_args(plan, LLAMA_SERVER_BIN)
+        args = _llama_args(model_path, new_port, parallel, placement) + extra
+        _spawn_llama(args)
+        if not _wait_llama_ready(new_port):
+            llama_supervisor.stop(new_port)
+            return False, f"Nowy model nie wystartowal na :{new_port} – zostaje poprzedni."
+        new_base = f"http://127.0.0.1:{new_port}"
+        llama_swap.warm(new_base)
+        # Przepiecie: jeden zapis config; router/probe/connection_manager ida za llama_port.
+        update_config_field("llama_port", new_port)
+        update_config_field("llama_model", model_name)
+        conn.set_pool_size("llama", parallel, base_url=new_base)
+        llama_probe.probe(force=True)
+        drained = llama_swap.drain(old_base)
+        if not llama_supervisor.stop(old_port):
+            subprocess.run(["pkill", "-f", f"llama-server.*--port {old_port}"], check=False)
+        draft_note = f", draft: {draft_name}" if draft_name else ""
+        drain_note = "" if drained else ", stara instancja zatrzymana po limicie wygaszania"
+        return True, f"Model podmieniony bez przerwy: {model_name} (:{old_port} -> :{new_port}{draft_note}{drain_note})"
+    except Exception as e:
+        return False, f"Llama swap error: {e}"
+
 def load_lyra_context():
     if not LYRA_CONTEXT_PATH.exists():
         return []
@@ -437,26 +603,25 @@ def append_lyra_context(user_text, assistant_text, limit=50):
     })
     save_lyra_context(entries[-limit:])
 
-def query_gpt_online(prompt, model_alias="gpt-5.1"):
-    if not openai:
+def query_gpt_online(prompt, model_alias="gpt-5.1", timeout=15):
+    if not cloud_client.available():
         return "❌ Biblioteka 'openai' nie zainstalowana.", "error"
     try:
-        with open(PLIK_USTAWIENIA, "r") as f:
-            config = json.load(f)
-            api_key = config.get("openai_api_key")
-        if not api_key or "TWÓJ_KLUCZ" in api_key:
+        if not cloud_client.key_configured():
             return "❌ Błąd: Brak klucza API.", "error"
-        model_name = model_alias or config.get("default_cloud_model") or "gpt-5.1"
-        client = openai.OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[
+        model_name = model_alias or cloud_client.settings()[2]
+        # Wspoldzielony klient: bez ponownego czytania config.json i nowego TLS przy kazdym zapytaniu.
+        start = time.time()
+        content = cloud_client.chat(
+            [
                 {"role": "system", "content": "Jesteś Lyra, zaawansowany asystent AI."},
                 {"role": "user", "content": prompt},
             ],
-            timeout=15,
+            model=model_name,
+            timeout=timeout,
         )
-        return response.choices[0].message.content, "online"
+        perf_store.record({"wall_s": time.time() - start}, model=model_name, backend="openai", path="cloud")
+        return content, "online"
     except Exception as e:
         return f"❌ Błąd API: {str(e)}", "error"
 
@@ -505,6 +670,17 @@ def _set_web_adapter(enabled: bool):
     update_config_field("web_adapter", "on" if enabled else "off")
     return f"✅ Adapter WWW: {'ON' if enabled else 'OFF'}"
 
+def _get_stream_enabled():
+    val = str(get_config_field("stream", "on") or "on").lower()
+    return val in ["on", "true", "1", "yes", "tak", "wlacz", "włącz"]
+
+def _set_stream_enabled(enabled: bool):
+    update_config_field("stream", "on" if enabled else "off")
+    return f"✅ Strumieniowanie: {'ON' if enabled else 'OFF'}"
+
+def _print_token(token):
+    print(token, end="", flush=True)
+
 def _show_banner():
     try:
         active_model = get_active_local_model_name() or "Lokalny"
@@ -665,18 +841,44 @@ def _lyra_capabilities_summary():
         "i robić backupy oraz rollback konfiguracji."
     )
 
-def _summarize_text(text: str, query: str, bullets: str = "5-7"):
-    prompt = (
-        f"Streszcz zawartosc po polsku w {bullets} krotkich punktach. "
-        "Zachowaj najwazniejsze fakty. Nie zmyslaj.\n\n"
-        f"Kontekst: {query}\n\nTresc:\n{text[:8000]}"
+SUMMARY_CHECKPOINT_DIR = BAZOWY_KATALOG / "logs" / "summary_checkpoints"
+# Streszczenia fragmentow jako lista punktow (ograniczone generowanie) – bez wstepow i formulek.
+SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {"punkty": {"type": "array", "items": {"type": "string", "minLength": 3}, "minItems": 1, "maxItems": 7}},
+    "required": ["punkty"],
+}
+
+def _summary_prompt(text: str, query: str, bullets: str = "5-7", sentences: int | None = None):
+    if sentences and sentences > 0:
+        head = f"Streszcz zawartosc po polsku w {sentences} zdaniach. "
+    else:
+        head = f"Streszcz zawartosc po polsku w {bullets} krotkich punktach. "
+    return (
+        head + "Zachowaj najwazniejsze fakty. Nie zmyslaj.\n\n"
+        f"Kontekst: {query}\n\nTresc:\n{text}"
     )
+
+def _clean_summary(response) -> str:
+    out = (response or "").strip()
+    if "Błąd połączenia" in out or "llama-server" in out or "ERROR" in out:
+        return ""
+    return out
+
+def _summary_input_limit() -> int:
+    # Limit znakow wejscia streszczenia dopasowany do n_ctx modelu (~3 znaki/token, zapas na odpowiedz).
+    n_ctx = None
+    if get_config_field("local_backend", "ollama") == "llama":
+        n_ctx = (llama_probe.get_capabilities() or {}).get("n_ctx")
+    if not n_ctx:
+        return 8000
+    return max(4000, min(32000, int((int(n_ctx) - 768) * 3)))
+
+def _summarize_text(text: str, query: str, bullets: str = "5-7", priority: str = "interactive"):
+    prompt = _summary_prompt(text[:_summary_input_limit()], query, bullets=bullets)
     try:
-        response, _ = query_model(prompt, get_active_local_model_name(), "local", config={"timeout":60}, history=[])
-        out = (response or "").strip()
-        if "Błąd połączenia" in out or "llama-server" in out or "ERROR" in out:
-            return ""
-        return out
+        response, _ = query_model(prompt, get_active_local_model_name(), "local", config={"timeout":60, "priority": priority}, history=[])
+        return _clean_summary(response)
     except Exception:
         return ""
 
@@ -694,37 +896,141 @@ def _chunk_text(text: str, max_chars: int = 4000, overlap: int = 200):
         start = max(0, end - overlap)
     return chunks
 
-def _summarize_text_sentences(text: str, query: str, sentences: int):
-    prompt = (
-        f"Streszcz zawartosc po polsku w {sentences} zdaniach. "
-        "Zachowaj najwazniejsze fakty. Nie zmyslaj.\n\n"
-        f"Kontekst: {query}\n\nTresc:\n{text[:8000]}"
-    )
+def _summarize_text_sentences(text: str, query: str, sentences: int, priority: str = "interactive"):
+    prompt = _summary_prompt(text[:_summary_input_limit()], query, sentences=sentences)
     try:
-        response, _ = query_model(prompt, get_active_local_model_name(), "local", config={"timeout":60}, history=[])
-        out = (response or "").strip()
-        if "Błąd połączenia" in out or "llama-server" in out or "ERROR" in out:
-            return ""
-        return out
+        response, _ = query_model(prompt, get_active_local_model_name(), "local", config={"timeout":60, "priority": priority}, history=[])
+        return _clean_summary(response)
     except Exception:
         return ""
 
-def _summarize_large_text(text: str, query: str, bullets: str = "5-7", sentences: int | None = None):
+def _summary_checkpoint_path(text: str, query: str, bullets: str, sentences: int | None) -> Path:
+    raw = json.dumps([get_active_local_model_name(), query, bullets, sentences], ensure_ascii=False) + text
+    digest = hashlib.sha256(raw.encode("utf-8", errors="ignore")).hexdigest()[:24]
+    return SUMMARY_CHECKPOINT_DIR / f"{digest}.json"
+
+def _load_summary_checkpoint(path: Path) -> dict:
+    try:
+        if path.exists():
+            data = json.loads(path.read_text(encoding="utf-8"))
+            if isinstance(data, dict):
+                return data
+    except Exception:
+        pass
+    return {}
+
+def _save_summary_checkpoint(path: Path, data: dict):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(path)
+    except Exception:
+        pass
+
+def _group_by_size(items: list, limit: int):
+    groups, current, size = [], [], 0
+    for item in items:
+        if current and size + len(item) + 1 > limit:
+            groups.append(current)
+            current, size = [], 0
+        current.append(item)
+        size += len(item) + 1
+    if current:
+        groups.append(current)
+    return groups
+
+def _summarize_stage(texts: list, queries: list, bullets: str, label: str, done: dict, ckpt_path: Path, ckpt: dict,
+                     priority: str = "background", failed: list | None = None):
+    """
+    Streszcza wiele tekstow rownolegle; kazdy wynik od razu trafia do checkpointu.
+    Fragment bez odpowiedzi modelu dostaje streszczenie heurystyczne i trafia do
+    `failed` (zapisywanego w checkpoincie) – przy wznowieniu jest ponawiany.
+    """
+    failed = failed if failed is not None else []
+    todo = [i for i in range(len(texts)) if str(i) not in done or str(i) in failed]
+    if len(todo) < len(texts):
+        retry = f", ponawiam nieudane: {len(failed)}" if failed else ""
+        print(f"{label}: wznawiam, gotowe {len(texts) - len(todo)}/{len(texts)}{retry}")
+    if todo:
+        prompts = [_summary_prompt(texts[i], queries[i], bullets=bullets) for i in todo]
+
+        def _store(pos, result):
+            key = str(todo[pos])
+            # Obiekt wg SUMMARY_SCHEMA; blad (tekst) – streszczenie heurystyczne, fragment do ponowienia.
+            points = result[0].get("punkty") if isinstance(result[0], dict) else None
+            out = "\n".join(f"- {p.strip()}" for p in points if isinstance(p, str) and p.strip()) if points else ""
+            if out:
+                if key in failed:
+                    failed.remove(key)
+            else:
+                out = _basic_summary(texts[todo[pos]], max_items=3)
+                if key not in failed:
+                    failed.append(key)
+            done[key] = out.strip()
+            _save_summary_checkpoint(ckpt_path, ckpt)
+            print(f"\r{label}: {len(done)}/{len(texts)}", end="", flush=True)
+
+        query_many(prompts, get_active_local_model_name(), "local", config={"timeout": 60, "priority": priority, "schema": SUMMARY_SCHEMA}, on_result=_store)
+        print("")
+        if failed:
+            print(f"⚠️ {label}: {len(failed)}/{len(texts)} bez odpowiedzi modelu – uzyto streszczenia heurystycznego.")
+    return [done[str(i)] for i in range(len(texts)) if done.get(str(i))]
+
+def _drop_summary_stages(ckpt: dict, after_level: int):
+    """Ponowiony etap zmienia wejscie dalszych – ich wyniki w checkpoincie sa nieaktualne."""
+    for key in [k for k in ckpt if k.startswith("reduce_") and int(k.split("_")[1]) > after_level]:
+        ckpt.pop(key, None)
+        ckpt.get("failed", {}).pop(key, None)
+
+def _summarize_large_text(text: str, query: str, bullets: str = "5-7", sentences: int | None = None,
+                          priority: str = "background"):
+    limit = _summary_input_limit()
     chunks = _chunk_text(text, max_chars=4000, overlap=200)
-    mini_summaries = []
-    for i, chunk in enumerate(chunks, start=1):
-        prompt_context = f"{query} (fragment {i}/{len(chunks)})"
-        part = _summarize_text(chunk, prompt_context, bullets="2-3")
-        if not part or _is_low_quality_response(part):
-            part = _basic_summary(chunk, max_items=3)
-        mini_summaries.append(part.strip())
-    combined = "\n".join([s for s in mini_summaries if s])
+    ckpt_path = _summary_checkpoint_path(text, query, bullets, sentences)
+    ckpt = _load_summary_checkpoint(ckpt_path)
+    try:
+        # Map: fragmenty rownolegle, do liczby slotow backendu.
+        failures = ckpt.setdefault("failed", {})
+        queries = [f"{query} (fragment {i}/{len(chunks)})" for i in range(1, len(chunks) + 1)]
+        if failures.get("map"):
+            _drop_summary_stages(ckpt, 0)
+        level_texts = _summarize_stage(chunks, queries, "2-3", "Fragmenty", ckpt.setdefault("map", {}), ckpt_path, ckpt, priority,
+                                       failures.setdefault("map", []))
+        # Reduce: drzewo – zadna warstwa nie przekracza limitu kontekstu modelu.
+        level = 0
+        while len(level_texts) > 1 and len("\n".join(level_texts)) > limit:
+            level += 1
+            groups = _group_by_size(level_texts, limit)
+            if len(groups) >= len(level_texts):
+                # Kazde streszczenie wieksze niz pol limitu – pary przyciete do polowy, liczba i tak maleje o polowe.
+                half = max(1, limit // 2 - 1)
+                groups = [[t[:half] for t in level_texts[i:i + 2]] for i in range(0, len(level_texts), 2)]
+            group_texts = ["\n".join(g) for g in groups]
+            group_queries = [f"Scal streszczenia fragmentow (poziom {level}, czesc {i}/{len(groups)})" for i in range(1, len(groups) + 1)]
+            if failures.get(f"reduce_{level}"):
+                _drop_summary_stages(ckpt, level)
+            level_texts = _summarize_stage(group_texts, group_queries, "3-5", f"Scalanie {level}", ckpt.setdefault(f"reduce_{level}", {}), ckpt_path, ckpt, priority,
+                                           failures.setdefault(f"reduce_{level}", []))
+    except KeyboardInterrupt:
+        print("\n⏸️ Przerwano streszczanie – postep zapisany, powtorz komende aby wznowic.")
+        return _basic_summary(text, max_items=5)
+    failed_total = sum(len(v) for v in ckpt.get("failed", {}).values())
+    if failed_total:
+        print(f"⚠️ Streszczenie niepelne: {failed_total} czesci bez odpowiedzi modelu – powtorz komende, aby je ponowic.")
+    combined = "\n".join([s for s in level_texts if s])
     if sentences and sentences > 0:
-        final = _summarize_text_sentences(combined, "Scal streszczenia fragmentow", sentences)
+        final = _summarize_text_sentences(combined, "Scal streszczenia fragmentow", sentences, priority=priority)
     else:
-        final = _summarize_text(combined, "Scal streszczenia fragmentow", bullets=bullets)
+        final = _summarize_text(combined, "Scal streszczenia fragmentow", bullets=bullets, priority=priority)
     if not final or _is_low_quality_response(final):
         final = _basic_summary(text, max_items=5)
+    elif not failed_total:
+        # Checkpoint z nieudanymi czesciami zostaje – nastepne wywolanie ponowi tylko je.
+        try:
+            ckpt_path.unlink()
+        except OSError:
+            pass
     return final
 
 def _extract_headings(text: str, max_items: int = 5):
@@ -1067,8 +1373,9 @@ def _ping_llama_server(timeout=10):
             "temperature": 0.5,
             "timings": True,
         }
-        r = requests.post(
-            "http://127.0.0.1:11435/completion",
+        r = conn.post(
+            "llama",
+            "/completion",
             json=payload,
             timeout=timeout,
         )
@@ -1107,7 +1414,7 @@ def _self_diagnostics():
 
     if backend == "ollama":
         try:
-            r = requests.get("http://127.0.0.1:11434/api/tags", timeout=2)
+            r = conn.get("ollama", "/api/tags", timeout=2)
             if r.status_code == 200:
                 data = r.json()
                 models = [m.get("name") for m in data.get("models", [])]
@@ -1121,10 +1428,16 @@ def _self_diagnostics():
         except Exception as e:
             lines.append(f"Ollama: ERROR ({e})")
     else:
-        if _port_open("127.0.0.1", 11435):
+        if _port_open("127.0.0.1", _llama_port()):
             ok, error, stats = _ping_llama_server()
             if ok:
                 lines.append("llama-server: OK")
+                caps = llama_probe.get_capabilities()
+                if caps:
+                    lines.append(
+                        f"llama-server API: {caps.get('dialect')} | port {caps.get('port')} | "
+                        f"model {caps.get('model') or '?'} | n_ctx {caps.get('n_ctx') or '?'} | sloty {caps.get('slots') or 1}"
+                    )
                 if stats:
                     LAST_STATS = stats
             else:
@@ -1134,7 +1447,13 @@ def _self_diagnostics():
                 else:
                     lines.append(f"llama-server: ERROR ({error})")
         else:
-            lines.append("llama-server: ERROR (port 11435)")
+            lines.append(f"llama-server: ERROR (port {_llama_port()})")
+
+    for base, h in conn.backend_health().items():
+        state = "OK" if h.get("ok") else "DEGRADED"
+        lat = h.get("latency_ms")
+        lat_txt = f"{lat:.0f} ms" if lat is not None else "-"
+        lines.append(f"Polaczenie {base}: {state} ({h.get('requests', 0)} req, {lat_txt})")
 
     lines.append(f"Inference: {LAST_INFERENCE}")
     if LAST_MODEL_NAME:
@@ -1522,13 +1841,13 @@ def _run_stress(seconds, intensity=1):
             f"Cel: obciaz GPU przez {seconds} sekund."
         )
         while not stop_event.is_set():
+            # Jedna runda = `intensity` zapytan naraz, ograniczonych do slotow serwera.
             with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
-                query_model(
-                    prompt,
+                query_many(
+                    [prompt] * intensity,
                     get_active_local_model_name(),
                     "local",
-                    config={"timeout": 5},
-                    history=[],
+                    config={"cache": False, "priority": "bulk", "timeout": 5},
                 )
             # Sync perf stats from model_router so banner can show P/G.
             try:
@@ -1542,11 +1861,8 @@ def _run_stress(seconds, intensity=1):
     t = threading.Thread(target=_monitor, args=(stop_event,), daemon=True)
     t.start()
     try:
-        workers = []
-        for _ in range(intensity):
-            th = threading.Thread(target=_worker, args=(stop_event,), daemon=True)
-            th.start()
-            workers.append(th)
+        workers = [threading.Thread(target=_worker, args=(stop_event,), daemon=True)]
+        workers[0].start()
         start = time.time()
         while time.time() - start < seconds:
             time.sleep(0.2)
@@ -1580,6 +1896,50 @@ def _parse_stress_args(cmd_clean):
             intensity = 1
     return seconds, intensity
 
+def _run_batch(arg_text):
+    """lyra batch <input.jsonl> [wyjscie.jsonl] [--order input|completion] [--workers N] [--model nazwa]"""
+    try:
+        args = shlex.split(arg_text)
+    except ValueError:
+        args = arg_text.split()
+    order, workers, model, positional = "input", None, None, []
+    i = 0
+    while i < len(args):
+        if args[i] in ["--order", "--kolejnosc"] and i + 1 < len(args):
+            order = args[i + 1].lower()
+            i += 2
+        elif args[i] in ["--workers", "-j"] and i + 1 < len(args):
+            try:
+                workers = max(1, int(args[i + 1]))
+            except ValueError:
+                print(f"⚠️ Niepoprawna liczba workerow: {args[i + 1]}")
+                return
+            i += 2
+        elif args[i] == "--model" and i + 1 < len(args):
+            model = args[i + 1]
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    if not positional:
+        print("⚠️ Użycie: lyra batch <input.jsonl> [wyjscie.jsonl] [--order input|completion] [--workers N] [--model nazwa]")
+        return
+    input_path = Path(positional[0]).expanduser()
+    if not input_path.exists():
+        print(f"❌ Brak pliku: {input_path}")
+        return
+    output_path = Path(positional[1]).expanduser() if len(positional) > 1 else None
+    try:
+        summary = batch_runner.run_batch(input_path, model or get_active_local_model_name(), output_path,
+                                         order=order, workers=workers)
+    except ValueError as e:
+        print(f"⚠️ {e}")
+        return
+    except Exception as e:
+        print(f"❌ Błąd batch: {e}")
+        return
+    print(batch_runner.format_summary(summary))
+
 def _format_commands_history(limit=20, top=10):
     if not COMMAND_LOG_PATH.exists():
         return "Historia komend: brak danych"
@@ -1661,11 +2021,21 @@ def wyswietl_baner(tryb, model, out=None, leading_newline=True, show_stats=True)
         print(f"{rainbow[4]}║ {eng_line} ║{RESET}", file=out)
         if has_perf:
             perf_text = f"Perf: P {p_tps} t/s | G {g_tps} t/s"
+            if stats.get("ttft") is not None:
+                perf_text += f" | TTFT {_fmt_tps(stats.get('ttft'))}s"
+            if stats.get("cached_tokens") is not None:
+                perf_text += f" | KV {stats.get('cached_tokens')}/{stats.get('prompt_tokens') or '?'}"
+            if stats.get("draft_acceptance") is not None:
+                perf_text += f" | Draft {stats.get('draft_acceptance') * 100:.0f}%"
         else:
             gpu_pct, gpu_used, gpu_total, gpu_active, gpu_count = _gpu_perf_summary()
             perf_text = f"Perf: GPU {gpu_pct:.1f}% | VRAM {gpu_used}/{gpu_total}MB ({gpu_active}/{gpu_count})"
         perf = _pad_banner_line(perf_text, width)
         print(f"{rainbow[5]}║ {perf} ║{RESET}", file=out)
+        queue_text = request_scheduler.format_waits()
+        if queue_text:
+            queue_line = _pad_banner_line(queue_text, width)
+            print(f"{rainbow[5]}║ {queue_line} ║{RESET}", file=out)
     print(f"{rainbow[0]}╚" + "═"*width + f"╝{RESET}", file=out)
 
 # ======= GŁÓWNA LOGIKA WYKONAWCZA =======
@@ -1706,6 +2076,94 @@ def run_once(user_input):
             return
         print(_set_web_adapter(mode == "on"))
         return
+    m_stream = re.search(r"^(lyra\s+)?stream\s*(on|off|status)?$", cmd_clean, flags=re.IGNORECASE)
+    if m_stream:
+        mode = (m_stream.group(2) or "status").lower()
+        if mode == "status":
+            print(f"Strumieniowanie: {'ON' if _get_stream_enabled() else 'OFF'}")
+            return
+        print(_set_stream_enabled(mode == "on"))
+        return
+    m_cache = re.search(r"^(lyra\s+)?cache\s*(stats|clear|on|off)?$", cmd_clean, flags=re.IGNORECASE)
+    if m_cache:
+        action = (m_cache.group(2) or "stats").lower()
+        if action == "clear":
+            print(f"✅ Wyczyszczono cache odpowiedzi ({response_cache.clear()} wpisow).")
+        elif action in ["on", "off"]:
+            update_config_field("response_cache", action)
+            print(f"✅ Cache odpowiedzi: {action.upper()}")
+        else:
+            print(response_cache.format_stats())
+            print(single_flight.format_stats())
+        return
+    m_hedge = re.search(r"^(lyra\s+)?hedge\s*(on|off|status)?$", cmd_clean, flags=re.IGNORECASE)
+    if m_hedge:
+        action = (m_hedge.group(2) or "status").lower()
+        if action == "status":
+            print(f"Wyscig lokalny/chmura: {str(get_config_field('hedge_cloud', 'off')).upper()} "
+                  f"| prog TTFT {get_config_field('hedge_ttft_sec', 4.0)}s "
+                  f"| limit zapytania {get_config_field('request_deadline_sec', DEFAULT_DEADLINE_SEC)}s "
+                  f"| zgoda GPT: {_get_cloud_consent()}")
+        else:
+            update_config_field("hedge_cloud", action)
+            note = "" if _get_cloud_consent() == "always" or action == "off" else " (wymaga: zgoda gpt zawsze)"
+            print(f"✅ Wyscig lokalny/chmura: {action.upper()}{note}")
+        return
+    m_draft = re.search(r"^(lyra\s+)?draft\s*(on|off|auto|status)?$", cmd_clean, flags=re.IGNORECASE)
+    if m_draft:
+        action = (m_draft.group(2) or "status").lower()
+        if action == "status":
+            model_name = get_config_field("llama_model", LLAMA_DEFAULT_MODEL)
+            pair = draft_models.pick_draft(model_name, _resolve_model_path(model_name))
+            print(f"Draft (dekodowanie spekulatywne): {draft_models.draft_mode().upper()}")
+            print(f"- Model: {model_name} | para: {pair[0] if pair else 'brak zgodnego modelu'}")
+            stats = get_last_stats() or {}
+            if stats.get("draft_acceptance") is not None:
+                print(f"- Akceptacja draftu (ostatnie zapytanie): {stats['draft_acceptance'] * 100:.0f}%")
+        else:
+            update_config_field("llama_draft", action)
+            print(f"✅ Draft: {action.upper()} (dziala od nastepnego startu llama-server)")
+        return
+    m_perf = re.search(r"^lyra\s+perf(?:\s+(\S+))?(?:\s+(\S+))?$", cmd_clean, flags=re.IGNORECASE)
+    if m_perf:
+        model_arg, since_arg = m_perf.group(1), m_perf.group(2)
+        # Jeden argument wygladajacy jak okres (24h, 7d, 2026-10-01) to "since", nie model.
+        if model_arg and not since_arg and perf_store.parse_since(model_arg) is not None:
+            model_arg, since_arg = None, model_arg
+        print(perf_store.format_report(model_arg, since_arg))
+        return
+    m_batch = re.search(r"^lyra\s+batch\s+(.+)$", cmd_clean, flags=re.IGNORECASE)
+    if m_batch:
+        _run_batch(m_batch.group(1))
+        return
+    if re.search(r"^(lyra\s+)?(slots|sloty)\s*(status)?$", cmd_clean, flags=re.IGNORECASE):
+        print(slot_store.format_status())
+        return
+    if re.search(r"^(lyra\s+)?(latency|opoznienia)\s*(status)?$", cmd_clean, flags=re.IGNORECASE):
+        print(latency_router.format_status())
+        return
+    if re.search(r"^(lyra\s+)?(vram|rezydencja)\s*(status)?$", cmd_clean, flags=re.IGNORECASE):
+        print(model_residency.format_status())
+        return
+    m_plan = re.search(r"^(lyra\s+)?plan\s+vram(?:\s+(\S+))?$", cmd_clean, flags=re.IGNORECASE)
+    if m_plan:
+        model_name = m_plan.group(2) or get_config_field("llama_model", LLAMA_DEFAULT_MODEL)
+        model_path = _resolve_model_path(model_name)
+        if not model_path:
+            print(f"❌ Brak modelu w liscie: {model_name}")
+        else:
+            print(vram_planner.format_plan(model_name, model_path, conn.parallel_slots("llama")))
+        return
+    m_pool = re.search(r"^(lyra\s+)?pool\s*(status|on|off|auto)?$", cmd_clean, flags=re.IGNORECASE)
+    if m_pool:
+        action = (m_pool.group(2) or "status").lower()
+        if action in ["on", "off", "auto"]:
+            update_config_field("llama_pool", action)
+            print(f"✅ Pula llama-server: {action.upper()} (dziala od nastepnego startu llama-server)")
+        else:
+            print(llama_pool.format_status())
+            print(llama_supervisor.format_status())
+        return
     cmd_lower = cmd_clean.lower()
     cmd_norm = cmd_lower.rstrip(" ?!.")
     log_command(cmd_clean)
@@ -1910,71 +2368,40 @@ def run_once(user_input):
 
     if cmd_norm in ["przetestuj model", "testuj model", "test model", "lyra przetestuj model", "lyra testuj model"]:
         active_name = get_active_local_model_name() or ""
+        sentence = {"type": "string", "minLength": 10}
+        # Schemat wymusza ksztalt odpowiedzi w samym generowaniu (json_schema / format) – bez recznego
+        # sprawdzania 15 linii i ponawiania; ponizej zostaja tylko kontrole tresci.
+        schema = {
+            "type": "object",
+            "properties": {
+                "MODEL_IMIE": {"type": "string", "enum": [active_name]},
+                "MODEL_TWORCA": {"type": "string", "minLength": 2},
+                "MODEL_POTRAFI": sentence,
+                "LINUX": {"type": "array", "items": dict(sentence, pattern="^.*Linux.*$"), "minItems": 10, "maxItems": 10},
+                "LYRA": {"type": "array", "items": sentence, "minItems": 2, "maxItems": 2},
+            },
+            "required": ["MODEL_IMIE", "MODEL_TWORCA", "MODEL_POTRAFI", "LINUX", "LYRA"],
+        }
         prompt = (
-            "Podaj odpowiedz w 15 liniach, dokladnie w formacie:\n"
-            f"MODEL_IMIE: {active_name}\n"
-            "MODEL_TWORCA: <tworca lub 'brak danych'>\n"
-            "MODEL_POTRAFI: <krotko: 1 zdanie>\n"
-            "LINUX_1: <zdanie>\n"
-            "LINUX_2: <zdanie>\n"
-            "LINUX_3: <zdanie>\n"
-            "LINUX_4: <zdanie>\n"
-            "LINUX_5: <zdanie>\n"
-            "LINUX_6: <zdanie>\n"
-            "LINUX_7: <zdanie>\n"
-            "LINUX_8: <zdanie>\n"
-            "LINUX_9: <zdanie>\n"
-            "LINUX_10: <zdanie>\n"
-            "LYRA_1: <zdanie>\n"
-            "LYRA_2: <zdanie>\n"
-            "Nie zmyslaj faktow. Nie dodawaj innych linii. "
-            "MODEL_IMIE musi byc dokladnie jak powyzej. "
-            "MODEL_TWORCA nie moze byc 'brak danych'. "
-            "LINUX_* musza byc pelnymi zdaniami o systemie Linux i zawierac slowo 'Linux'. "
-            "LYRA_* to 2 zdania o Lyra."
+            "Odpowiedz obiektem JSON z polami:\n"
+            f"MODEL_IMIE: dokladnie \"{active_name}\"\n"
+            "MODEL_TWORCA: tworca modelu\n"
+            "MODEL_POTRAFI: krotko, 1 zdanie\n"
+            "LINUX: lista 10 pelnych zdan o systemie Linux, kazde zawiera slowo 'Linux'\n"
+            "LYRA: lista 2 zdan o Lyra\n"
+            "Nie zmyslaj faktow."
         )
         try:
-            response, _ = query_model(prompt, get_active_local_model_name(), "local", config={"timeout":20}, history=[])
-            if response:
-                if "Błąd połączenia z llama-server" in response or "llama-server" in response:
-                    print("❌ Llama-server nieosiagalny. Uruchom: lyra zmien silnik na llama  start llama.")
-                    return
-                text = response.strip()
-                required = ["MODEL_IMIE:", "MODEL_TWORCA:", "MODEL_POTRAFI:"]
-                missing = [k for k in required if k not in text]
-                linux_lines = [f"LINUX_{i}:" for i in range(1, 11)]
-                linux_missing = [k for k in linux_lines if k not in text]
-                bad_markers = [
-                    "jan kowalski",
-                    "john doe",
-                    "przyklad",
-                    "przykład",
-                    "nie mam wiedzy",
-                ]
-                low = text.lower()
-                linux_bad = [ln for ln in low.splitlines() if ln.strip().startswith("linux_") and ("nie mam wiedzy" in ln or "linux" not in ln)]
-                name_line = next((ln for ln in text.splitlines() if ln.strip().startswith("MODEL_IMIE:")), "")
-                name_ok = active_name and name_line.strip().lower() == f"model_imie: {active_name}".lower()
-                creator_line = next((ln for ln in low.splitlines() if ln.strip().startswith("model_tworca:")), "")
-                creator_ok = creator_line and "brak danych" not in creator_line
-                lyra_lines = [ln for ln in text.splitlines() if ln.strip().startswith("LYRA_")]
-                lyra_ok = len(lyra_lines) == 2
-                if missing or linux_missing or any(m in low for m in bad_markers) or linux_bad or not name_ok or not creator_ok or not lyra_ok:
-                    print("❌ Test modelu nieudany (zla odpowiedz lub format).")
-                    if missing or linux_missing:
-                        print(f"Brak: {', '.join(missing + linux_missing)}")
-                    if any(m in low for m in bad_markers) or linux_bad:
-                        print("Powod: model powtarza przyklad lub unika odpowiedzi.")
-                    if not name_ok:
-                        print("Powod: MODEL_IMIE nie zgadza sie z aktywnym modelem.")
-                    if not creator_ok:
-                        print("Powod: MODEL_TWORCA nie moze byc 'brak danych'.")
-                    if not lyra_ok:
-                        print("Powod: musza byc dokladnie 2 linie LYRA_*.")
-                    print(f"Odpowiedź: {text}")
-                    return
-                print(text)
+            result, _ = query_model(prompt, active_name, "local", config={"timeout": 20, "schema": schema}, history=[])
+        except StructuredOutputError as e:
+            raw = e.raw or ""
+            if "llama-server" in str(e) and "Błąd" in str(e):
+                print("❌ Llama-server nieosiagalny. Uruchom: lyra zmien silnik na llama  start llama.")
                 return
+            print(f"❌ Test modelu nieudany (zly format): {e}")
+            if raw and raw != str(e):
+                print(f"Odpowiedź: {raw}")
+            return
         except Exception as e:
             msg = str(e)
             if "Failed to establish a new connection" in msg or "Operation not permitted" in msg:
@@ -1982,6 +2409,24 @@ def run_once(user_input):
             else:
                 print(f"❌ Test modelu nie powiodl sie: {e}")
             return
+        lines = [f"MODEL_IMIE: {result['MODEL_IMIE']}", f"MODEL_TWORCA: {result['MODEL_TWORCA']}",
+                 f"MODEL_POTRAFI: {result['MODEL_POTRAFI']}"]
+        lines += [f"LINUX_{i}: {txt}" for i, txt in enumerate(result["LINUX"], 1)]
+        lines += [f"LYRA_{i}: {txt}" for i, txt in enumerate(result["LYRA"], 1)]
+        text = "\n".join(lines)
+        bad_markers = ["jan kowalski", "john doe", "przyklad", "przykład", "nie mam wiedzy"]
+        low = text.lower()
+        creator_ok = "brak danych" not in result["MODEL_TWORCA"].lower()
+        if any(m in low for m in bad_markers) or not creator_ok:
+            print("❌ Test modelu nieudany (zla odpowiedz).")
+            if any(m in low for m in bad_markers):
+                print("Powod: model powtarza przyklad lub unika odpowiedzi.")
+            if not creator_ok:
+                print("Powod: MODEL_TWORCA nie moze byc 'brak danych'.")
+            print(f"Odpowiedź: {text}")
+            return
+        print(text)
+        return
 
     if cmd_norm in [
         "jaki jest nowy model",
@@ -2044,6 +2489,9 @@ def run_once(user_input):
     if cmd_lower in ["skanuj modele szybko", "lyra skanuj modele szybko", "skanuj modele fast", "lyra skanuj modele fast"]:
         print(tool_SCAN_MODELS("szybko", system_run, log_event))
         return
+    if cmd_lower in ["skanuj modele pelne", "lyra skanuj modele pelne", "skanuj modele pełne", "lyra skanuj modele pełne"]:
+        print(tool_SCAN_MODELS("pelne", system_run, log_event))
+        return
 
     if cmd_lower in ["dry-run on", "dry run on", "lyra dry-run on", "lyra dry run on"]:
         update_config_field("dry_run", True)
@@ -2333,7 +2781,10 @@ def run_once(user_input):
                 print("Nie mam ostatnio czytanego pliku w pamieci. Uzyj: lyra przeczytaj <plik>.")
                 return
             print("Streszczenie ostatniego pliku:")
-            summary = _summarize_text(LAST_FILE_CONTENT, "O czym jest ostatnio czytany plik?", bullets="5-7")
+            if len(LAST_FILE_CONTENT) > _summary_input_limit():
+                summary = _summarize_large_text(LAST_FILE_CONTENT, "O czym jest ostatnio czytany plik?", bullets="5-7")
+            else:
+                summary = _summarize_text(LAST_FILE_CONTENT, "O czym jest ostatnio czytany plik?", bullets="5-7")
             if _is_low_quality_response(summary) or not summary:
                 summary = _basic_summary(LAST_FILE_CONTENT)
             if summary:
@@ -2390,7 +2841,10 @@ def run_once(user_input):
                 print("⚠️ Użycie: lyra ustaw model <nazwa>")
                 return
             update_config_field("llama_model", model_name)
-            ok, msg = _start_llama_server(model_name)
+            if _get_local_backend() == "llama":
+                ok, msg = _swap_llama_model(model_name)
+            else:
+                ok, msg = _start_llama_server(model_name)
             print(msg if ok else f"❌ {msg}")
             return
         if cmd_tail_lower in ["pokaz model", "pokaż model"]:
@@ -2436,6 +2890,9 @@ def run_once(user_input):
             FORCE_ONLINE = False
             FORCED_CLOUD_MODEL = None
             print(result)
+            if active and active != "brak" and _get_local_backend() == "llama" and llama_probe.get_capabilities():
+                ok, msg = _swap_llama_model(active)
+                print(msg if ok else f"❌ {msg}")
             return
 
     # --- 2. TRYB BASH LUB FORCE-SHELL (!) ---
@@ -2489,32 +2946,43 @@ def run_once(user_input):
         return
 
     # Strategia i Model
-    strategy = choose_best_model(cmd_clean)
-    local_target, cloud_target = strategy if strategy else ("mistral", "gpt-4o")
+    task = task_class(cmd_clean)
+    local_candidates, cloud_target = candidate_models(cmd_clean)
+    local_target = local_candidates[0] if local_candidates else "mistral"
     
     # Prompt Systemowy zależny od trybu
     sys_instruction = "Jesteś Lyra, asystentem operacyjnym."
     if CURRENT_MODE == "code":
         sys_instruction = "Jesteś ekspertem programowania. Podawaj czysty kod, używaj komentarzy, bądź zwięzła."
-        local_target = "mistral" # Preferowany Bielik dla kodu lokalnie
+        # Lista z model_profiles.TASK_MODELS["code"]; Bielik (mistral) preferowany dla kodu lokalnie.
+        code_models = list(TASK_MODELS["code"][0])
+        local_target = "mistral" if "mistral" in code_models else code_models[0]
+        local_candidates = [local_target] + [m for m in code_models if m != local_target]
+    # Modele, ktorych kontekst (context_length z naglowka GGUF) nie pomiesci zapytania, odpadaja.
+    need_tokens = estimate_tokens(cmd_clean) + 1000
+    local_candidates = [m for m in local_candidates if gguf_index.context_ok(m, need_tokens)] or local_candidates
+    if local_target not in local_candidates:
+        local_target = local_candidates[0]
+    if _get_local_backend() == "ollama":
+        # Pierwszy kandydat, ktory wg zmierzonej predkosci zmiesci sie w SLO klasy zadania.
+        local_target = latency_router.choose(local_candidates, task, prompt_tokens=estimate_tokens(cmd_clean) + 1000) or local_target
+        # Tanszy model juz obecny w VRAM zamiast przeladowania preferowanego.
+        alternatives = [m for m in local_candidates if m != local_target]
+        local_target = model_residency.route(local_target, alternatives)
 
     # Dusza Lyry – jeśli dostępna, dołącz prompt tożsamości
+    soul_prompt = ""
     if LyraSoul:
         try:
-            soul_prompt = LyraSoul.get_prompt()
-            if soul_prompt:
-                sys_instruction = f"{sys_instruction}\n\n{soul_prompt}"
+            soul_prompt = LyraSoul.get_prompt() or ""
         except Exception:
-            pass
+            soul_prompt = ""
 
-    # Lokalny kontekst Lyry z pliku
-    recent_context = load_lyra_context()[-5:]
-    if recent_context:
-        ctx_lines = []
-        for entry in recent_context:
-            ctx_lines.append(f"U: {entry.get('user','')}")
-            ctx_lines.append(f"L: {entry.get('assistant','')}")
-        sys_instruction = f"{sys_instruction}\n\nKONTEKST LOKALNY:\n" + "\n".join(ctx_lines)
+    # Lokalny kontekst Lyry z pliku – ile wymian sie zmiesci, decyduje budzet tokenow.
+    history_items = [
+        f"U: {entry.get('user','')}\nL: {entry.get('assistant','')}"
+        for entry in load_lyra_context()[-HISTORY_MAX_TURNS:]
+    ]
 
     try: active_model = get_active_local_model_name() or "Lokalny"
     except: active_model = "Lokalny"
@@ -2592,7 +3060,10 @@ def run_once(user_input):
                         print("Nie mam ostatnio czytanego pliku w pamieci. Uzyj: lyra przeczytaj <plik>.")
                         return
                 print("Streszczenie ostatniego pliku:")
-                summary = _summarize_text(LAST_FILE_CONTENT, "O czym jest ostatnio czytany plik?", bullets="5-7")
+                if len(LAST_FILE_CONTENT) > _summary_input_limit():
+                    summary = _summarize_large_text(LAST_FILE_CONTENT, "O czym jest ostatnio czytany plik?", bullets="5-7")
+                else:
+                    summary = _summarize_text(LAST_FILE_CONTENT, "O czym jest ostatnio czytany plik?", bullets="5-7")
                 if _is_low_quality_response(summary) or not summary:
                     summary = _basic_summary(LAST_FILE_CONTENT)
                 if summary:
@@ -2618,7 +3089,7 @@ def run_once(user_input):
                 elif tool_name == "FILE_READ_SUMMARY_LONG":
                     bullets = "10"
                 print("Streszczenie:")
-                if len(content) > 12000:
+                if len(content) > _summary_input_limit():
                     summary = _summarize_large_text(content, cmd_clean, bullets=bullets, sentences=sentence_count)
                 elif sentence_count and sentence_count > 0:
                     summary = _summarize_text_sentences(content, cmd_clean, sentence_count)
@@ -2706,11 +3177,20 @@ def run_once(user_input):
                 return
 
     # Wywołanie AI
-    full_query = f"{sys_instruction}\n\nZapytanie: {cmd_clean}"
-    mem_ctx = build_memory_context()
-    if mem_ctx:
-        full_query = f"{sys_instruction}\n\nPAMIEC LYRY:\n{mem_ctx}\n\nZapytanie: {cmd_clean}"
-    
+    # Segmenty od najbardziej stalych (system, dusza, pamiec dluga) do zmiennych,
+    # zeby llama-server uzyl ponownie KV cache wspolnego prefiksu.
+    long_items, recent_items = memory_items()
+    assembled = build_context(
+        cmd_clean,
+        model=local_target,
+        system=sys_instruction,
+        soul=soul_prompt,
+        memory_items=long_items,
+        recent_items=recent_items,
+        history_items=history_items,
+    )
+    full_query = assembled["prompt"]
+    source, cloud_tried = None, False
     try:
         if FORCE_ONLINE:
             model_name = FORCED_CLOUD_MODEL or cloud_target
@@ -2723,55 +3203,83 @@ def run_once(user_input):
             LAST_STATS = None
             return
 
-        response, _ = query_model(full_query, local_target, "local", config={"timeout":90, "allow_cloud": False}, history=[])
-        if _local_unknown(response):
+        # Jeden limit czasu na cale zapytanie: lokalny model, ponowienie i chmura.
+        deadline = Deadline(get_config_field("request_deadline_sec", DEFAULT_DEADLINE_SEC))
+        # Przy stalej zgodzie router sam sciga sie z chmura (hedge) i do niej przechodzi;
+        # ponizszy fallback do chmury jest wtedy pomijany, zeby nie pytac jej drugi raz.
+        allow_cloud = not FORCE_LOCAL and _get_cloud_consent() == "always"
+        streamed_text = None
+        if _get_stream_enabled():
+            print("")
+            response, source = query_model_stream(full_query, local_target, cloud_target, config={"deadline": deadline, "session": "shell", "prefix_hash": assembled["prefix_hash"], "allow_cloud": allow_cloud}, history=[], on_token=_print_token)
+            print("")
+            if source == "cancelled":
+                print("⏹️ Przerwano generowanie.")
+                LAST_STATS = get_last_stats()
+                return
+            if response:
+                streamed_text = response
+        else:
+            response, source = query_model(full_query, local_target, cloud_target, config={"deadline": deadline, "session": "shell", "prefix_hash": assembled["prefix_hash"], "allow_cloud": allow_cloud}, history=[])
+        cloud_tried = allow_cloud and source in ["cloud", "offline", "timeout"]
+        if _local_unknown(response) and not cloud_tried:
             if FORCE_LOCAL:
                 print("⚠️ Lokalny model nie ma odpowiedzi, a tryb lokalny jest wymuszony.")
                 return
             consent = _get_cloud_consent()
             if consent == "always":
-                response, _ = query_gpt_online(full_query, "gpt-5.1")
+                response, _ = query_gpt_online(full_query, "gpt-5.1", timeout=deadline.timeout(cap=15))
             else:
-                choice = input("Lokalny model nie wie. Uzyc GPT? (tylko raz/jednorazowo/ok/zawsze/nie): ").strip().lower()
+                with deadline.paused():
+                    choice = input("Lokalny model nie wie. Uzyc GPT? (tylko raz/jednorazowo/ok/zawsze/nie): ").strip().lower()
                 if choice in ["zawsze", "always", "stala", "stała", "stale", "stałe", "full", "ciagla", "ciągła", "ciagle", "ciągłe"]:
                     print(_set_cloud_consent("zawsze"))
-                    response, _ = query_gpt_online(full_query, "gpt-5.1")
+                    response, _ = query_gpt_online(full_query, "gpt-5.1", timeout=deadline.timeout(cap=15))
                 elif choice in ["tylko raz", "jednorazowo", "ok", "raz", "once", "tak", "dobrze", "zgoda"]:
-                    response, _ = query_gpt_online(full_query, "gpt-5.1")
+                    response, _ = query_gpt_online(full_query, "gpt-5.1", timeout=deadline.timeout(cap=15))
                 else:
                     print("OK, bez GPT.")
                     return
         if response and response.startswith("[Zgoda GPT wymagana]"):
             print(response)
-            choice = input("Uzyc GPT teraz? (zawsze/raz/nie): ").strip().lower()
+            with deadline.paused():
+                choice = input("Uzyc GPT teraz? (zawsze/raz/nie): ").strip().lower()
             if choice in ["zawsze", "always", "stala", "stała", "full", "ciagla", "ciągła"]:
                 print(_set_cloud_consent("zawsze"))
-                response, _ = query_model(full_query, local_target, "local", config={"timeout":90, "allow_cloud": True}, history=[])
+                response, _ = query_model(full_query, local_target, "local", config={"deadline": deadline, "session": "shell", "prefix_hash": assembled["prefix_hash"], "allow_cloud": True}, history=[])
             elif choice in ["raz", "once", "ok", "tak", "dobrze", "zgoda na raz", "jednorazowo", "tylko raz"]:
                 os.environ["LYRA_CLOUD_ONCE"] = "1"
-                response, _ = query_model(full_query, local_target, "local", config={"timeout":90, "allow_cloud": True}, history=[])
+                response, _ = query_model(full_query, local_target, "local", config={"deadline": deadline, "session": "shell", "prefix_hash": assembled["prefix_hash"], "allow_cloud": True}, history=[])
                 os.environ.pop("LYRA_CLOUD_ONCE", None)
             else:
                 print("OK, bez GPT.")
                 return
         if not response or "error" in response.lower(): raise Exception("Błąd modelu")
         response = _normalize_output(response)
-        if _is_low_quality_response(response):
+        if _is_low_quality_response(response) and deadline.remaining() > 5:
             retry_prompt = f"Odpowiedz konkretnie i krotko po polsku: {cmd_clean}"
-            retry, _ = query_model(retry_prompt, local_target, "local", config={"timeout":60, "allow_cloud": False}, history=[])
+            retry, _ = query_model(retry_prompt, local_target, "local", config={"deadline": deadline, "allow_cloud": False}, history=[])
             if retry:
                 response = _normalize_output(retry)
-        print(f"\n{response}\n")
+        if streamed_text is None or response != _normalize_output(streamed_text):
+            print(f"\n{response}\n")
         append_lyra_context(cmd_clean, response)
         if LyraMemory:
             try:
                 LyraMemory.dodaj_do_osi_czasu(f"U: {cmd_clean} | L: {response[:200]}")
             except Exception:
                 pass
+        if source == "cloud":
+            LAST_INFERENCE = "online"
+            LAST_MODEL_NAME = cloud_target
+            LAST_STATS = None
+            return
         LAST_INFERENCE = "local"
         LAST_MODEL_NAME = local_target
         LAST_STATS = get_last_stats()
         _cache_stats(LAST_STATS)
+        if _get_local_backend() == "ollama":
+            model_residency.preload_next(local_target)
     except Exception as e:
         if FORCE_LOCAL:
             print(f"❌ Lokalny model nie działa: {e}")
@@ -2786,6 +3294,9 @@ def run_once(user_input):
         if consent != "always":
             print("[Zgoda GPT wymagana] Uzyj: zgoda gpt zawsze|raz|nie")
             return
+        if cloud_tried:
+            print(f"⚠️ Brak odpowiedzi lokalnej ani z chmury ({e}).")
+            return
         print(f"⚠️ Fallback do {cloud_target} Online... ({e})")
         response, _ = query_gpt_online(full_query, cloud_target)
         response = _normalize_output(response)
@@ -6,6 +6,8 @@ import sys
 from datetime import datetime
 from pathlib import Path
 
+from modules import cloud_client
+
 BASE_DIR = Path(__file__).resolve().parent
 CFG_PATH = BASE_DIR / "config.json"
 HISTORY_PATH = BASE_DIR / "lyra_project" / "jądro" / "HistoriaChatGPT.json"
@@ -45,20 +47,16 @@ def append_history(role, content):
 
 
 def main():
-    try:
-        import openai
-    except ImportError:
+    if not cloud_client.available():
         print("Brak biblioteki openai. Zainstaluj: pip install openai")
         sys.exit(1)
 
     cfg = load_cfg()
-    api_key = cfg.get("openai_api_key") or cfg.get("api_key")
-    if not api_key:
+    if not cloud_client.key_configured():
         print("Brak klucza API w config.json (openai_api_key).")
         sys.exit(1)
 
     model = cfg.get("default_cloud_model") or cfg.get("openai_model") or "gpt-4o"
-    client = openai.OpenAI(api_key=api_key)
 
     messages = []
     print("ChatGPT logger online. 'exit' aby wyjść.")
@@ -79,16 +77,18 @@ def main():
         messages.append({"role": "user", "content": user_text})
 
         try:
-            response = client.chat.completions.create(
+            # Odpowiedz strumieniowana na biezaco; klient wspoldzielony miedzy turami.
+            reply = cloud_client.chat(
+                messages,
                 model=model,
-                messages=messages,
-                timeout=30
+                timeout=30,
+                on_token=lambda t: print(t, end="", flush=True),
             )
-            reply = response.choices[0].message.content
+            print()
         except Exception as e:
             reply = f"[ERROR] {e}"
+            print(reply)
 
-        print(reply)
         append_history("assistant", reply)
         messages.append({"role": "assistant", "content": reply})
 
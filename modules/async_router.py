@@ -0,0 +1,289 @@
+import asyncio
+import time
+
+try:
+    import httpx
+except Exception:
+    httpx = None
+
+from modules import connection_manager as conn
+from modules import deadline as deadline_mod
+from modules import llama_pool
+from modules import llama_probe
+from modules import model_residency
+from modules import model_router
+from modules import request_scheduler
+from modules import single_flight
+from modules import slot_store
+from modules import structured_output
+from modules.memory_ai import search_memory
+
+# =========================================================
+# ASYNC ROUTER – asynchroniczny blizniak query_model (httpx
+# AsyncClient) z ograniczeniem wspolbieznosci do liczby slotow
+# serwera; te same etapy: deadline, schema, single-flight, sloty
+# =========================================================
+
+# Czekajace zapytanie: przydzial slotu sprawdzany w petli zdarzen co POLL_SEC,
+# krok harmonogramu (starzenie, timeout) w watku co DISPATCH_SEC.
+POLL_SEC = 0.05
+DISPATCH_SEC = 0.5
+
+
+def parallel_capacity(backend=None):
+    """Ile zapytan jednoczesnie obsluzy lokalny backend (sloty llama-server / OLLAMA_NUM_PARALLEL)."""
+    backend = backend or model_router._get_local_backend()
+    if backend == "llama":
+        caps = llama_probe.get_capabilities() or {}
+        if caps.get("slots"):
+            # Kazda instancja puli ma wlasne sloty.
+            return max(1, int(caps["slots"])) * max(1, len(llama_pool.instances()))
+    return conn.parallel_slots(backend)
+
+
+def _new_client(slots):
+    limits = httpx.Limits(max_connections=slots + 2, max_keepalive_connections=slots + 2)
+    return httpx.AsyncClient(limits=limits, timeout=None)
+
+
+async def _post_json(client, base, path, payload, timeout):
+    resp = await client.post(base + path, json=payload, timeout=timeout)
+    if resp.status_code != 200:
+        return None, resp.status_code
+    return resp.json(), 200
+
+
+async def _ollama_async(client, prompt, model, timeout, constraint=None):
+    payload = {"model": model, "prompt": prompt, "stream": False, "keep_alive": model_residency.keep_alive()}
+    try:
+        payload.update(structured_output.ollama_fields(constraint))
+    except structured_output.StructuredOutputError as e:
+        return f"Błąd Ollama: {e}"
+    await asyncio.to_thread(model_residency.ensure_loaded, model)
+    model_residency.touch(model)
+    try:
+        data, status = await _post_json(client, conn.OLLAMA_BASE, "/api/generate", payload, timeout)
+    except Exception as e:
+        return f"Błąd połączenia z Ollama: {str(e)}"
+    if data is None:
+        return f"Błąd Ollama: Status {status}"
+    try:
+        model_router._publish_stats(model_router._ollama_stats(data), model)
+    except Exception:
+        pass
+    return data.get("response", "Błąd: Brak pola response")
+
+
+async def _llama_async(client, prompt, timeout, session=None, constraint=None, prefix_hash=None):
+    timeout = await asyncio.to_thread(model_router._await_llama, timeout)
+    caps = await asyncio.to_thread(llama_probe.get_capabilities)
+    if not caps:
+        return "Błąd połączenia z llama-server: serwer nie wykryty"
+    path, payload = model_router._llama_payload(caps, prompt, session=session, constraint=constraint)
+    try:
+        with llama_pool.lease(caps["base"], session) as base:
+            # Jak w _llama_request: slot sesji z pliku przed tura, zapis po udanej.
+            await asyncio.to_thread(slot_store.before_turn, base, caps, session, prefix_hash)
+            start = time.time()
+            data, status = await _post_json(client, base, path, payload, timeout)
+            wall_s = time.time() - start
+            if data is not None:
+                await asyncio.to_thread(slot_store.after_turn, base, caps, session, prefix_hash)
+    except Exception as e:
+        llama_probe.invalidate()
+        return f"Błąd połączenia z llama-server: {str(e)}"
+    if data is None:
+        llama_probe.invalidate()
+        return f"Błąd llama-server: Status {status}"
+    try:
+        model_router._publish_stats(model_router._llama_result_stats(caps, data, wall_s), caps.get("model"))
+    except Exception:
+        pass
+    return model_router._llama_text(caps, data) or "Błąd llama-server: pusta odpowiedz"
+
+
+async def _local_async(client, prompt, local_model, backend, timeout, cfg, constraint=None):
+    session, prefix_hash = cfg.get("session"), cfg.get("prefix_hash")
+    if client is None:
+        # Bez httpx: synchroniczny klient z pula keep-alive w osobnym watku.
+        if backend == "llama":
+            return await asyncio.to_thread(model_router.query_llama_server, prompt, local_model, timeout, session,
+                                           constraint, prefix_hash)
+        return await asyncio.to_thread(model_router.query_ollama, prompt, local_model, timeout, constraint)
+    if backend == "llama":
+        return await _llama_async(client, prompt, timeout, session, constraint, prefix_hash)
+    return await _ollama_async(client, prompt, local_model, timeout, constraint)
+
+
+async def _cancellable(coro, cancel_event):
+    """Czeka na zapytanie; ustawiony cancel_event zamyka polaczenie (serwer przerywa generowanie)."""
+    task = asyncio.ensure_future(coro)
+    while not task.done():
+        if cancel_event.is_set():
+            task.cancel()
+            raise model_router.StreamCancelled()
+        await asyncio.wait({task}, timeout=0.1)
+    return task.result()
+
+
+async def _acquire(priority, timeout):
+    """
+    Ticket harmonogramu bez blokowania watku puli na czas czekania: czekajace zapytania
+    spia w petli zdarzen, a watki zostaja dla tych, ktore juz maja slot (probe, sloty, zapytania).
+    """
+    ticket = await asyncio.to_thread(request_scheduler.enqueue, priority)
+    try:
+        last = time.monotonic()
+        while not ticket.granted.is_set():
+            await asyncio.sleep(POLL_SEC)
+            if not ticket.granted.is_set() and time.monotonic() - last >= DISPATCH_SEC:
+                last = time.monotonic()
+                await asyncio.to_thread(request_scheduler.poll, ticket, timeout)
+    except BaseException:
+        # Timeout, anulowanie (Ctrl-C) – zlecenie nie moze zostac w kolejce ani trzymac slotu.
+        request_scheduler.release(ticket)
+        raise
+    return ticket
+
+
+async def _scheduled_local(client, semaphore, prompt, local_model, backend, cfg, deadline, constraint=None):
+    """Zapytanie lokalne przez wspolny harmonogram; wywlaszczone wraca do kolejki."""
+    priority = request_scheduler.normalize_priority(cfg.get("priority"))
+    for _ in range(request_scheduler.MAX_REQUEUE + 1):
+        try:
+            ticket = await _acquire(priority, deadline.remaining())
+        except request_scheduler.SchedulerBusy as e:
+            return f"Błąd harmonogramu: {e}"
+        try:
+            async with semaphore:
+                if deadline.expired():
+                    return deadline_mod.TIMEOUT_MESSAGE
+                timeout = deadline.timeout()
+                coro = _local_async(client, prompt, local_model, backend, timeout, cfg, constraint)
+                if client is None:
+                    # Watek z synchronicznym klientem nie da sie przerwac – bez wywlaszczania.
+                    return await coro
+                return await _cancellable(coro, ticket.cancel_event)
+        except model_router.StreamCancelled:
+            continue
+        finally:
+            request_scheduler.release(ticket)
+    return f"Błąd harmonogramu: wywlaszczone ({priority})"
+
+
+async def query_model_async(prompt, local_model, remote_model, config=None, history=None,
+                            client=None, semaphore=None):
+    """
+    Asynchroniczny odpowiednik query_model: pamiec -> lokalny model -> chmura.
+    Zwraca (odpowiedz, zrodlo). Wspolbieznosc ogranicza semaphore (domyslnie sloty serwera).
+    Te same klucze config co query_model: timeout/deadline, schema/grammar (wtedy zwraca
+    sparsowany obiekt albo rzuca StructuredOutputError), session/prefix_hash, priority, cache.
+    """
+    cfg = config or {}
+    constraint = structured_output.from_config(cfg)
+    if not constraint:
+        mem_answer = await asyncio.to_thread(search_memory, prompt)
+        if mem_answer:
+            return f"[Z pamięci] {mem_answer}", "memory"
+
+    mode = model_router._read_mode()
+    backend = model_router._get_local_backend()
+    deadline = deadline_mod.from_config(cfg, default=50)
+    # Odpowiedzi ograniczone schematem nie ida do cache (jak w _query_local).
+    cached, key = (None, None) if constraint else \
+        await asyncio.to_thread(model_router._cached_response, prompt, local_model, backend, cfg)
+    if cached:
+        return cached, backend if mode == "offline" else "local"
+
+    # Lokalny etap nie zjada czasu zarezerwowanego na chmure (jak w query_model).
+    local_deadline = deadline_mod.Deadline(
+        deadline.timeout() if mode == "offline" else model_router._local_budget(cfg, deadline))
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(parallel_capacity(backend))
+    own_client = None
+    if client is None and httpx is not None:
+        own_client = client = _new_client(parallel_capacity(backend))
+    priority = request_scheduler.normalize_priority(cfg.get("priority"))
+    # Ten sam klucz co w _query_local – identyczne zapytania z obu sciezek ida do backendu raz.
+    flight_key = await asyncio.to_thread(model_router._flight_key, prompt, local_model, backend, priority,
+                                         constraint, key)
+    try:
+        text = await single_flight.do_async(
+            flight_key,
+            lambda: _scheduled_local(client, semaphore, prompt, local_model, backend, cfg, local_deadline, constraint),
+            timeout=local_deadline.remaining(), retry_on=model_router.FLIGHT_RETRY)
+    except TimeoutError:
+        text = deadline_mod.TIMEOUT_MESSAGE
+    finally:
+        if own_client is not None:
+            await own_client.aclose()
+
+    if constraint:
+        return await asyncio.to_thread(model_router._structured_result, text, prompt, remote_model, cfg, constraint,
+                                       deadline, mode, backend)
+    await asyncio.to_thread(model_router._store_response, key, text, local_model, backend)
+    if mode == "offline":
+        return text, backend
+    if text and isinstance(text, str) and text.strip() and not model_router._is_error_response(text):
+        return text, "local"
+    return await asyncio.to_thread(model_router._cloud_fallback, prompt, remote_model, dict(cfg, deadline=deadline))
+
+
+async def gather_requests(requests, config=None, on_result=None, limit=None):
+    """
+    Wiele zapytan z roznymi modelami/parametrami: lista dictow
+    {prompt, model, remote_model?, config?}. Wspolny klient i semafor
+    (domyslnie sloty serwera, `limit` moze go tylko zmniejszyc). Wyniki w kolejnosci wejscia.
+    W locie jest najwyzej tyle wierszy, ile slotow – partia nie zapycha kolejki
+    harmonogramu, a termin zapytania liczy sie od startu wiersza, nie calej partii.
+    """
+    backend = model_router._get_local_backend()
+    slots = parallel_capacity(backend)
+    if limit:
+        slots = max(1, min(slots, int(limit)))
+    semaphore = asyncio.Semaphore(slots)
+    client = _new_client(slots) if httpx is not None else None
+
+    async def _one(idx, req):
+        cfg = dict(config or {})
+        cfg.update(req.get("config") or {})
+        try:
+            result = await query_model_async(req["prompt"], req.get("model"), req.get("remote_model"),
+                                             cfg, client=client, semaphore=semaphore)
+        except Exception as e:
+            # Jeden wadliwy prompt nie przerywa calej partii.
+            result = (f"Błąd zapytania: {e}", "error")
+        if on_result:
+            on_result(idx, result)
+        return result
+
+    requests = list(requests)
+    results = [None] * len(requests)
+    pending = iter(range(len(requests)))
+
+    async def _worker():
+        for idx in pending:
+            results[idx] = await _one(idx, requests[idx])
+
+    try:
+        await asyncio.gather(*[_worker() for _ in range(min(slots, len(requests)))])
+        return results
+    finally:
+        if client is not None:
+            await client.aclose()
+
+
+async def gather_models(prompts, local_model, remote_model=None, config=None, on_result=None):
+    """Uruchamia wiele promptow naraz (wspolny klient i semafor). Wyniki w kolejnosci wejscia."""
+    requests = [{"prompt": p, "model": local_model, "remote_model": remote_model} for p in prompts]
+    return await gather_requests(requests, config, on_result)
+
+
+def query_many(prompts, local_model, remote_model=None, config=None, on_result=None):
+    """Synchroniczna fasada dla istniejacego kodu: lista promptow -> lista (odpowiedz, zrodlo)."""
+    return asyncio.run(gather_models(prompts, local_model, remote_model, config, on_result))
+
+
+def query_model_sync(prompt, local_model, remote_model, config=None, history=None):
+    """Synchroniczna fasada pojedynczego zapytania przez sciezke async."""
+    return asyncio.run(query_model_async(prompt, local_model, remote_model, config, history))
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from modules import async_router
+from modules.token_budget import estimate_tokens
+
+# =========================================================
+# BATCH RUNNER – `lyra batch <input.jsonl>`: setki promptow
+# w jednym procesie, wspolbieznie do pojemnosci backendu;
+# wynik JSONL (kolejnosc wejscia lub ukonczenia), wznawianie
+# z pliku wynikowego i podsumowanie przepustowosci
+# =========================================================
+
+DEFAULT_PRIORITY = "bulk"
+DEFAULT_TIMEOUT = 120
+ORDERS = ("input", "completion")
+# Zrodla udanej odpowiedzi; reszta (offline, consent, timeout, error, ...) to blad do ponowienia.
+OK_SOURCES = {"local", "llama", "ollama", "cloud", "memory"}
+
+
+def default_output(input_path):
+    path = Path(input_path)
+    return path.with_name(f"{path.stem}.out.jsonl")
+
+
+def read_input(input_path):
+    """
+    Wiersze JSONL: {"id"?, "prompt", "model"?, "params"?: {timeout, cache, allow_cloud, priority, remote_model}}.
+    Zwykly tekst (nie-JSON) traktujemy jako sam prompt. Zwraca (zadania, bledy).
+    """
+    items, errors = [], []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                row = json.loads(line)
+            except Exception:
+                row = {"prompt": line}
+            if isinstance(row, str):
+                row = {"prompt": row}
+            if not isinstance(row, dict) or not str(row.get("prompt") or "").strip():
+                errors.append(f"linia {lineno}: brak pola prompt")
+                continue
+            row["index"] = len(items)
+            row.setdefault("id", row["index"])
+            items.append(row)
+    return items, errors
+
+
+def load_checkpoint(output_path):
+    """
+    Plik wynikowy jest checkpointem: zostawia tylko poprawne wiersze bez bledu
+    (ucieta ostatnia linia po przerwaniu znika) i zwraca zbior gotowych indeksow.
+    """
+    path = Path(output_path)
+    if not path.exists():
+        return set()
+    done, keep = set(), []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except Exception:
+                continue
+            if not isinstance(row, dict) or "index" not in row or row.get("error") or row["index"] in done:
+                continue
+            done.add(row["index"])
+            keep.append(json.dumps(row, ensure_ascii=False))
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text("".join(line + "\n" for line in keep), encoding="utf-8")
+    os.replace(tmp, path)
+    return done
+
+
+class _Writer:
+    """Dopisuje wyniki na biezaco; w trybie 'input' trzyma bufor do pierwszej luki."""
+
+    def __init__(self, output_path, order, pending):
+        self.f = open(output_path, "a", encoding="utf-8")
+        self.order = order
+        self.pending = sorted(pending)
+        self.next_pos = 0
+        self.buffer = {}
+        self.lock = threading.Lock()
+
+    def _write(self, row):
+        self.f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def add(self, row):
+        with self.lock:
+            if self.order == "completion":
+                self._write(row)
+            else:
+                self.buffer[row["index"]] = row
+                while self.next_pos < len(self.pending) and self.pending[self.next_pos] in self.buffer:
+                    self._write(self.buffer.pop(self.pending[self.next_pos]))
+                    self.next_pos += 1
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            for idx in sorted(self.buffer):
+                self._write(self.buffer[idx])
+            self.buffer.clear()
+            self.f.close()
+
+
+def _request(item, default_model, base_config):
+    params = dict(item.get("params") or {})
+    cfg = {"timeout": DEFAULT_TIMEOUT, "priority": DEFAULT_PRIORITY}
+    cfg.update(base_config or {})
+    cfg.update({k: v for k, v in params.items() if k != "remote_model"})
+    return {
+        "prompt": item["prompt"],
+        "model": item.get("model") or default_model,
+        "remote_model": params.get("remote_model"),
+        "config": cfg,
+    }
+
+
+def run_batch(input_path, default_model, output_path=None, order="input", workers=None, config=None,
+              progress=print):
+    """Wykonuje partie; zwraca slownik podsumowania (patrz format_summary)."""
+    if order not in ORDERS:
+        raise ValueError(f"nieznana kolejnosc: {order} (dostepne: {', '.join(ORDERS)})")
+    output_path = Path(output_path) if output_path else default_output(input_path)
+    items, input_errors = read_input(input_path)
+    done = load_checkpoint(output_path)
+    todo = [item for item in items if item["index"] not in done]
+    summary = {
+        "input": str(input_path), "output": str(output_path), "total": len(items),
+        "skipped": len(done), "invalid": input_errors, "done": 0, "errors": 0,
+        "sources": {}, "out_tokens": 0, "wall_s": 0.0,
+    }
+    if not todo:
+        return summary
+
+    writer = _Writer(output_path, order, [item["index"] for item in todo])
+    start = time.monotonic()
+
+    def _on_result(pos, result):
+        item = todo[pos]
+        text, source = result if isinstance(result, tuple) else (result, "?")
+        text = text if isinstance(text, str) else str(text)
+        failed = source not in OK_SOURCES or text.startswith("Błąd") or text.startswith("[Błąd")
+        model = item.get("model") or default_model
+        writer.add({
+            "index": item["index"], "id": item["id"], "model": model, "source": source,
+            "response": text, "t_s": round(time.monotonic() - start, 3),
+            "error": text if failed else None,
+        })
+        summary["done"] += 1
+        summary["errors"] += 1 if failed else 0
+        summary["sources"][source] = summary["sources"].get(source, 0) + 1
+        if not failed:
+            summary["out_tokens"] += estimate_tokens(text, model)
+        if progress and (summary["done"] % 10 == 0 or summary["done"] == len(todo)):
+            progress(f"[batch] {summary['done']}/{len(todo)} (bledy: {summary['errors']})")
+
+    requests = [_request(item, default_model, config) for item in todo]
+    try:
+        asyncio.run(async_router.gather_requests(requests, on_result=_on_result, limit=workers))
+    finally:
+        writer.close()
+        summary["wall_s"] = time.monotonic() - start
+    return summary
+
+
+def format_summary(summary):
+    lines = [f"Batch: {summary['input']} -> {summary['output']}"]
+    lines.append(f"- zadania: {summary['total']} | pominiete (checkpoint): {summary['skipped']} | "
+                 f"wykonane: {summary['done']} | bledy: {summary['errors']}")
+    if summary["invalid"]:
+        lines.append(f"- odrzucone wiersze: {len(summary['invalid'])} ({'; '.join(summary['invalid'][:3])})")
+    wall = summary["wall_s"]
+    if summary["done"] and wall > 0:
+        lines.append(f"- czas: {wall:.1f}s | {summary['done'] / wall:.2f} zapytan/s | "
+                     f"~{summary['out_tokens'] / wall:.1f} tok/s wyjscia (szacunek)")
+    if summary["sources"]:
+        lines.append("- zrodla: " + ", ".join(f"{k} {v}" for k, v in
+                                             sorted(summary["sources"].items(), key=lambda kv: -kv[1])))
+    return "\n".join(lines)
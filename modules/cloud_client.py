@@ -0,0 +1,103 @@
+import threading
+
+try:
+    import openai
+except Exception:
+    openai = None
+
+from modules import config_cache
+from modules import llama_probe
+
+# =========================================================
+# CLOUD CLIENT – jeden klient OpenAI na (klucz, base_url)
+# w calym procesie: wspolna pula HTTP/TLS, config czytany
+# tylko po zmianie pliku, opcjonalnie lokalny zastepca /v1
+# =========================================================
+
+LOCAL_STAND_IN = "local"
+LOCAL_STAND_IN_KEY = "sk-local"
+
+_LOCK = threading.Lock()
+_CLIENTS = {}
+
+
+def available():
+    return openai is not None
+
+
+def settings():
+    """
+    (api_key, base_url, model) dla chmury. cloud_base_url = "local" kieruje
+    zapytania do llama-server /v1 (testy bez kosztow API).
+    """
+    cfg = config_cache.load()
+    base_url = cfg.get("cloud_base_url") or None
+    api_key = cfg.get("openai_api_key") or cfg.get("api_key")
+    if base_url == LOCAL_STAND_IN:
+        caps = llama_probe.get_capabilities() or {}
+        base_url = f"{caps.get('base') or 'http://127.0.0.1:11435'}/v1"
+        api_key = LOCAL_STAND_IN_KEY
+    model = cfg.get("default_cloud_model") or "gpt-5.1"
+    return api_key, base_url, model
+
+
+def key_configured():
+    api_key, _, _ = settings()
+    return bool(api_key) and "TWÓJ_KLUCZ" not in api_key
+
+
+def get_client(api_key=None, base_url=None):
+    """Wspoldzielony klient (i jego pula polaczen keep-alive) dla pary klucz/base_url."""
+    if openai is None:
+        raise RuntimeError("brak biblioteki openai")
+    if api_key is None:
+        api_key, base_url, _ = settings()
+    key = (api_key, base_url)
+    with _LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            kwargs = {"api_key": api_key}
+            if base_url:
+                kwargs["base_url"] = base_url
+            client = openai.OpenAI(**kwargs)
+            _CLIENTS[key] = client
+        return client
+
+
+def chat(messages, model=None, timeout=20, on_token=None):
+    """
+    Zapytanie chat.completions przez wspoldzielonego klienta. Z on_token odpowiedz
+    jest strumieniowana (kazdy fragment trafia do callbacku). Zwraca pelny tekst.
+    """
+    api_key, base_url, default_model = settings()
+    client = get_client(api_key, base_url)
+    model = model or default_model
+    if on_token is None:
+        resp = client.chat.completions.create(model=model, messages=messages, timeout=timeout)
+        return resp.choices[0].message.content or ""
+    parts = []
+    stream = client.chat.completions.create(model=model, messages=messages, timeout=timeout, stream=True)
+    try:
+        for chunk in stream:
+            choices = getattr(chunk, "choices", None) or []
+            if not choices:
+                continue
+            token = getattr(choices[0].delta, "content", None) or ""
+            if token:
+                parts.append(token)
+                on_token(token)
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    return "".join(parts)
+
+
+def close_all():
+    with _LOCK:
+        for client in _CLIENTS.values():
+            try:
+                client.close()
+            except Exception:
+                pass
+        _CLIENTS.clear()
@@ -0,0 +1,45 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+# =========================================================
+# CONFIG CACHE – wspolny odczyt config.json dla modulow:
+# plik parsowany ponownie tylko po zmianie mtime/rozmiaru,
+# na goracej sciezce zostaje jeden stat
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+CONFIG_PATH = BASE_DIR / "config.json"
+
+_LOCK = threading.Lock()
+# sciezka -> (mtime_ns, rozmiar, dane)
+_CACHE = {}
+
+
+def load(path=None):
+    """
+    Zawartosc config.json (domyslnie z katalogu Lyry) jako dict; brak pliku
+    lub bledny JSON = {}. Zwraca kopie – zmiany wolajacego nie trafiaja do cache.
+    """
+    path = str(path or CONFIG_PATH)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _LOCK:
+        cached = _CACHE.get(path)
+        if cached and cached[:2] == stamp:
+            return dict(cached[2])
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            data = {}
+    except Exception:
+        data = {}
+    with _LOCK:
+        _CACHE[path] = (stamp[0], stamp[1], data)
+    return dict(data)
+
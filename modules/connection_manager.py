@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from modules import config_cache
+
+# =========================================================
+# CONNECTION MANAGER – wspolne sesje HTTP (keep-alive) dla
+# lokalnych backendow inferencji (Ollama / llama-server)
+# =========================================================
+
+OLLAMA_BASE = "http://127.0.0.1:11434"
+LLAMA_BASE = "http://127.0.0.1:11435"
+
+# Po tylu bledach z rzedu backend uznajemy za niezdrowy.
+UNHEALTHY_AFTER = 3
+# Po tym czasie niezdrowy backend znow dostaje szanse.
+UNHEALTHY_COOLDOWN = 10.0
+
+_LOCK = threading.Lock()
+_SESSIONS = {}
+_POOL_SIZES = {}
+_HEALTH = {}
+
+
+def default_base(backend):
+    if backend == "ollama":
+        return OLLAMA_BASE
+    # llama_port przestawia podmiana modelu (blue/green) – wszyscy klienci ida za nim.
+    port = config_cache.load().get("llama_port")
+    if port:
+        return f"http://127.0.0.1:{int(port)}"
+    return LLAMA_BASE
+
+
+def parallel_slots(backend):
+    """Liczba rownoleglych slotow serwera (llama-server --parallel / OLLAMA_NUM_PARALLEL)."""
+    cfg = config_cache.load()
+    if backend == "ollama":
+        raw = cfg.get("ollama_num_parallel") or os.environ.get("OLLAMA_NUM_PARALLEL") or 1
+    else:
+        raw = cfg.get("llama_parallel") or os.environ.get("LLAMA_ARG_N_PARALLEL") or 1
+    try:
+        return max(1, int(raw))
+    except Exception:
+        return 1
+
+
+def _new_session(pool_size):
+    session = requests.Session()
+    # +2 polaczenia na health-checki obok pelnego obciazenia slotow.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size + 2, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def get_session(backend, base_url=None):
+    base = base_url or default_base(backend)
+    key = (backend, base)
+    with _LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            size = _POOL_SIZES.get(key) or parallel_slots(backend)
+            session = _new_session(size)
+            _SESSIONS[key] = session
+            _POOL_SIZES[key] = size
+        return session
+
+
+def set_pool_size(backend, slots, base_url=None):
+    """Dopasowuje pule polaczen do liczby slotow (np. po starcie serwera)."""
+    base = base_url or default_base(backend)
+    key = (backend, base)
+    slots = max(1, int(slots or 1))
+    with _LOCK:
+        if _POOL_SIZES.get(key) == slots and key in _SESSIONS:
+            return
+        old = _SESSIONS.pop(key, None)
+        _SESSIONS[key] = _new_session(slots)
+        _POOL_SIZES[key] = slots
+    if old is not None:
+        try:
+            old.close()
+        except Exception:
+            pass
+
+
+def _mark(base, ok, latency_ms=None, error=None):
+    with _LOCK:
+        h = _HEALTH.setdefault(base, {
+            "ok": True,
+            "fails": 0,
+            "requests": 0,
+            "last_ok": None,
+            "last_error": None,
+            "latency_ms": None,
+        })
+        h["requests"] += 1
+        if ok:
+            h["ok"] = True
+            h["fails"] = 0
+            h["last_ok"] = time.time()
+            if latency_ms is not None:
+                prev = h.get("latency_ms")
+                h["latency_ms"] = latency_ms if prev is None else round(prev * 0.8 + latency_ms * 0.2, 1)
+        else:
+            h["fails"] += 1
+            h["last_error"] = error
+            h["last_fail"] = time.time()
+            if h["fails"] >= UNHEALTHY_AFTER:
+                h["ok"] = False
+
+
+def request(backend, method, path, base_url=None, **kwargs):
+    """Wysyla zapytanie przez wspolna sesje i aktualizuje stan zdrowia backendu."""
+    base = base_url or default_base(backend)
+    session = get_session(backend, base)
+    start = time.time()
+    try:
+        resp = session.request(method, base + path, **kwargs)
+    except Exception as e:
+        _mark(base, False, error=str(e))
+        raise
+    latency_ms = (time.time() - start) * 1000.0
+    if resp.status_code >= 500:
+        _mark(base, False, error=f"status {resp.status_code}")
+    else:
+        _mark(base, True, latency_ms=latency_ms)
+    return resp
+
+
+def post(backend, path, base_url=None, **kwargs):
+    return request(backend, "POST", path, base_url=base_url, **kwargs)
+
+
+def get(backend, path, base_url=None, **kwargs):
+    return request(backend, "GET", path, base_url=base_url, **kwargs)
+
+
+def is_healthy(backend, base_url=None):
+    base = base_url or default_base(backend)
+    with _LOCK:
+        h = _HEALTH.get(base)
+        if not h or h["ok"]:
+            return True
+        return (time.time() - h.get("last_fail", 0)) > UNHEALTHY_COOLDOWN
+
+
+def backend_health(base_url=None):
+    with _LOCK:
+        if base_url:
+            return dict(_HEALTH.get(base_url) or {})
+        return {k: dict(v) for k, v in _HEALTH.items()}
+
+
+def warm(backend, base_url=None):
+    """Otwiera polaczenie keep-alive w tle, zeby pierwszy prompt nie placil za handshake."""
+    path = "/api/tags" if backend == "ollama" else "/health"
+
+    def _run():
+        try:
+            get(backend, path, base_url=base_url, timeout=2)
+        except Exception:
+            pass
+
+    threading.Thread(target=_run, daemon=True).start()
+
+
+def close_all():
+    with _LOCK:
+        sessions = list(_SESSIONS.values())
+        _SESSIONS.clear()
+    for s in sessions:
+        try:
+            s.close()
+        except Exception:
+            pass
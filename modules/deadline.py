@@ -0,0 +1,51 @@
+import time
+from contextlib import contextmanager
+
+# =========================================================
+# DEADLINE – wspolny limit czasu calego zapytania; kazdy etap
+# (lokalny model, ponowienie, chmura) dostaje tylko reszte
+# =========================================================
+
+DEFAULT_DEADLINE_SEC = 120
+TIMEOUT_MESSAGE = "Błąd: przekroczono limit czasu odpowiedzi"
+
+
+class Deadline:
+    def __init__(self, seconds=DEFAULT_DEADLINE_SEC):
+        self.total = float(seconds)
+        self.expires = time.monotonic() + self.total
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap=None, floor=1.0):
+        """Timeout dla etapu: reszta budzetu, ograniczona przez cap, nie mniej niz floor."""
+        left = self.remaining()
+        if cap is not None:
+            left = min(left, float(cap))
+        return max(floor, left)
+
+    @contextmanager
+    def paused(self):
+        """Czas oczekiwania na uzytkownika (np. zgoda GPT) nie zjada budzetu."""
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.expires += time.monotonic() - start
+
+    def __repr__(self):
+        return f"Deadline({self.remaining():.1f}s/{self.total:.0f}s)"
+
+
+def from_config(config, default=None):
+    """Deadline z config['deadline'] albo nowy z config['timeout'] (lub default)."""
+    cfg = config or {}
+    deadline = cfg.get("deadline")
+    if isinstance(deadline, Deadline):
+        return deadline
+    seconds = cfg.get("timeout") or default or DEFAULT_DEADLINE_SEC
+    return Deadline(seconds)
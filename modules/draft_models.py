@@ -0,0 +1,140 @@
+import re
+from pathlib import Path
+
+from modules import config_cache
+from modules import gguf_index
+from modules.model_paths import load_models
+
+# =========================================================
+# DRAFT MODELS – dobor malego modelu do dekodowania
+# spekulatywnego llama-server (-md) wg rodziny slownika
+# =========================================================
+
+# Rodzina tokenizera/slownika po nazwie pliku; kolejnosc ma znaczenie
+# (destylaty DeepSeek maja wlasne tokeny specjalne, wiec osobna rodzina).
+FAMILY_RULES = [
+    (r"deepseek-r1-distill-qwen", "deepseek-qwen"),
+    (r"deepseek-r1-distill-llama", "deepseek-llama"),
+    (r"qwen2\.5|qwen2", "qwen2"),
+    (r"gemma-2", "gemma2"),
+    (r"llama-3|hermes-3", "llama3"),
+    (r"mistral-nemo", "tekken"),
+    (r"codestral|mathstral|mistral", "mistral"),
+    (r"smollm", "smollm"),
+    (r"phi-4", "phi4"),
+    (r"granite-3", "granite3"),
+]
+# Draft ma sens, gdy jest wyraznie mniejszy od modelu docelowego.
+MAX_DRAFT_RATIO = 0.25
+AUTO_MIN_TARGET_GB = 6.0
+DEFAULT_DRAFT_MAX = 16
+DEFAULT_DRAFT_MIN = 1
+DEFAULT_DRAFT_P_MIN = 0.75
+
+
+def draft_mode():
+    """off | on | auto (auto: tylko dla duzych modeli, gdy jest para)."""
+    mode = str(config_cache.load().get("llama_draft", "auto") or "auto").lower()
+    return mode if mode in ["on", "off", "auto"] else "auto"
+
+
+def name_family(name):
+    """Rodzina slownika z nazwy pliku (FAMILY_RULES)."""
+    low = str(name or "").lower()
+    if "mmproj" in low:
+        return None
+    for pattern, family in FAMILY_RULES:
+        if re.search(pattern, low):
+            return family
+    return None
+
+
+def vocab_family(name, path=None):
+    """Rodzina slownika: z naglowka GGUF (tokenizer + pre), bez niego – z nazwy pliku."""
+    if "mmproj" in str(name or "").lower():
+        return None
+    info = gguf_index.model_info(path) if path else None
+    if info and (info.get("tokenizer_pre") or info.get("tokenizer")):
+        return f"{info.get('tokenizer')}/{info.get('tokenizer_pre') or '-'}"
+    return name_family(name)
+
+
+def _model_size(path):
+    """Rozmiar w bajtach; dla pierwszego shardu suma wszystkich czesci."""
+    return gguf_index.total_bytes(path) if path else None
+
+
+def _gguf_models():
+    """(nazwa, sciezka) lokalnych plikow GGUF; shardy zwiniete do pierwszej czesci."""
+    available = gguf_index.collapse(load_models().get("available", {}))
+    return [(name, path) for name, path in available.items() if str(path).endswith(".gguf")]
+
+
+def pick_draft(model_name, model_path=None):
+    """Zwraca (nazwa, sciezka) modelu draft z tej samej rodziny slownika albo None."""
+    cfg = config_cache.load()
+    explicit = cfg.get("llama_draft_model")
+    models = dict(_gguf_models())
+    if explicit:
+        path = models.get(explicit) or explicit
+        return (explicit, path) if Path(path).exists() else None
+    target_path = model_path or models.get(model_name)
+    target_info = gguf_index.model_info(target_path) if target_path else None
+    family = vocab_family(model_name, target_path)
+    if not family:
+        return None
+    target_name_family = name_family(model_name)
+    target_size = _model_size(target_path)
+    if not target_size:
+        return None
+    candidates = []
+    for name, path in models.items():
+        if name == model_name or vocab_family(name, path) != family:
+            continue
+        # Naglowek laczy rodziny (np. llama-bpe dla llama3 i destylatow DeepSeek) – nazwa rozstrzyga.
+        draft_name_family = name_family(name)
+        if target_name_family and draft_name_family and draft_name_family != target_name_family:
+            continue
+        info = gguf_index.model_info(path)
+        if target_info and info and not gguf_index.vocab_compatible(target_info, info):
+            continue
+        size = _model_size(path)
+        if size and size <= target_size * MAX_DRAFT_RATIO:
+            candidates.append((size, name, path))
+    if not candidates:
+        return None
+    # Najwiekszy mieszczacy sie w limicie – lepsza akceptacja przy wciaz niskim koszcie.
+    _, name, path = max(candidates)
+    return name, path
+
+
+def draft_args(model_name, model_path=None, gpu_layers=99):
+    """Flagi llama-server dla dekodowania spekulatywnego ([] gdy wylaczone lub brak pary)."""
+    mode = draft_mode()
+    if mode == "off":
+        return [], None
+    if mode == "auto":
+        size = _model_size(model_path) if model_path else None
+        if not size or size < AUTO_MIN_TARGET_GB * 1024 ** 3:
+            return [], None
+    pair = pick_draft(model_name, model_path)
+    if not pair:
+        return [], None
+    cfg = config_cache.load()
+    args = [
+        "-md", str(pair[1]),
+        "-ngld", str(gpu_layers),
+        "--draft-max", str(cfg.get("llama_draft_max", DEFAULT_DRAFT_MAX)),
+        "--draft-min", str(cfg.get("llama_draft_min", DEFAULT_DRAFT_MIN)),
+        "--draft-p-min", str(cfg.get("llama_draft_p_min", DEFAULT_DRAFT_P_MIN)),
+    ]
+    return args, pair[0]
+
+
+def acceptance_rate(timings):
+    """Odsetek zaakceptowanych tokenow draftu z timings llama-server (None gdy brak)."""
+    drafted = (timings or {}).get("draft_n")
+    accepted = (timings or {}).get("draft_n_accepted")
+    if not drafted or accepted is None:
+        return None
+    return accepted / drafted
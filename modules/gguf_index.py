@@ -0,0 +1,408 @@
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+from pathlib import Path
+
+# =========================================================
+# GGUF INDEX – metadane modeli prosto z naglowka GGUF (mmap,
+# tylko klucze/wartosci i opisy tensorow, bez wag): architektura,
+# parametry, kwantyzacja, kontekst, warstwy, tokenizer, shardy;
+# cache wg sciezki + mtime, shardy zwijane w jeden model logiczny
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+INDEX_PATH = BASE_DIR / "logs" / "gguf_index.json"
+SHARD_RE = re.compile(r"-(\d{5})-of-(\d{5})$")
+GGUF_MAGIC = b"GGUF"
+DEFAULT_ALIGNMENT = 32
+# llama.cpp akceptuje draft, gdy slowniki roznia sie najwyzej o tyle tokenow.
+VOCAB_MAX_DIFF = 128
+# Tokeny specjalne porownywane przy zgodnosci slownika (brak w jednym z plikow = bez porownania).
+SPECIAL_TOKEN_KEYS = ("bos_token_id", "eos_token_id", "eot_token_id", "add_bos")
+# Wersja formatu wpisu w cache – zmiana wymusza ponowne czytanie naglowkow.
+INDEX_VERSION = 2
+
+# llama_ftype (general.file_type) -> nazwa kwantyzacji.
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16",
+}
+
+# Typy wartosci GGUF: format struct dla skalarow; 8 = string, 9 = tablica.
+_SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+_STRING, _ARRAY = 8, 9
+
+_LOCK = threading.Lock()
+_INDEX = None
+
+
+class _Reader:
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def scalar(self, fmt):
+        value = struct.unpack_from(fmt, self.buf, self.pos)[0]
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def string(self):
+        n = self.scalar("<Q")
+        value = bytes(self.buf[self.pos:self.pos + n]).decode("utf-8", errors="replace")
+        self.pos += n
+        return value
+
+    def skip_string(self):
+        n = self.scalar("<Q")
+        self.pos += n
+
+    def value(self, vtype):
+        """Wartosc klucza; tablice tylko jako dlugosc (slownik tokenow ma ~150k pozycji)."""
+        if vtype in _SCALARS:
+            return self.scalar(_SCALARS[vtype])
+        if vtype == _STRING:
+            return self.string()
+        if vtype == _ARRAY:
+            etype = self.scalar("<I")
+            count = self.scalar("<Q")
+            if etype in _SCALARS:
+                self.pos += count * struct.calcsize(_SCALARS[etype])
+            elif etype == _STRING:
+                for _ in range(count):
+                    self.skip_string()
+            else:
+                raise ValueError(f"nieobslugiwany typ tablicy {etype}")
+            return {"array_len": count}
+        raise ValueError(f"nieobslugiwany typ wartosci {vtype}")
+
+
+def read_header(path):
+    """Naglowek jednego pliku GGUF: {kv, tensors: {nazwa: bajty}, params}. Rzuca ValueError."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 24:
+            raise ValueError("plik za krotki")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            r = _Reader(buf)
+            if bytes(buf[:4]) != GGUF_MAGIC:
+                raise ValueError("brak sygnatury GGUF")
+            r.pos = 4
+            version = r.scalar("<I")
+            if version < 2:
+                raise ValueError(f"nieobslugiwana wersja GGUF {version}")
+            n_tensors = r.scalar("<Q")
+            n_kv = r.scalar("<Q")
+            kv = {}
+            for _ in range(n_kv):
+                key = r.string()
+                kv[key] = r.value(r.scalar("<I"))
+            infos = []
+            params = 0
+            for _ in range(n_tensors):
+                name = r.string()
+                n_dims = r.scalar("<I")
+                count = 1
+                for _ in range(n_dims):
+                    count *= r.scalar("<Q")
+                r.scalar("<I")  # typ ggml – rozmiar bierzemy z przesuniec
+                infos.append((r.scalar("<Q"), name))
+                params += count
+    align = int(kv.get("general.alignment") or DEFAULT_ALIGNMENT)
+    data_start = (r.pos + align - 1) // align * align
+    # Rozmiar tensora = odstep do nastepnego (z wyrownaniem); ostatni do konca pliku.
+    infos.sort()
+    tensors = {}
+    for i, (offset, name) in enumerate(infos):
+        end = infos[i + 1][0] if i + 1 < len(infos) else size - data_start
+        tensors[name] = max(0, end - offset)
+    return {"version": version, "kv": kv, "tensors": tensors, "params": params}
+
+
+def _summary(path, header):
+    """Z naglowka pliku tylko to, czego uzywa Lyra (cache ma byc maly)."""
+    kv = header["kv"]
+    arch = kv.get("general.architecture")
+
+    def arch_key(name):
+        return kv.get(f"{arch}.{name}") if arch else None
+
+    n_layer = arch_key("block_count")
+    # Kolejne shardy nie maja block_count – dlugosc listy wg najwyzszego numeru blk.N.
+    blocks = [int(m.group(1)) for m in (re.match(r"blk\.(\d+)\.", n) for n in header["tensors"]) if m]
+    layer_bytes = [0] * max(int(n_layer or 0), max(blocks) + 1 if blocks else 0)
+    embd_bytes = other_bytes = 0
+    for name, size in header["tensors"].items():
+        m = re.match(r"blk\.(\d+)\.", name)
+        if m:
+            layer_bytes[int(m.group(1))] += size
+        elif name.startswith("token_embd."):
+            embd_bytes += size
+        else:
+            other_bytes += size
+    # Czesc architektur ma liczbe glowic per warstwa (tablica) – wtedy brak jednej wartosci.
+    n_head = arch_key("attention.head_count")
+    n_head = None if isinstance(n_head, dict) else n_head
+    n_head_kv = arch_key("attention.head_count_kv")
+    n_head_kv = None if isinstance(n_head_kv, dict) else n_head_kv
+    n_embd = arch_key("embedding_length")
+    head_dim = n_embd // n_head if n_embd and n_head else None
+    tokens = kv.get("tokenizer.ggml.tokens")
+    file_type = kv.get("general.file_type")
+    return {
+        "architecture": arch,
+        "name": kv.get("general.name"),
+        "size_label": kv.get("general.size_label"),
+        "quant": FILE_TYPES.get(file_type, f"ftype {file_type}" if file_type is not None else None),
+        "context_length": arch_key("context_length"),
+        "n_layer": n_layer,
+        "n_embd": n_embd,
+        "n_head": n_head,
+        "n_head_kv": n_head_kv or n_head,
+        "key_length": arch_key("attention.key_length") or head_dim,
+        "value_length": arch_key("attention.value_length") or head_dim,
+        "tokenizer": kv.get("tokenizer.ggml.model"),
+        "tokenizer_pre": kv.get("tokenizer.ggml.pre"),
+        "n_vocab": tokens.get("array_len") if isinstance(tokens, dict) else None,
+        "bos_token_id": kv.get("tokenizer.ggml.bos_token_id"),
+        "eos_token_id": kv.get("tokenizer.ggml.eos_token_id"),
+        "eot_token_id": kv.get("tokenizer.ggml.eot_token_id"),
+        "add_bos": kv.get("tokenizer.ggml.add_bos_token"),
+        "split_no": kv.get("split.no"),
+        "split_count": kv.get("split.count"),
+        "params": header["params"],
+        "file_bytes": Path(path).stat().st_size,
+        "layer_bytes": layer_bytes,
+        "embd_bytes": embd_bytes,
+        "other_bytes": other_bytes,
+    }
+
+
+# ---------- cache (logs/gguf_index.json) ----------
+
+def _load_index():
+    global _INDEX
+    if _INDEX is None:
+        try:
+            _INDEX = json.loads(INDEX_PATH.read_text(encoding="utf-8"))
+        except Exception:
+            _INDEX = {}
+        if _INDEX.get("version") != INDEX_VERSION:
+            _INDEX = {"version": INDEX_VERSION, "files": {}}
+    return _INDEX
+
+
+def _save_index():
+    try:
+        INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp = INDEX_PATH.with_suffix(".tmp")
+        tmp.write_text(json.dumps(_load_index(), ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, INDEX_PATH)
+    except Exception:
+        pass
+
+
+def file_meta(path, save=True):
+    """Metadane jednego pliku z cache (klucz: sciezka, wazne przy tym samym mtime i rozmiarze)."""
+    path = str(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    with _LOCK:
+        entry = _load_index()["files"].get(path)
+    if entry and entry.get("mtime_ns") == st.st_mtime_ns and entry.get("size") == st.st_size:
+        return entry.get("meta")
+    try:
+        meta = _summary(path, read_header(path))
+    except Exception as e:
+        meta = {"error": str(e)}
+    with _LOCK:
+        _load_index()["files"][path] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "meta": meta}
+    if save:
+        with _LOCK:
+            _save_index()
+    return meta
+
+
+def prune(keep_paths=None):
+    """Usuwa z cache pliki, ktorych juz nie ma (albo spoza keep_paths). Zwraca liczbe usunietych."""
+    keep = {str(p) for p in keep_paths} if keep_paths is not None else None
+    with _LOCK:
+        files = _load_index()["files"]
+        gone = [p for p in files if (keep is not None and p not in keep) or not os.path.exists(p)]
+        for p in gone:
+            del files[p]
+        if gone:
+            _save_index()
+    return len(gone)
+
+
+def refresh(paths, workers=4):
+    """Czyta naglowki wielu plikow (rownolegle – HDD i SSD), jeden zapis cache na koniec."""
+    from concurrent.futures import ThreadPoolExecutor
+    paths = [str(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(lambda p: file_meta(p, save=False), paths))
+    with _LOCK:
+        _save_index()
+
+
+# ---------- modele logiczne (shardy) ----------
+
+def shard_info(path):
+    """(numer, liczba) dla pliku *-0000N-of-0000M.gguf albo None."""
+    m = SHARD_RE.search(Path(str(path)).stem)
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+
+def is_extra_shard(path):
+    """Kolejny shard (nie pierwszy) – nie jest osobnym modelem."""
+    info = shard_info(path)
+    return bool(info and info[0] != 1)
+
+
+def shard_paths(path):
+    """Wszystkie czesci modelu, zaczynajac od pierwszej (dla zwyklego pliku – on sam)."""
+    p = Path(str(path))
+    info = shard_info(p)
+    if not info:
+        return [p]
+    total = f"{info[1]:05d}"
+    return [p.with_name(SHARD_RE.sub(f"-{i:05d}-of-{total}", p.stem) + p.suffix) for i in range(1, info[1] + 1)]
+
+
+def logical_name(path):
+    """Nazwa modelu w models.json: nazwa pliku bez .gguf i bez sufiksu shardu."""
+    return SHARD_RE.sub("", Path(str(path)).stem).lower()
+
+
+def model_info(path):
+    """
+    Metadane modelu logicznego: naglowek pierwszego shardu + sumy z wszystkich czesci
+    (rozmiar, parametry, bajty warstw). None, gdy plik nie jest czytelnym GGUF.
+    """
+    if not path or not str(path).endswith(".gguf"):
+        return None
+    parts = shard_paths(path)
+    metas = [file_meta(p) for p in parts]
+    first = metas[0]
+    if not first or first.get("error"):
+        return None
+    info = dict(first)
+    info["path"] = str(parts[0])
+    info["shards"] = [str(p) for p in parts]
+    info["missing_shards"] = [str(p) for p, m in zip(parts, metas) if not m]
+    for meta in metas[1:]:
+        if not meta or meta.get("error"):
+            continue
+        info["params"] += meta.get("params") or 0
+        info["file_bytes"] += meta.get("file_bytes") or 0
+        info["embd_bytes"] += meta.get("embd_bytes") or 0
+        info["other_bytes"] += meta.get("other_bytes") or 0
+        layers = list(info["layer_bytes"])
+        for i, size in enumerate(meta.get("layer_bytes") or []):
+            if i >= len(layers):
+                layers.extend([0] * (i + 1 - len(layers)))
+            layers[i] += size
+        info["layer_bytes"] = layers
+    return info
+
+
+def collapse(available):
+    """
+    {nazwa: sciezka} z models.json -> jeden wpis na model logiczny (pierwszy shard),
+    klucz = logical_name. Kolejne shardy znikaja, wpisy spoza GGUF bez zmian.
+    """
+    out = {}
+    for name, path in (available or {}).items():
+        if not str(path).endswith(".gguf"):
+            out.setdefault(name, path)
+            continue
+        if is_extra_shard(path):
+            first = shard_paths(path)[0]
+            out.setdefault(logical_name(first), str(first))
+            continue
+        key = logical_name(path) if shard_info(path) else name
+        out[key] = path
+    return out
+
+
+def model_path(name):
+    """Sciezka pierwszego pliku modelu o danej nazwie (logicznej lub starej nazwie shardu)."""
+    from modules.model_paths import load_models
+    available = load_models().get("available", {})
+    low = str(name or "").lower()
+    for key, path in list(available.items()) + list(collapse(available).items()):
+        if key.lower() == low:
+            return str(shard_paths(path)[0]) if str(path).endswith(".gguf") else path
+    return None
+
+
+def info_by_name(name):
+    path = model_path(name)
+    return model_info(path) if path else None
+
+
+def total_bytes(path):
+    """Rozmiar modelu na dysku ze wszystkimi shardami (bez czytania naglowka)."""
+    total = 0
+    for part in shard_paths(path):
+        try:
+            total += part.stat().st_size
+        except OSError:
+            return None
+    return total
+
+
+def vocab_compatible(a, b):
+    """Czy dwa modele (metadane) maja ten sam slownik – warunek dekodowania spekulatywnego."""
+    if not a or not b:
+        return False
+    if (a.get("tokenizer"), a.get("tokenizer_pre")) != (b.get("tokenizer"), b.get("tokenizer_pre")):
+        return False
+    # Ten sam tokenizer, inne tokeny specjalne (np. destylaty) – draft sie rozjezdza.
+    for key in SPECIAL_TOKEN_KEYS:
+        if a.get(key) is not None and b.get(key) is not None and a[key] != b[key]:
+            return False
+    if a.get("n_vocab") and b.get("n_vocab"):
+        return abs(a["n_vocab"] - b["n_vocab"]) <= VOCAB_MAX_DIFF
+    return True
+
+
+def context_ok(name, tokens):
+    """Czy model (wg context_length z naglowka) pomiesci tyle tokenow; brak danych = tak."""
+    info = info_by_name(name)
+    ctx = (info or {}).get("context_length")
+    return not ctx or tokens <= ctx
+
+
+def _params_label(info):
+    if info.get("size_label"):
+        return str(info["size_label"])
+    params = info.get("params") or 0
+    return f"{params / 1e9:.1f}B" if params >= 1e9 else f"{params / 1e6:.0f}M"
+
+
+def describe(info):
+    """Jedna linia dla listy modeli."""
+    if not info:
+        return "brak metadanych GGUF"
+    parts = [
+        info.get("architecture") or "?",
+        _params_label(info),
+        info.get("quant") or "?",
+        f"ctx {info['context_length']}" if info.get("context_length") else "ctx ?",
+        f"{info['n_layer']} warstw" if info.get("n_layer") else "warstwy ?",
+        f"tok {info.get('tokenizer_pre') or info.get('tokenizer') or '?'}",
+        f"{info.get('file_bytes', 0) / 1024 ** 3:.1f} GB",
+    ]
+    if len(info.get("shards") or []) > 1:
+        missing = len(info.get("missing_shards") or [])
+        parts.append(f"{len(info['shards'])} shardy" + (f", BRAK {missing}" if missing else ""))
+    return " | ".join(parts)
@@ -0,0 +1,219 @@
+import json
+import os
+import statistics
+import threading
+import time
+from pathlib import Path
+
+from modules import config_cache
+
+# =========================================================
+# LATENCY ROUTER – historia predkosci modeli (prompt/gen t/s,
+# TTFT) i wybor najlepszego modelu mieszczacego sie w SLO
+# danej klasy zadan; kolejnosc regul slow kluczowych = remis
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+# Dopisywany JSONL (jedna linia na pomiar) – bez przepisywania pliku po kazdym zapytaniu.
+HISTORY_PATH = BASE_DIR / "logs" / "model_latency.jsonl"
+LEGACY_PATH = BASE_DIR / "logs" / "model_latency.json"
+HISTORY_LEN = 50
+MIN_SAMPLES = 3
+# Kompaktowanie (przyciecie do HISTORY_LEN per model), gdy plik ma tyle razy wiecej linii.
+COMPACT_FACTOR = 4
+
+# Domyslny limit czasu odpowiedzi (s) i oczekiwana dlugosc odpowiedzi (tokeny) per klasa.
+DEFAULT_SLO_SEC = {"image": 60, "code": 30, "reasoning": 45, "polish": 20, "general": 15}
+EXPECTED_OUTPUT_TOKENS = {"image": 200, "code": 400, "reasoning": 500, "polish": 250, "general": 200}
+
+_LOCK = threading.Lock()
+_HISTORY = None
+_LINES = 0
+
+
+def enabled():
+    return str(config_cache.load().get("latency_routing", "on")).lower() in ["on", "true", "1", "yes", "tak"]
+
+
+def _read_file():
+    """Historia z pliku: {model: [pomiary]} (ostatnie HISTORY_LEN) i liczba linii JSONL."""
+    hist, lines = {}, 0
+    try:
+        with open(HISTORY_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # Urwana linia (przerwany zapis) – pomijamy.
+                    continue
+                if isinstance(row, dict) and row.get("model"):
+                    hist.setdefault(row.pop("model"), []).append(row)
+    except OSError:
+        pass
+    for rows in hist.values():
+        del rows[:-HISTORY_LEN]
+    return hist, lines
+
+
+def _write_file(hist):
+    tmp = HISTORY_PATH.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        for model, rows in hist.items():
+            for row in rows:
+                f.write(json.dumps(dict(row, model=model), ensure_ascii=False) + "\n")
+    tmp.replace(HISTORY_PATH)
+
+
+def _migrate_legacy():
+    """Jednorazowo: dawny model_latency.json (caly slownik) -> JSONL."""
+    try:
+        if not LEGACY_PATH.exists() or HISTORY_PATH.exists():
+            return
+        legacy = json.loads(LEGACY_PATH.read_text(encoding="utf-8"))
+        if isinstance(legacy, dict):
+            _write_file({k: v[-HISTORY_LEN:] for k, v in legacy.items() if isinstance(v, list)})
+        LEGACY_PATH.unlink()
+    except Exception:
+        pass
+
+
+def _history():
+    global _HISTORY, _LINES
+    if _HISTORY is None:
+        _migrate_legacy()
+        _HISTORY, _LINES = _read_file()
+    return _HISTORY
+
+
+def _append(key, sample):
+    """
+    Jedna linia z O_APPEND – zapisy kilku procesow (shell, konsola, batch) sie nie przeplataja.
+    Co jakis czas plik jest przycinany: swiezy odczyt, zapis do .tmp i podmiana.
+    """
+    global _LINES
+    HISTORY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    line = json.dumps(dict(sample, model=key), ensure_ascii=False) + "\n"
+    fd = os.open(str(HISTORY_PATH), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
+    _LINES += 1
+    if _LINES <= COMPACT_FACTOR * HISTORY_LEN * max(1, len(_history())):
+        return
+    # Pomiar dopisany przez inny proces miedzy odczytem a podmiana przepada – to tylko statystyka.
+    hist, _ = _read_file()
+    _write_file(hist)
+    _LINES = sum(len(rows) for rows in hist.values())
+
+
+def _key(model):
+    name = str(model or "").strip().lower()
+    return name[:-7] if name.endswith(":latest") else name
+
+
+def record(model, stats):
+    """Dopisuje pomiar (z LAST_STATS) do historii modelu; pomija trafienia cache."""
+    if not model or not stats or stats.get("cache_hit"):
+        return
+    sample = {
+        "prompt_tps": stats.get("prompt_tps"),
+        "gen_tps": stats.get("gen_tps"),
+        "ttft": stats.get("ttft"),
+        "ts": time.time(),
+    }
+    if not sample["gen_tps"] and not sample["ttft"]:
+        return
+    key = _key(model)
+    with _LOCK:
+        rows = _history().setdefault(key, [])
+        rows.append(sample)
+        del rows[:-HISTORY_LEN]
+        try:
+            _append(key, sample)
+        except Exception:
+            pass
+
+
+def _median(rows, field):
+    values = [r[field] for r in rows if r.get(field)]
+    return statistics.median(values) if values else None
+
+
+def profile(model):
+    """Mediany z ostatnich pomiarow: {'prompt_tps', 'gen_tps', 'ttft', 'samples'} albo None."""
+    rows = _history().get(_key(model)) or []
+    if len(rows) < MIN_SAMPLES:
+        return None
+    return {
+        "prompt_tps": _median(rows, "prompt_tps"),
+        "gen_tps": _median(rows, "gen_tps"),
+        "ttft": _median(rows, "ttft"),
+        "samples": len(rows),
+    }
+
+
+def estimate_seconds(model, prompt_tokens, output_tokens):
+    """Szacowany czas calej odpowiedzi: prefill (lub zmierzony TTFT) + generowanie."""
+    prof = profile(model)
+    if not prof or not prof.get("gen_tps"):
+        return None
+    if prof.get("prompt_tps"):
+        first = prompt_tokens / prof["prompt_tps"]
+        if prof.get("ttft"):
+            first = max(first, prof["ttft"])
+    else:
+        first = prof.get("ttft") or 0.0
+    return first + output_tokens / prof["gen_tps"]
+
+
+def slo_seconds(task):
+    custom = config_cache.load().get("latency_slo_sec") or {}
+    try:
+        return float(custom.get(task, DEFAULT_SLO_SEC.get(task, DEFAULT_SLO_SEC["general"])))
+    except Exception:
+        return float(DEFAULT_SLO_SEC["general"])
+
+
+def choose(candidates, task="general", prompt_tokens=1500, output_tokens=None):
+    """
+    Z listy kandydatow (kolejnosc = reguly slow kluczowych) wybiera pierwszy
+    model, ktory wg historii zmiesci sie w SLO klasy. Modele bez historii
+    traktujemy optymistycznie (trzeba je zmierzyc). Gdy zaden nie spelnia SLO
+    – najszybszy wg szacunku.
+    """
+    if not candidates:
+        return None
+    if not enabled():
+        return candidates[0]
+    output_tokens = output_tokens or EXPECTED_OUTPUT_TOKENS.get(task, EXPECTED_OUTPUT_TOKENS["general"])
+    slo = slo_seconds(task)
+    estimates = []
+    for model in candidates:
+        est = estimate_seconds(model, prompt_tokens, output_tokens)
+        if est is None or est <= slo:
+            return model
+        estimates.append((est, model))
+    return min(estimates)[1]
+
+
+def format_status():
+    hist = _history()
+    if not hist:
+        return "Historia opoznien modeli: brak pomiarow."
+    lines = ["Historia opoznien modeli (mediana z ostatnich pomiarow):"]
+    for model in sorted(hist):
+        prof = profile(model)
+        if not prof:
+            lines.append(f"- {model}: za malo pomiarow ({len(hist[model])}/{MIN_SAMPLES})")
+            continue
+        p = f"{prof['prompt_tps']:.1f}" if prof.get("prompt_tps") else "?"
+        g = f"{prof['gen_tps']:.1f}" if prof.get("gen_tps") else "?"
+        t = f"{prof['ttft']:.2f}s" if prof.get("ttft") else "?"
+        est = estimate_seconds(model, 1500, EXPECTED_OUTPUT_TOKENS["general"])
+        est_txt = f" | ~{est:.1f}s/odp." if est else ""
+        lines.append(f"- {model}: P {p} t/s | G {g} t/s | TTFT {t} | n={prof['samples']}{est_txt}")
+    slo = ", ".join(f"{k} {slo_seconds(k):.0f}s" for k in DEFAULT_SLO_SEC)
+    lines.append(f"SLO: {slo}")
+    return "\n".join(lines)
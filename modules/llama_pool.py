@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from modules import config_cache
+from modules import connection_manager as conn
+
+# =========================================================
+# LLAMA POOL – kilka instancji llama-server (np. jedna na GPU)
+# z routingiem do najmniej obciazonej instancji
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+POOL_STATE = BASE_DIR / "logs" / "llama_pool.json"
+DEFAULT_BASE_PORT = 11435
+DEFAULT_GPUS = [0, 1]
+
+_LOCK = threading.Lock()
+_OUTSTANDING = {}
+_SERVED = {}
+# sesja -> instancja: kolejne tury trafiaja tam, gdzie lezy ich KV cache / slot
+_PINNED = {}
+_INSTANCES = None
+
+
+def pool_mode():
+    """off | on | auto (pula tylko gdy model miesci sie na jednej karcie)."""
+    mode = str(config_cache.load().get("llama_pool", "off") or "off").lower()
+    return mode if mode in ["on", "auto"] else "off"
+
+
+def pool_gpus():
+    gpus = config_cache.load().get("llama_pool_gpus") or DEFAULT_GPUS
+    if isinstance(gpus, (int, str)):
+        gpus = [gpus]
+    return [str(g) for g in gpus]
+
+
+def pool_base_port():
+    try:
+        return int(config_cache.load().get("llama_pool_base_port", DEFAULT_BASE_PORT))
+    except Exception:
+        return DEFAULT_BASE_PORT
+
+
+def plan_instances():
+    """Lista (port, gpu) dla kolejnych instancji puli."""
+    base = pool_base_port()
+    return [(base + i, gpu) for i, gpu in enumerate(pool_gpus())]
+
+
+def _load_state():
+    try:
+        if POOL_STATE.exists():
+            data = json.loads(POOL_STATE.read_text(encoding="utf-8"))
+            if isinstance(data, list):
+                return data
+    except Exception:
+        pass
+    return []
+
+
+def instances():
+    global _INSTANCES
+    with _LOCK:
+        if _INSTANCES is None:
+            _INSTANCES = _load_state()
+        return list(_INSTANCES)
+
+
+def register(items):
+    """Zapisuje uruchomione instancje: [{'port', 'gpu', 'model', 'pid'}]."""
+    global _INSTANCES
+    clean = []
+    for item in items:
+        entry = dict(item)
+        entry["base"] = f"http://127.0.0.1:{entry['port']}"
+        entry["started_at"] = entry.get("started_at") or time.time()
+        clean.append(entry)
+    with _LOCK:
+        _INSTANCES = clean
+        _PINNED.clear()
+    try:
+        POOL_STATE.parent.mkdir(parents=True, exist_ok=True)
+        POOL_STATE.write_text(json.dumps(clean, ensure_ascii=False, indent=2), encoding="utf-8")
+    except Exception:
+        pass
+
+
+def clear():
+    register([])
+
+
+def active():
+    return len(instances()) > 1
+
+
+def _pick_base(session=None):
+    bases = [i["base"] for i in instances()]
+    healthy = [b for b in bases if conn.is_healthy("llama", b)]
+    with _LOCK:
+        pinned = _PINNED.get(session) if session else None
+    # Sesja zostaje na swojej instancji, dopoki ta jest zdrowa.
+    if pinned in healthy:
+        return pinned
+    candidates = healthy or bases
+    if not candidates:
+        return None
+    with _LOCK:
+        # Najmniej zaleglych zapytan; przy remisie ta, ktora obsluzyla mniej.
+        base = min(candidates, key=lambda b: (_OUTSTANDING.get(b, 0), _SERVED.get(b, 0)))
+        if session:
+            _PINNED[session] = base
+        return base
+
+
+@contextmanager
+def lease(default_base=None, session=None):
+    """
+    Wypozycza adres instancji na czas jednego zapytania: instancje przypieta do sesji,
+    a bez sesji (albo gdy przypieta jest niezdrowa) – najmniej obciazona.
+    """
+    base = _pick_base(session) or default_base
+    if base is None:
+        yield None
+        return
+    with _LOCK:
+        _OUTSTANDING[base] = _OUTSTANDING.get(base, 0) + 1
+    try:
+        yield base
+    finally:
+        with _LOCK:
+            _OUTSTANDING[base] = max(0, _OUTSTANDING.get(base, 1) - 1)
+            _SERVED[base] = _SERVED.get(base, 0) + 1
+
+
+def outstanding(base):
+    with _LOCK:
+        return _OUTSTANDING.get(base, 0)
+
+
+def check_health(timeout=2):
+    """GET /health na kazdej instancji; wynik {base: 'ok' | 'loading' | 'down'}."""
+    out = {}
+    for inst in instances():
+        base = inst["base"]
+        try:
+            r = conn.get("llama", "/health", base_url=base, timeout=timeout)
+            if r.status_code == 200:
+                out[base] = "ok"
+            elif r.status_code == 503:
+                out[base] = "loading"
+            else:
+                out[base] = f"status {r.status_code}"
+        except Exception:
+            out[base] = "down"
+    return out
+
+
+def format_status():
+    items = instances()
+    if not items:
+        return f"Pula llama-server: brak instancji (tryb: {pool_mode()})."
+    health = check_health()
+    lines = [f"Pula llama-server (tryb: {pool_mode()}, instancje: {len(items)}):"]
+    for inst in items:
+        base = inst["base"]
+        with _LOCK:
+            served = _SERVED.get(base, 0)
+            pending = _OUTSTANDING.get(base, 0)
+        lines.append(
+            f"- :{inst['port']} GPU{inst.get('gpu', '?')} | {health.get(base, '?')} | "
+            f"model {inst.get('model') or '?'} | w toku {pending} | obsluzone {served}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+from modules import config_cache
+from modules import connection_manager as conn
+from modules import slot_store
+
+# =========================================================
+# LLAMA PROBE – jednorazowe wykrycie portu, dialektu API,
+# modelu, n_ctx i liczby slotow llama-server (z cache)
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+PROBE_CACHE = BASE_DIR / "logs" / "llama_probe.json"
+DEFAULT_PORTS = [11435, 11434]
+
+_LOCK = threading.Lock()
+_CAPS = None
+
+
+def _candidate_ports():
+    cfg = config_cache.load()
+    ports = []
+    try:
+        if cfg.get("llama_port"):
+            ports.append(int(cfg.get("llama_port")))
+    except Exception:
+        pass
+    for p in DEFAULT_PORTS:
+        if p not in ports:
+            ports.append(p)
+    return ports
+
+
+def _probe_port(port, timeout):
+    base = f"http://127.0.0.1:{port}"
+    try:
+        r = conn.get("llama", "/props", base_url=base, timeout=timeout)
+    except Exception:
+        return None
+    if r.status_code == 200:
+        try:
+            data = r.json()
+        except Exception:
+            data = {}
+        gen = data.get("default_generation_settings") or {}
+        model_path = data.get("model_path") or gen.get("model") or ""
+        return {
+            "base": base,
+            "port": port,
+            "dialect": "completion",
+            "model": Path(model_path).stem if model_path else "",
+            "n_ctx": gen.get("n_ctx") or data.get("n_ctx"),
+            "slots": data.get("total_slots") or 1,
+        }
+    # Ollama tez odpowiada na /v1/models – nie traktujemy jej jak llama-server.
+    try:
+        o = conn.get("llama", "/api/version", base_url=base, timeout=timeout)
+        if o.status_code == 200:
+            return None
+    except Exception:
+        pass
+    try:
+        r = conn.get("llama", "/v1/models", base_url=base, timeout=timeout)
+    except Exception:
+        return None
+    if r.status_code != 200:
+        return None
+    try:
+        items = r.json().get("data") or []
+    except Exception:
+        items = []
+    first = items[0] if items else {}
+    meta = first.get("meta") or {}
+    return {
+        "base": base,
+        "port": port,
+        "dialect": "chat",
+        "model": first.get("id") or "",
+        "n_ctx": meta.get("n_ctx_train"),
+        "slots": 1,
+    }
+
+
+def _save(caps):
+    try:
+        PROBE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        PROBE_CACHE.write_text(json.dumps(caps or {}, ensure_ascii=False), encoding="utf-8")
+    except Exception:
+        pass
+
+
+def _load():
+    try:
+        if PROBE_CACHE.exists():
+            data = json.loads(PROBE_CACHE.read_text(encoding="utf-8"))
+            if isinstance(data, dict) and data.get("base"):
+                return data
+    except Exception:
+        pass
+    return None
+
+
+def probe(force=False, timeout=2):
+    """Wykrywa dzialajacy llama-server. Wynik trafia do pamieci i logs/llama_probe.json."""
+    global _CAPS
+    with _LOCK:
+        if _CAPS and not force:
+            return _CAPS
+        caps = None
+        for port in _candidate_ports():
+            caps = _probe_port(port, timeout)
+            if caps:
+                break
+        if caps:
+            caps["probed_at"] = time.time()
+            conn.set_pool_size("llama", caps.get("slots") or 1, base_url=caps["base"])
+        _CAPS = caps
+        _save(caps)
+        return caps
+
+
+def get_capabilities():
+    """Zwraca zapamietane mozliwosci serwera; probe tylko gdy brak danych."""
+    global _CAPS
+    if _CAPS:
+        return _CAPS
+    cached = _load()
+    if cached:
+        with _LOCK:
+            _CAPS = cached
+        return cached
+    return probe()
+
+
+def target_port():
+    """Port, na ktory pojdzie zapytanie: wykryty wczesniej albo pierwszy kandydat (bez sieci)."""
+    caps = _CAPS or _load()
+    if caps and caps.get("port"):
+        return int(caps["port"])
+    return _candidate_ports()[0]
+
+
+def invalidate():
+    global _CAPS
+    with _LOCK:
+        _CAPS = None
+    # Serwer mogl wstac od nowa z pustymi slotami – ponowne przywrocenie z plikow.
+    slot_store.forget()
+    try:
+        if PROBE_CACHE.exists():
+            PROBE_CACHE.unlink()
+    except Exception:
+        pass
@@ -0,0 +1,371 @@
+import argparse
+import gzip
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+if __package__ in (None, ""):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules import config_cache
+from modules import connection_manager as conn
+
+# =========================================================
+# LLAMA SUPERVISOR – osobny proces nadzorujacy llama-server:
+# start, gotowosc przez /health, restart z backoffem po awarii,
+# rotacja i kompresja logu; stan (loading/ready/degraded)
+# w logs/llama_supervisor/<port>.json dla routera i agenta
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+STATE_DIR = BASE_DIR / "logs" / "llama_supervisor"
+LOG_DIR = BASE_DIR / "logs"
+DEFAULT_PORT = 11435
+DEFAULT_READY_TIMEOUT = 300
+DEFAULT_LOG_MAX_MB = 50
+LOG_KEEP = 5
+BACKOFF_START = 1.0
+BACKOFF_MAX = 60.0
+# Wiecej awarii w tym oknie = rezygnacja (stan "failed"), zeby nie mielic w petli.
+CRASH_WINDOW_SEC = 300
+CRASH_LIMIT = 5
+HEALTH_INTERVAL = 5.0
+HEALTH_FAILS_DEGRADED = 3
+
+SERVING_STATES = ("ready",)
+WAITING_STATES = ("starting", "loading", "degraded")
+# Jak dlugo router ufa ostatniemu "ready" bez ponownego czytania pliku stanu.
+SERVING_CACHE_SEC = 2.0
+
+# Nadzorcy uruchomieni z tego procesu (do zebrania statusu wyjscia, bez zombie).
+_PROCS = {}
+# Porty -> chwila (monotonic) ostatniego potwierdzenia "ready" w wait_until_serving.
+_SERVING = {}
+
+
+def _cfg_number(key, default):
+    try:
+        return float(config_cache.load().get(key, default))
+    except Exception:
+        return float(default)
+
+
+def log_path(port):
+    """Glowna instancja pisze do llama_server.log (czytanego przez statystyki), reszta puli osobno."""
+    port = int(port)
+    return LOG_DIR / ("llama_server.log" if port == DEFAULT_PORT else f"llama_server_{port}.log")
+
+
+def _state_path(port):
+    return STATE_DIR / f"{int(port)}.json"
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(int(pid), 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except Exception:
+        return False
+
+
+def _write_state(port, **fields):
+    path = _state_path(port)
+    try:
+        data = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+    except Exception:
+        data = {}
+    data.update(fields)
+    data["port"] = int(port)
+    data["updated_at"] = time.time()
+    try:
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+    except Exception:
+        pass
+    return data
+
+
+def state(port):
+    """Stan nadzorcy portu albo None (port bez nadzoru). Martwy proces nadzorcy = 'stopped'."""
+    path = _state_path(port)
+    if not path.exists():
+        return None
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+    if data.get("state") not in ("stopped", "failed") and not _pid_alive(data.get("pid")):
+        data["state"] = "stopped"
+    return data
+
+
+def states():
+    if not STATE_DIR.exists():
+        return {}
+    out = {}
+    for path in sorted(STATE_DIR.glob("*.json")):
+        try:
+            data = state(int(path.stem))
+        except ValueError:
+            continue
+        if data:
+            out[data["port"]] = data
+    return out
+
+
+# ---------- strona klienta (agent, router) ----------
+
+def spawn(args, port, env=None):
+    """Uruchamia nadzorce (odlaczony od terminala), ktory uruchamia llama-server z `args`."""
+    stop(port)
+    _state_path(port).unlink(missing_ok=True)
+    cmd = [sys.executable, "-m", "modules.llama_supervisor", "--port", str(port), "--"] + [str(a) for a in args]
+    proc = subprocess.Popen(
+        cmd,
+        cwd=str(BASE_DIR),
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        preexec_fn=os.setsid,
+    )
+    _PROCS[int(port)] = proc
+    _write_state(port, state="starting", pid=proc.pid, child_pid=None, restarts=0, started_at=time.time())
+    return proc
+
+
+def wait_ready(port, timeout=None):
+    """Czeka, az model zostanie zaladowany (/health = 200). Zwraca ostatni stan."""
+    timeout = timeout or _cfg_number("llama_ready_timeout_sec", DEFAULT_READY_TIMEOUT)
+    end = time.monotonic() + timeout
+    current = None
+    while time.monotonic() < end:
+        data = state(port)
+        current = data.get("state") if data else None
+        if current not in WAITING_STATES:
+            return current
+        time.sleep(0.5)
+    return current
+
+
+def wait_until_serving(timeout, ports):
+    """
+    Dla routera: gdy nadzorowany serwer na docelowym porcie (lub portach puli) laduje model
+    lub wstaje po awarii, zapytanie czeka (do `timeout`) zamiast konczyc sie bledem
+    polaczenia. True = mozna pytac. Wynik "mozna pytac" pamietany przez SERVING_CACHE_SEC.
+    """
+    key = tuple(sorted(int(p) for p in ports if p))
+    checked = _SERVING.get(key)
+    if checked is not None and time.monotonic() - checked < SERVING_CACHE_SEC:
+        return True, False
+    end = time.monotonic() + max(0.0, timeout or 0)
+    waited = False
+    while True:
+        current = [d.get("state") for d in (state(p) for p in key) if d]
+        # Port bez nadzoru (serwer uruchomiony recznie) – pytamy od razu.
+        if not current or any(s in SERVING_STATES for s in current):
+            _SERVING[key] = time.monotonic()
+            return True, waited
+        _SERVING.pop(key, None)
+        if not any(s in WAITING_STATES for s in current) or time.monotonic() >= end:
+            return False, waited
+        waited = True
+        time.sleep(0.5)
+
+
+def stop(port=None, timeout=15):
+    """Zatrzymuje nadzorce (i jego llama-server) dla portu lub wszystkich. Zwraca liczbe zatrzymanych."""
+    _SERVING.clear()
+    targets = [state(port)] if port is not None else list(states().values())
+    stopped = 0
+    for data in targets:
+        if not data or not _pid_alive(data.get("pid")):
+            continue
+        try:
+            os.kill(int(data["pid"]), signal.SIGTERM)
+        except Exception:
+            continue
+        own = _PROCS.pop(int(data["port"]), None)
+        end = time.monotonic() + timeout
+        while time.monotonic() < end and (own.poll() is None if own else _pid_alive(data["pid"])):
+            time.sleep(0.2)
+        if own.poll() is None if own else _pid_alive(data["pid"]):
+            try:
+                os.killpg(int(data["pid"]), signal.SIGKILL)
+            except Exception:
+                pass
+        _write_state(data["port"], state="stopped", child_pid=None)
+        stopped += 1
+    return stopped
+
+
+def format_status():
+    items = states()
+    if not items:
+        return "Nadzorca llama-server: brak nadzorowanych instancji."
+    lines = ["Nadzorca llama-server:"]
+    for port, data in sorted(items.items()):
+        up = ""
+        if data.get("ready_at") and data.get("state") == "ready":
+            up = f" | od {(time.time() - data['ready_at']) / 60:.0f} min"
+        exit_txt = f" | ostatnie wyjscie {data['last_exit']}" if data.get("last_exit") is not None else ""
+        lines.append(f"- :{port} {data.get('state')} | restarty {data.get('restarts', 0)}{up}{exit_txt} | "
+                     f"log {log_path(port).name}")
+    return "\n".join(lines)
+
+
+# ---------- proces nadzorcy ----------
+
+class _LogWriter:
+    """Przepisuje stdout llama-server do pliku, z rotacja (gzip) po przekroczeniu rozmiaru."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.max_bytes = int(_cfg_number("llama_log_max_mb", DEFAULT_LOG_MAX_MB) * 1024 * 1024)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.f = open(self.path, "ab")
+
+    def rotate(self):
+        self.f.close()
+        for i in range(LOG_KEEP - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}.gz")
+            if src.exists():
+                os.replace(src, self.path.with_name(f"{self.path.name}.{i + 1}.gz"))
+        try:
+            with open(self.path, "rb") as src, gzip.open(self.path.with_name(f"{self.path.name}.1.gz"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        except Exception:
+            pass
+        self.f = open(self.path, "wb")
+
+    def pump(self, stream):
+        for line in iter(stream.readline, b""):
+            with self.lock:
+                self.f.write(line)
+                self.f.flush()
+                if self.f.tell() > self.max_bytes:
+                    self.rotate()
+
+    def write(self, text):
+        with self.lock:
+            self.f.write(f"[supervisor {time.strftime('%Y-%m-%d %H:%M:%S')}] {text}\n".encode("utf-8"))
+            self.f.flush()
+
+
+def _health(base):
+    try:
+        r = conn.get("llama", "/health", base_url=base, timeout=2)
+        return r.status_code
+    except Exception:
+        return None
+
+
+def _terminate(proc, timeout=10):
+    if proc is None or proc.poll() is not None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def supervise(port, args):
+    base = f"http://127.0.0.1:{port}"
+    log = _LogWriter(log_path(port))
+    stopping = threading.Event()
+    holder = {"proc": None}
+
+    def _on_signal(signum, frame):
+        stopping.set()
+        _terminate(holder["proc"])
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    restarts = 0
+    crashes = []
+    backoff = BACKOFF_START
+    while not stopping.is_set():
+        log.write(f"start: {' '.join(args)}")
+        proc = holder["proc"] = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                                 stderr=subprocess.STDOUT)
+        pump = threading.Thread(target=log.pump, args=(proc.stdout,), daemon=True)
+        pump.start()
+        _write_state(port, state="loading" if restarts == 0 else "degraded", pid=os.getpid(),
+                     child_pid=proc.pid, restarts=restarts)
+        ready = False
+        current = None
+        fails = 0
+        while proc.poll() is None and not stopping.is_set():
+            code = _health(base)
+            if code == 200:
+                fails = 0
+                if not ready:
+                    ready = True
+                    backoff = BACKOFF_START
+                    log.write("gotowy (/health 200)")
+                    _write_state(port, ready_at=time.time())
+                if current != "ready":
+                    current = "ready"
+                    _write_state(port, state=current)
+            elif ready:
+                # 503 = serwer zajety/przeladowuje, brak odpowiedzi = zawieszony; po kilku probach "degraded".
+                fails += 1
+                if fails >= HEALTH_FAILS_DEGRADED and current != "degraded":
+                    current = "degraded"
+                    log.write(f"/health nie odpowiada ({code})")
+                    _write_state(port, state=current)
+            stopping.wait(HEALTH_INTERVAL if ready else 0.5)
+        if stopping.is_set():
+            _terminate(proc)
+            break
+        pump.join(timeout=2)
+        code = proc.returncode
+        now = time.time()
+        crashes = [t for t in crashes if now - t < CRASH_WINDOW_SEC] + [now]
+        log.write(f"llama-server zakonczony (kod {code}), awarie w oknie: {len(crashes)}")
+        if len(crashes) >= CRASH_LIMIT:
+            _write_state(port, state="failed", child_pid=None, last_exit=code)
+            log.write("za duzo awarii – rezygnuje")
+            return 1
+        restarts += 1
+        _write_state(port, state="degraded", child_pid=None, last_exit=code, restarts=restarts)
+        log.write(f"restart za {backoff:.0f}s")
+        if stopping.wait(backoff):
+            break
+        backoff = min(BACKOFF_MAX, backoff * 2)
+    _write_state(port, state="stopped", child_pid=None)
+    log.write("zatrzymany")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Nadzorca llama-server")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    opts = parser.parse_args(argv)
+    args = opts.args[1:] if opts.args[:1] == ["--"] else opts.args
+    if not args:
+        parser.error("brak polecenia llama-server")
+    return supervise(opts.port, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
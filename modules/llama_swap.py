@@ -0,0 +1,69 @@
+import time
+
+from modules import config_cache
+from modules import connection_manager as conn
+from modules import llama_pool
+
+# =========================================================
+# LLAMA SWAP – podmiana modelu bez przerwy (blue/green):
+# nowy model na drugim porcie, rozgrzanie, przepiecie
+# llama_port, wygaszenie starej instancji; gdy oba modele
+# nie mieszcza sie w VRAM – zwykle stop + start
+# =========================================================
+
+PRIMARY_PORT = 11435
+DEFAULT_SWAP_PORT = 11445
+DEFAULT_DRAIN_SEC = 30
+WARM_PROMPT = "Jestes Lyra, asystentka systemu Linux. Odpowiedz jednym slowem: gotowa?"
+
+
+def side_port(current_port):
+    """Port dla nowej instancji: naprzemiennie glowny i zapasowy (llama_swap_port)."""
+    try:
+        swap = int(config_cache.load().get("llama_swap_port", DEFAULT_SWAP_PORT))
+    except Exception:
+        swap = DEFAULT_SWAP_PORT
+    return swap if int(current_port) == PRIMARY_PORT else PRIMARY_PORT
+
+
+def warm(base, timeout=60):
+    """Krotki prefill + 1 token: pierwsze prawdziwe zapytanie nie placi za rozruch (graf, bufory)."""
+    try:
+        r = conn.post("llama", "/completion", base_url=base,
+                      json={"prompt": WARM_PROMPT, "n_predict": 1, "cache_prompt": True}, timeout=timeout)
+        return r.status_code == 200
+    except Exception:
+        return False
+
+
+def _busy_slots(base):
+    """Liczba slotow w trakcie generowania (None, gdy serwer nie udostepnia /slots)."""
+    try:
+        r = conn.get("llama", "/slots", base_url=base, timeout=2)
+        if r.status_code != 200:
+            return None
+        slots = r.json()
+    except Exception:
+        return None
+    if not isinstance(slots, list):
+        return None
+    # Nowsze wersje: is_processing; starsze: state 1 = przetwarzanie.
+    return sum(1 for s in slots if s.get("is_processing") or s.get("state") == 1)
+
+
+def drain(base, timeout=None):
+    """Czeka, az stara instancja dokonczy zapytania w toku. True = wygaszona przed limitem."""
+    try:
+        timeout = float(timeout or config_cache.load().get("llama_drain_sec", DEFAULT_DRAIN_SEC))
+    except Exception:
+        timeout = DEFAULT_DRAIN_SEC
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        busy = _busy_slots(base)
+        if llama_pool.outstanding(base) == 0 and not busy:
+            if busy is None:
+                # Bez /slots nie widac zapytan innych procesow – krotki margines.
+                time.sleep(min(2.0, max(0.0, end - time.monotonic())))
+            return True
+        time.sleep(0.5)
+    return False
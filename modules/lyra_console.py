@@ -10,9 +10,11 @@ from datetime import datetime
 import shlex
 from pathlib import Path
 
-from modules.model_router import query_model
+from modules.model_router import query_model, query_model_stream, _get_local_backend
+from modules import connection_manager as conn
+from modules.token_budget import build_context
 from modules.file_edit_tools import handle_file_command
-from modules.memory_commands import handle_memory_command, build_memory_context
+from modules.memory_commands import handle_memory_command, memory_items
 from modules.model_switcher import get_active_local_model_name
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -303,7 +305,7 @@ def _windows_to_linux(cmd):
     return cmd
 
 
-def _ask_lyra(prompt):
+def _ask_lyra(prompt, on_token=None):
     local_model = get_active_local_model_name() or "mistral"
     system_hint = (
         "Odpowiadaj po polsku. "
@@ -311,17 +313,49 @@ def _ask_lyra(prompt):
         "bez żadnego dodatkowego tekstu, bez bloków kodu i bez odmów. "
         "Komendy mają być dla Linux bash."
     )
-    mem_ctx = build_memory_context()
-    if mem_ctx:
-        full_prompt = f"{system_hint}\n\nPAMIEC LYRY:\n{mem_ctx}\n\nUżytkownik: {prompt}"
-    else:
-        full_prompt = f"{system_hint}\n\nUżytkownik: {prompt}"
+    long_items, recent_items = memory_items()
+    assembled = build_context(
+        prompt,
+        model=local_model,
+        question_label="Użytkownik: ",
+        system=system_hint,
+        memory_items=long_items,
+        recent_items=recent_items,
+    )
+    full_prompt = assembled["prompt"]
     allow_cloud = _get_cloud_consent() == "always"
-    response, _ = query_model(full_prompt, local_model, "gpt-5.1", config={"timeout": 60, "allow_cloud": allow_cloud}, history=[])
+    cfg = {"timeout": 60, "allow_cloud": allow_cloud, "session": "console", "prefix_hash": assembled["prefix_hash"]}
+    if on_token:
+        response, source = query_model_stream(full_prompt, local_model, "gpt-5.1", config=cfg, history=[], on_token=on_token)
+        if source == "cancelled":
+            response = "[Lyra] Przerwano generowanie."
+    else:
+        response, _ = query_model(full_prompt, local_model, "gpt-5.1", config=cfg, history=[])
     if os.environ.get("LYRA_CLOUD_ONCE") == "1":
         os.environ.pop("LYRA_CLOUD_ONCE", None)
     return response or ""
 
+def _ask_lyra_live(stdscr, log_lines, cwd, state, prompt, width):
+    """Wyswietla odpowiedz Lyry na biezaco, w miare naplywu tokenow."""
+    start = len(log_lines)
+    buf = []
+    last_draw = [0.0]
+
+    def _on_token(token):
+        buf.append(token)
+        now = time.time()
+        if now - last_draw[0] < 0.05:
+            return
+        last_draw[0] = now
+        del log_lines[start:]
+        _append_log(log_lines, "".join(buf), width)
+        _render(stdscr, log_lines, cwd, "", cursor_pos=0, scroll_offset=state.get("scroll", 0))
+
+    response = _ask_lyra(prompt, on_token=_on_token)
+    del log_lines[start:]
+    _append_log(log_lines, response, width)
+    return response
+
 def _looks_like_nl(cmd):
     if not cmd or cmd.startswith(":"):
         return False
@@ -580,6 +614,7 @@ def start_console():
                 history = []
         state = {"scroll": 0}
         cwd = os.getcwd()
+        conn.warm(_get_local_backend())
         h, w = stdscr.getmaxyx()
         _append_log(log_lines, "Lyra Console: :help, :lyra <pytanie>, exit", w - 1)
         while True:
@@ -679,8 +714,7 @@ def start_console():
                 prompt = cmd.split(" ", 1)[1]
                 _append_log(log_lines, "[Lyra] generuję odpowiedź...", w - 1)
                 _render(stdscr, log_lines, cwd, "", cursor_pos=0, scroll_offset=state.get("scroll", 0))
-                response = _ask_lyra(prompt)
-                _append_log(log_lines, response, w - 1)
+                response = _ask_lyra_live(stdscr, log_lines, cwd, state, prompt, w - 1)
                 cmds = _extract_cmds(response)
                 if not cmds:
                     cmds = _extract_codeblock_cmds(response)
@@ -750,8 +784,7 @@ def start_console():
                 prompt = cmd
                 _append_log(log_lines, "[Lyra] generuję odpowiedź...", w - 1)
                 _render(stdscr, log_lines, cwd, "", cursor_pos=0, scroll_offset=state.get("scroll", 0))
-                response = _ask_lyra(prompt)
-                _append_log(log_lines, response, w - 1)
+                response = _ask_lyra_live(stdscr, log_lines, cwd, state, prompt, w - 1)
                 cmds = _extract_cmds(response)
                 if not cmds:
                     cmds = _extract_codeblock_cmds(response)
@@ -77,23 +77,31 @@ def record_context_line(text: str):
         pass
 
 
-def build_memory_context(max_chars: int = 8000):
+def memory_items(include_long: bool = True, include_recent: bool = True, long_limit: int = 200, recent_limit: int = 30):
+    """Zwraca (fakty_dlugie, wpisy_biezace) jako listy linii – budzet tokenow wybiera z nich."""
     if not LyraMemory:
-        return ""
+        return [], []
     try:
         dluga = LyraMemory.odczytaj("dluga") or {}
         biezaca = LyraMemory.odczytaj("biezaca") or []
     except Exception:
-        return ""
+        return [], []
+    long_items = []
+    recent_items = []
+    if include_long and isinstance(dluga, dict) and dluga:
+        long_items = [f"- {k}: {v}" for k, v in list(dluga.items())[:long_limit]]
+    if include_recent and isinstance(biezaca, list) and biezaca:
+        recent_items = [f"- {x.get('data','')}: {x.get('zdarzenie','')}" for x in biezaca[-recent_limit:]]
+    return long_items, recent_items
+
+
+def build_memory_context(max_chars: int = 8000, include_long: bool = True, include_recent: bool = True):
+    long_items, recent_items = memory_items(include_long, include_recent, long_limit=20, recent_limit=5)
     parts = []
-    if isinstance(dluga, dict) and dluga:
-        items = list(dluga.items())[:20]
-        chunk = "\n".join([f"- {k}: {v}" for k, v in items])
-        parts.append("Pamiec_dluga:\n" + chunk)
-    if isinstance(biezaca, list) and biezaca:
-        recent = biezaca[-5:]
-        chunk = "\n".join([f"- {x.get('data','')}: {x.get('zdarzenie','')}" for x in recent])
-        parts.append("Pamiec_biezaca:\n" + chunk)
+    if long_items:
+        parts.append("Pamiec_dluga:\n" + "\n".join(long_items))
+    if recent_items:
+        parts.append("Pamiec_biezaca:\n" + "\n".join(recent_items))
     text = "\n\n".join(parts).strip()
     if len(text) > max_chars:
         return text[:max_chars] + "\n...[OBIĘTE]..."
@@ -1,4 +1,5 @@
 import json
+from modules import gguf_index
 from modules.model_paths import get_models_path, get_models_dir
 
 MAP_FILE = get_models_path()
@@ -28,12 +29,17 @@ def tool_MODEL_LIST(arg, system, log):
 
     msg = "📦 Dostępne modele lokalne:\n\n"
 
+    # Shardy jednego modelu jako jedna pozycja; opis z naglowka GGUF (cache w logs/gguf_index.json).
+    available = gguf_index.collapse(available)
+
     # Sortuj alfabetycznie — czytelniej
     for name in sorted(available.keys(), key=lambda s: s.lower()):
         path = available[name]
         flag = " (AKTYWNY)" if name == active else ""
         msg += f" • {name}{flag}\n"
         msg += f"    ↳ {path}\n"
+        if str(path).endswith(".gguf"):
+            msg += f"    ↳ {gguf_index.describe(gguf_index.model_info(path))}\n"
 
     msg += "\nUżyj: lyra użyj <model>\n"
     msg += "Przykład: lyra użyj hernes\n"
@@ -23,35 +23,60 @@ def process_with_failover(user_prompt):
         response = call_online_api(cloud_model, user_prompt)
         return response, "CLOUD"
 
-def choose_best_model(prompt: str):
-    """
-    Zwraca tuple:
-       (local_model_name, cloud_model_name)
+# Klasa zadania -> (lokalne modele od najlepszego, model w chmurze).
+# Kolejne pozycje to akceptowalne zamienniki (rezydencja VRAM, SLO opoznien).
+TASK_MODELS = {
+    "image": (["llava-v1.5-7b-Q4_0"], "gpt-4o"),
+    "code": (["qwen2.5-coder-3b-instruct-q4_0", "qwen2.5-coder-14b-instruct-q3_k_m", "mistral"], "gpt-5.1"),
+    "reasoning": (["deepseek-r1-distill-qwen-7b-q4_k_m", "deepseek-r1-distill-llama-8b-q4_k_m"], "gpt-5.1"),
+    "polish": (["hermes-3-llama-3.2-3b.q4_k_m", "gemma-2-2b-it-q4_k_m", "mistral"], "gpt-5.1"),
+    "general": (["gemma-2-2b-it-q4_k_m", "hermes-3-llama-3.2-3b.q4_k_m", "mistral"], "gpt-5.1"),
+}
 
-    agent.py zakłada, że ta funkcja MA DOKŁADNIE 1 argument!
-    """
 
-    p = prompt.lower()
+def task_class(prompt: str):
+    """Klasa zadania wg slow kluczowych: image | code | reasoning | polish | general."""
 
-    # ===========================
-    # Modele specjalistyczne
-    # ===========================
+    p = prompt.lower()
 
     # analiza zdjęć
     if "zdjęcie" in p or "obraz" in p or "foto" in p:
-        return "llava-v1.5-7b-Q4_0", "gpt-4o"
+        return "image"
 
     # kod / programowanie
     if "kod" in p or "python" in p or "program" in p or "skrypt" in p:
-        return "qwen2.5-coder-3b-instruct-q4_0", "gpt-5.1"
+        return "code"
 
     # reasoning / trudna logika
     if "wyjaśnij" in p or "logicznie" in p or "rozumowanie" in p or "analiza" in p:
-        return "deepseek-r1-distill-qwen-7b-q4_k_m", "gpt-5.1"
+        return "reasoning"
 
     # ogólny polski model (szybki)
     if any(pol in p for pol in ["napisz", "polski", "tłumacz", "wyjaśnij mi"]):
-        return "hermes-3-llama-3.2-3b.q4_k_m", "gpt-5.1"
+        return "polish"
 
     # domyślny fallback
-    return "gemma-2-2b-it-q4_k_m", "gpt-5.1"
+    return "general"
+
+
+def candidate_models(prompt: str):
+    """
+    Zwraca tuple:
+       ([lokalne_modele_od_najlepszego], cloud_model_name)
+
+    Kolejne pozycje listy to akceptowalne zamienniki – menedzer rezydencji
+    wybiera je, gdy sa juz w VRAM, zamiast przeladowywac preferowany model.
+    """
+    local_models, cloud_model = TASK_MODELS[task_class(prompt)]
+    return list(local_models), cloud_model
+
+
+def choose_best_model(prompt: str):
+    """
+    Zwraca tuple:
+       (local_model_name, cloud_model_name)
+
+    agent.py zakłada, że ta funkcja MA DOKŁADNIE 1 argument!
+    """
+    local_models, cloud_model = candidate_models(prompt)
+    return local_models[0], cloud_model
@@ -0,0 +1,253 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from modules import config_cache
+from modules import connection_manager as conn
+from modules import gguf_index
+from modules.model_paths import load_models
+
+# =========================================================
+# MODEL RESIDENCY – ktore modele Ollama trzymac w VRAM:
+# LRU w granicach pamieci obu kart, keep_alive, wstepne
+# ladowanie przewidywanego modelu i preferencja rezydentow
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+STATE_PATH = BASE_DIR / "logs" / "model_residency.json"
+DEFAULT_KEEP_ALIVE = "30m"
+DEFAULT_RESERVE_MB = 1024
+# Narzut KV cache/buforow ponad rozmiar pliku, gdy nie znamy zmierzonego rozmiaru.
+FOOTPRINT_OVERHEAD = 1.2
+# /api/ps przed kazdym zapytaniem to zbedna runda – wynik wazny przez PS_TTL sekund.
+PS_TTL = 5.0
+# Zapis stanu LRU najwyzej co tyle sekund (zmiana przejsc miedzy modelami – od razu).
+SAVE_INTERVAL = 30.0
+
+_LOCK = threading.Lock()
+_STATE = None
+_PS = {"at": 0.0, "models": None}
+_LAST_SAVE = 0.0
+
+
+def enabled():
+    return str(config_cache.load().get("model_residency", "on")).lower() in ["on", "true", "1", "yes", "tak"]
+
+
+def keep_alive():
+    """Wartosc keep_alive dla zapytan do Ollama (config ollama_keep_alive)."""
+    return config_cache.load().get("ollama_keep_alive", DEFAULT_KEEP_ALIVE)
+
+
+def _norm(name):
+    name = str(name or "").strip().lower()
+    return name if ":" in name else f"{name}:latest"
+
+
+def _state():
+    global _STATE
+    if _STATE is None:
+        try:
+            _STATE = json.loads(STATE_PATH.read_text(encoding="utf-8")) if STATE_PATH.exists() else {}
+        except Exception:
+            _STATE = {}
+        _STATE.setdefault("footprint_mb", {})
+        _STATE.setdefault("last_used", {})
+        _STATE.setdefault("transitions", {})
+        _STATE.setdefault("last_model", None)
+    return _STATE
+
+
+def _save():
+    global _LAST_SAVE
+    _LAST_SAVE = time.time()
+    try:
+        STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        STATE_PATH.write_text(json.dumps(_state(), ensure_ascii=False, indent=2), encoding="utf-8")
+    except Exception:
+        pass
+
+
+def vram_capacity_mb():
+    """Suma VRAM kart (sysfs amdgpu) minus rezerwa vram_reserve_mb."""
+    total = 0
+    try:
+        for card in sorted(os.listdir("/sys/class/drm/")):
+            path = f"/sys/class/drm/{card}/device/mem_info_vram_total"
+            if card.startswith("card") and len(card) == 5 and os.path.exists(path):
+                with open(path, "r") as f:
+                    total += int(f.read().strip()) // (1024 ** 2)
+    except Exception:
+        pass
+    try:
+        reserve = int(config_cache.load().get("vram_reserve_mb", DEFAULT_RESERVE_MB))
+    except Exception:
+        reserve = DEFAULT_RESERVE_MB
+    return max(0, total - reserve)
+
+
+def resident_models(timeout=2, max_age=0):
+    """{model: vram_mb} zaladowanych w Ollama (/api/ps); max_age > 0 – wynik z pamieci, jesli swiezy."""
+    with _LOCK:
+        if max_age and _PS["models"] is not None and time.time() - _PS["at"] < max_age:
+            return dict(_PS["models"])
+    try:
+        r = conn.get("ollama", "/api/ps", timeout=timeout)
+        if r.status_code != 200:
+            return {}
+        items = r.json().get("models") or []
+    except Exception:
+        return {}
+    out = {}
+    with _LOCK:
+        footprints = _state()["footprint_mb"]
+        for item in items:
+            name = _norm(item.get("name") or item.get("model"))
+            size = item.get("size_vram") or item.get("size") or 0
+            out[name] = size // (1024 ** 2)
+            if out[name]:
+                footprints[name] = out[name]
+        _PS.update({"at": time.time(), "models": dict(out)})
+    return out
+
+
+def _forget_ps():
+    with _LOCK:
+        _PS["models"] = None
+
+
+def footprint_mb(model):
+    """Zmierzony rozmiar w VRAM, a bez pomiaru – rozmiar GGUF (wszystkie shardy) + narzut."""
+    name = _norm(model)
+    known = _state()["footprint_mb"].get(name)
+    if known:
+        return known
+    available = gguf_index.collapse(load_models().get("available", {}))
+    path = available.get(str(model)) or available.get(str(model).lower())
+    size = gguf_index.total_bytes(path) if path else None
+    if size:
+        return int(size / (1024 ** 2) * FOOTPRINT_OVERHEAD)
+    return None
+
+
+def _unload(model):
+    try:
+        conn.post("ollama", "/api/generate", json={"model": model, "keep_alive": 0}, timeout=10)
+        return True
+    except Exception:
+        return False
+
+
+def _evictions_needed(model, resident, capacity):
+    """Lista modeli LRU do zwolnienia, zeby `model` zmiescil sie w VRAM."""
+    need = footprint_mb(model) or 0
+    used = sum(resident.values())
+    if not need or used + need <= capacity:
+        return []
+    last_used = _state()["last_used"]
+    victims = []
+    for name in sorted(resident, key=lambda n: last_used.get(n, 0)):
+        if name == _norm(model):
+            continue
+        victims.append(name)
+        used -= resident[name]
+        if used + need <= capacity:
+            break
+    return victims
+
+
+def route(preferred, alternatives=None):
+    """
+    Wybiera model do zapytania: preferowany, chyba ze wymagalby eksmisji,
+    a inny akceptowalny model juz jest w VRAM – wtedy ten tanszy rezydent.
+    """
+    if not enabled():
+        return preferred
+    resident = resident_models(max_age=PS_TTL)
+    if not resident or _norm(preferred) in resident:
+        return preferred
+    if not _evictions_needed(preferred, resident, vram_capacity_mb()):
+        return preferred
+    for alt in alternatives or []:
+        if _norm(alt) in resident:
+            return alt
+    return preferred
+
+
+def ensure_loaded(model):
+    """Przed zapytaniem: zwalnia najdawniej uzywane modele, jesli nowy sie nie zmiesci."""
+    if not enabled():
+        return []
+    resident = resident_models(max_age=PS_TTL)
+    if _norm(model) in resident:
+        return []
+    victims = _evictions_needed(model, resident, vram_capacity_mb())
+    for name in victims:
+        _unload(name)
+    # Model zaraz sie laduje – wpis w pamieci zamiast kolejnego /api/ps przy nastepnym zapytaniu.
+    with _LOCK:
+        if _PS["models"] is not None:
+            for name in victims:
+                _PS["models"].pop(name, None)
+            _PS["models"][_norm(model)] = footprint_mb(model) or 0
+    return victims
+
+
+def touch(model):
+    """Rejestruje uzycie modelu (LRU) i przejscie poprzedni -> biezacy (predykcja)."""
+    name = _norm(model)
+    with _LOCK:
+        state = _state()
+        prev = state.get("last_model")
+        state["last_used"][name] = time.time()
+        switched = prev != name
+        if prev and switched:
+            row = state["transitions"].setdefault(prev, {})
+            row[name] = row.get(name, 0) + 1
+        state["last_model"] = name
+        if switched or time.time() - _LAST_SAVE >= SAVE_INTERVAL:
+            _save()
+
+
+def predict_next(model):
+    row = _state()["transitions"].get(_norm(model)) or {}
+    if not row:
+        return None
+    return max(row, key=row.get)
+
+
+def preload_next(model):
+    """W tle laduje najbardziej prawdopodobny nastepny model, jesli zmiesci sie bez eksmisji."""
+    if not enabled():
+        return None
+    nxt = predict_next(model)
+    if not nxt:
+        return None
+
+    def _load():
+        resident = resident_models()
+        if nxt in resident or _evictions_needed(nxt, resident, vram_capacity_mb()):
+            return
+        try:
+            conn.post("ollama", "/api/generate", json={"model": nxt, "keep_alive": keep_alive()}, timeout=120)
+        except Exception:
+            pass
+        _forget_ps()
+
+    threading.Thread(target=_load, daemon=True).start()
+    return nxt
+
+
+def format_status():
+    resident = resident_models()
+    capacity = vram_capacity_mb()
+    used = sum(resident.values())
+    lines = [f"Rezydencja modeli (Ollama): {used}/{capacity} MB, keep_alive {keep_alive()}"]
+    last_used = _state()["last_used"]
+    for name in sorted(resident, key=lambda n: -last_used.get(n, 0)):
+        lines.append(f"- {name}: {resident[name]} MB")
+    if not resident:
+        lines.append("- brak zaladowanych modeli")
+    return "\n".join(lines)
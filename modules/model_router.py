@@ -2,44 +2,63 @@ import os
 # Importujemy funkcję przeszukiwania pamięci z Twojego modułu pamięci
 from modules.memory_ai import search_memory 
 import socket
-import requests
 import json
+import queue
+import threading
+import time
 from pathlib import Path
-try:
-    import openai
-except Exception:
-    openai = None
-
+from modules import cloud_client
+from modules import config_cache
+from modules import connection_manager as conn
+from modules import deadline as deadline_mod
+from modules import draft_models
+from modules import llama_pool
+from modules import latency_router
+from modules import llama_probe
+from modules import llama_supervisor
+from modules import model_residency
+from modules import perf_store
+from modules import request_scheduler
+from modules import response_cache
+from modules import single_flight
+from modules import slot_store
+from modules import structured_output
+from modules.structured_output import StructuredOutputError
+from modules.prompt_builder import session_slot
 CONFIG_PATH = Path.home() / "lyra_agent" / "config.json"
 LAST_STATS = None
 
-def _load_config():
-    try:
-        return json.loads(CONFIG_PATH.read_text(encoding="utf-8"))
-    except Exception:
-        return {}
-
 def _get_local_backend():
-    cfg = _load_config()
+    cfg = config_cache.load(CONFIG_PATH)
     value = (cfg.get("local_backend") or os.environ.get("LYRA_BACKEND") or "ollama").lower()
     if value.startswith("llama"):
         return "llama"
     return value
 
 def _get_cloud_model():
-    cfg = _load_config()
+    cfg = config_cache.load(CONFIG_PATH)
     return cfg.get("default_cloud_model") or "gpt-5.1"
 
 def _cloud_consent_state():
-    cfg = _load_config()
+    cfg = config_cache.load(CONFIG_PATH)
     return (cfg.get("cloud_consent") or "ask").lower()
 
 def get_last_stats():
     return LAST_STATS
 
+def _publish_stats(stats, model=None, path="local"):
+    """Ustawia LAST_STATS, dopisuje pomiar do historii opoznien i do magazynu perf."""
+    global LAST_STATS
+    LAST_STATS = stats
+    try:
+        latency_router.record(model, stats)
+    except Exception:
+        pass
+    perf_store.record(stats, model=model, backend=(stats or {}).get("backend"), path=path)
+
 def _ollama_detected(timeout=2):
     try:
-        r = requests.get("http://127.0.0.1:11434/api/tags", timeout=timeout)
+        r = conn.get("ollama", "/api/tags", timeout=timeout)
         if r.status_code != 200:
             return False
         data = r.json()
@@ -47,31 +66,106 @@ def _ollama_detected(timeout=2):
     except Exception:
         return False
 
-def query_ollama(prompt, model="mistral", timeout=90):
-    url = "http://127.0.0.1:11434/api/generate"
+def _ollama_stats(data):
+    prompt_n = data.get("prompt_eval_count") or 0
+    prompt_ns = data.get("prompt_eval_duration") or 0
+    gen_n = data.get("eval_count") or 0
+    gen_ns = data.get("eval_duration") or 0
+    prompt_tps = (prompt_n / (prompt_ns / 1e9)) if prompt_ns else None
+    gen_tps = (gen_n / (gen_ns / 1e9)) if gen_ns else None
+    stats = {
+        "prompt_tps": prompt_tps,
+        "gen_tps": gen_tps,
+        "backend": "ollama",
+        "prompt_tokens": prompt_n or None,
+        "gen_tokens": gen_n or None,
+    }
+    if data.get("total_duration"):
+        stats["wall_s"] = data["total_duration"] / 1e9
+    return stats
+
+def _llama_stats(data):
+    timings = data.get("timings") or {}
+    prompt_tps = timings.get("prompt_per_second")
+    gen_tps = timings.get("predicted_per_second")
+    if prompt_tps is None or gen_tps is None:
+        prompt_n = timings.get("prompt_n") or 0
+        prompt_ms = timings.get("prompt_ms") or 0
+        gen_n = timings.get("predicted_n") or 0
+        gen_ms = timings.get("predicted_ms") or 0
+        prompt_tps = (prompt_n / (prompt_ms / 1000.0)) if prompt_ms else None
+        gen_tps = (gen_n / (gen_ms / 1000.0)) if gen_ms else None
+    stats = {
+        "prompt_tps": prompt_tps,
+        "gen_tps": gen_tps,
+        "backend": "llama",
+        "prompt_tokens": timings.get("prompt_n"),
+        "gen_tokens": timings.get("predicted_n"),
+    }
+    if timings.get("prompt_ms") is not None and timings.get("predicted_ms") is not None:
+        stats["wall_s"] = (timings["prompt_ms"] + timings["predicted_ms"]) / 1000.0
+    acceptance = draft_models.acceptance_rate(timings)
+    if acceptance is not None:
+        stats["draft_acceptance"] = acceptance
+    # Ile tokenow promptu llama-server wzial z KV cache (cache_prompt).
+    cached_n = timings.get("cache_n")
+    if cached_n is None:
+        cached_n = data.get("tokens_cached")
+    if cached_n is not None:
+        stats["cached_tokens"] = cached_n
+        stats["prompt_tokens"] = (timings.get("prompt_n") or 0) + (timings.get("cache_n") or 0) or data.get("tokens_evaluated")
+    return stats
+
+def _llama_result_stats(caps, data, wall_s, ttft=None):
+    """
+    Statystyki w kazdym dialekcie: timings llama-server (/completion, nowsze wersje OAI)
+    albo `usage` OAI (prompt_tokens/completion_tokens) + zmierzony czas.
+    """
+    if caps.get("dialect") == "completion" or data.get("timings"):
+        stats = _llama_stats(data)
+    else:
+        usage = data.get("usage") or {}
+        prompt_n = usage.get("prompt_tokens")
+        gen_n = usage.get("completion_tokens")
+        # Bez TTFT (odpowiedz w calosci) czas generowania = caly czas zapytania.
+        gen_s = wall_s - (ttft or 0)
+        stats = {
+            "prompt_tps": (prompt_n / ttft) if prompt_n and ttft else None,
+            "gen_tps": (gen_n / gen_s) if gen_n and gen_s > 0 else None,
+            "backend": "llama",
+            "prompt_tokens": prompt_n,
+            "gen_tokens": gen_n,
+        }
+        cached_n = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached_n is not None:
+            stats["cached_tokens"] = cached_n
+    stats.setdefault("wall_s", wall_s)
+    if ttft is not None:
+        stats["ttft"] = ttft
+    return stats
+
+def query_ollama(prompt, model="mistral", timeout=90, constraint=None):
     payload = {
         "model": model,
         "prompt": prompt,
-        "stream": False
+        "stream": False,
+        "keep_alive": model_residency.keep_alive(),
     }
+    try:
+        payload.update(structured_output.ollama_fields(constraint))
+    except StructuredOutputError as e:
+        # Tekst bledu -> _structured_result: komunikat albo chmura z gramatyka w poleceniu.
+        return f"Błąd Ollama: {e}"
+    # Zwalniamy najdawniej uzywane modele, zanim Ollama zacznie ladowac nowy.
+    model_residency.ensure_loaded(model)
+    model_residency.touch(model)
     try:
         # Zwiększamy timeout do 30 sekund, bo Mistral może potrzebować chwili na start
-        response = requests.post(url, json=payload, timeout=timeout)
+        response = conn.post("ollama", "/api/generate", json=payload, timeout=timeout)
         if response.status_code == 200:
             data = response.json()
             try:
-                prompt_n = data.get("prompt_eval_count") or 0
-                prompt_ns = data.get("prompt_eval_duration") or 0
-                gen_n = data.get("eval_count") or 0
-                gen_ns = data.get("eval_duration") or 0
-                prompt_tps = (prompt_n / (prompt_ns / 1e9)) if prompt_ns else None
-                gen_tps = (gen_n / (gen_ns / 1e9)) if gen_ns else None
-                global LAST_STATS
-                LAST_STATS = {
-                    "prompt_tps": prompt_tps,
-                    "gen_tps": gen_tps,
-                    "backend": "ollama"
-                }
+                _publish_stats(_ollama_stats(data), model)
             except Exception:
                 pass
             return data.get("response", "Błąd: Brak pola response")
@@ -79,63 +173,222 @@ def query_ollama(prompt, model="mistral", timeout=90):
     except Exception as e:
         return f"Błąd połączenia z Ollama: {str(e)}"
 
-def query_llama_server(prompt, model=None, timeout=90):
-    try:
-        # Try llama.cpp /completion
-        url = "http://127.0.0.1:11434/completion"
+def _llama_payload(caps, prompt, stream=False, session=None, constraint=None):
+    dialect = caps.get("dialect")
+    if dialect == "chat":
+        path = "/v1/chat/completions"
+        payload = {"model": caps.get("model") or "", "messages": [{"role": "user", "content": prompt}]}
+    elif dialect == "completions":
+        path = "/v1/completions"
+        payload = {"model": caps.get("model") or "", "prompt": prompt}
+    else:
+        path = "/completion"
         payload = {"prompt": prompt, "n_predict": 256, "temperature": 0.7, "timings": True}
-        response = requests.post(url, json=payload, timeout=timeout)
-        if response.status_code == 200:
-            data = response.json()
-            try:
-                timings = data.get("timings") or {}
-                prompt_tps = timings.get("prompt_per_second")
-                gen_tps = timings.get("predicted_per_second")
-                if prompt_tps is None or gen_tps is None:
-                    prompt_n = timings.get("prompt_n") or 0
-                    prompt_ms = timings.get("prompt_ms") or 0
-                    gen_n = timings.get("predicted_n") or 0
-                    gen_ms = timings.get("predicted_ms") or 0
-                    prompt_tps = (prompt_n / (prompt_ms / 1000.0)) if prompt_ms else None
-                    gen_tps = (gen_n / (gen_ms / 1000.0)) if gen_ms else None
-                global LAST_STATS
-                LAST_STATS = {"prompt_tps": prompt_tps, "gen_tps": gen_tps, "backend": "llama"}
-            except Exception:
-                pass
-            text = data.get("content") or data.get("response") or ""
-            if text:
-                return text
-
-        # Try OpenAI-compatible /v1/chat/completions
-        url = "http://127.0.0.1:11434/v1/chat/completions"
-        payload = {"model": "", "messages": [{"role": "user", "content": prompt}]}
-        response = requests.post(url, json=payload, timeout=timeout)
-        if response.status_code == 200:
-            data = response.json()
-            choices = data.get("choices") or []
-            if choices and isinstance(choices, list):
-                msg = choices[0].get("message") or {}
-                text = msg.get("content") or ""
-                if text:
-                    return text
-
-        # Try OpenAI-compatible /v1/completions
-        url = "http://127.0.0.1:11434/v1/completions"
-        payload = {"model": "", "prompt": prompt}
-        response = requests.post(url, json=payload, timeout=timeout)
+    payload["cache_prompt"] = True
+    payload.update(structured_output.llama_fields(constraint, dialect))
+    slot = session_slot(session, caps.get("slots") or 1)
+    if slot is not None:
+        payload["id_slot"] = slot
+    if stream:
+        payload["stream"] = True
+        if dialect in ("chat", "completions"):
+            # Ostatni fragment strumienia OAI niesie `usage` (tokeny promptu i odpowiedzi).
+            payload["stream_options"] = {"include_usage": True}
+    return path, payload
+
+def _llama_text(caps, data):
+    if caps.get("dialect") == "completion":
+        return data.get("content") or data.get("response") or ""
+    choices = data.get("choices") or []
+    if choices and isinstance(choices, list):
+        msg = choices[0].get("message") or {}
+        return msg.get("content") or choices[0].get("text") or ""
+    return ""
+
+def _llama_request(caps, prompt, timeout, session=None, constraint=None, prefix_hash=None):
+    path, payload = _llama_payload(caps, prompt, session=session, constraint=constraint)
+    # Przy puli instancji (jedna na GPU): sesja na swojej instancji, reszta do najmniej obciazonej.
+    with llama_pool.lease(caps["base"], session) as base:
+        slot_store.before_turn(base, caps, session, prefix_hash)
+        start = time.time()
+        response = conn.post("llama", path, base_url=base, json=payload, timeout=timeout)
+        wall_s = time.time() - start
         if response.status_code == 200:
-            data = response.json()
-            choices = data.get("choices") or []
-            if choices and isinstance(choices, list):
-                text = choices[0].get("text") or ""
-                if text:
-                    return text
+            slot_store.after_turn(base, caps, session, prefix_hash)
+    if response.status_code != 200:
+        return None, f"Błąd llama-server: Status {response.status_code}"
+    data = response.json()
+    try:
+        _publish_stats(_llama_result_stats(caps, data, wall_s), caps.get("model"))
+    except Exception:
+        pass
+    return _llama_text(caps, data), None
+
+def _await_llama(timeout):
+    """
+    Nadzorowany llama-server laduje model albo wstaje po awarii – zapytanie czeka
+    w kolejce (do timeout) zamiast konczyc sie bledem polaczenia. Zwraca pozostaly timeout.
+    """
+    start = time.monotonic()
+    # Tylko porty, do ktorych pojdzie zapytanie (instancje puli albo wykryty serwer).
+    ports = [i.get("port") for i in llama_pool.instances()] or [llama_probe.target_port()]
+    _, waited = llama_supervisor.wait_until_serving(timeout, ports)
+    if waited:
+        # Po (re)starcie port/model/sloty moga byc inne.
+        llama_probe.invalidate()
+    return max(1.0, timeout - (time.monotonic() - start))
 
+def query_llama_server(prompt, model=None, timeout=90, session=None, constraint=None, prefix_hash=None):
+    timeout = _await_llama(timeout)
+    caps = llama_probe.get_capabilities()
+    if not caps:
         if _ollama_detected():
             return "Błąd llama-server: ollama detected"
-        return "Błąd llama-server: Status 404"
+        return "Błąd połączenia z llama-server: serwer nie wykryty"
+    try:
+        text, error = _llama_request(caps, prompt, timeout, session=session, constraint=constraint,
+                                     prefix_hash=prefix_hash)
     except Exception as e:
-        return f"Błąd połączenia z llama-server: {str(e)}"
+        text, error = None, f"Błąd połączenia z llama-server: {str(e)}"
+    if error:
+        # Serwer mogl zostac zrestartowany na innym porcie/modelu – jedno ponowne wykrycie.
+        fresh = llama_probe.probe(force=True)
+        if not fresh or fresh == caps:
+            return error
+        try:
+            text, error = _llama_request(fresh, prompt, timeout, session=session, constraint=constraint,
+                                         prefix_hash=prefix_hash)
+        except Exception as e:
+            return f"Błąd połączenia z llama-server: {str(e)}"
+        if error:
+            return error
+    return text or "Błąd llama-server: pusta odpowiedz"
+
+class StreamCancelled(Exception):
+    """Generowanie przerwane (Ctrl-C lub anulowanie) – polaczenie zamkniete."""
+
+
+def _iter_stream(response, parse_line, cancel_event=None):
+    """Czyta strumien linia po linii; zamkniecie odpowiedzi przerywa generowanie na serwerze."""
+    try:
+        for raw in response.iter_lines(decode_unicode=True):
+            if cancel_event is not None and cancel_event.is_set():
+                raise StreamCancelled()
+            if not raw:
+                continue
+            item = parse_line(raw)
+            if item is None:
+                continue
+            yield item
+    finally:
+        response.close()
+
+
+def stream_ollama(prompt, model="mistral", timeout=90, cancel_event=None, session=None, constraint=None,
+                  prefix_hash=None):
+    """Generator tokenow z Ollama (NDJSON). Statystyki + TTFT trafiaja do LAST_STATS."""
+    payload = {"model": model, "prompt": prompt, "stream": True, "keep_alive": model_residency.keep_alive()}
+    payload.update(structured_output.ollama_fields(constraint))
+    model_residency.ensure_loaded(model)
+    model_residency.touch(model)
+    start = time.time()
+    response = conn.post("ollama", "/api/generate", json=payload, timeout=timeout, stream=True)
+    if response.status_code != 200:
+        response.close()
+        raise RuntimeError(f"Błąd Ollama: Status {response.status_code}")
+    ttft = None
+    for data in _iter_stream(response, json.loads, cancel_event):
+        token = data.get("response") or ""
+        if token:
+            if ttft is None:
+                ttft = time.time() - start
+            yield token
+        if data.get("done"):
+            stats = _ollama_stats(data)
+            stats["ttft"] = ttft
+            stats["wall_s"] = time.time() - start
+            _publish_stats(stats, model)
+            break
+
+
+def _parse_sse(raw):
+    if not raw.startswith("data:"):
+        return None
+    body = raw[5:].strip()
+    if not body or body == "[DONE]":
+        return None
+    return json.loads(body)
+
+
+class _LlamaConnectError(Exception):
+    """Strumien llama-server nie wystartowal (polaczenie/status) – zaden token nie poszedl."""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+def stream_llama_server(prompt, model=None, timeout=90, cancel_event=None, session=None, constraint=None,
+                        prefix_hash=None):
+    """Generator tokenow z llama-server (SSE) w dialekcie wykrytym przez llama_probe."""
+    timeout = _await_llama(timeout)
+    caps = llama_probe.get_capabilities()
+    if not caps:
+        raise RuntimeError("Błąd połączenia z llama-server: serwer nie wykryty")
+    try:
+        yield from _stream_llama(caps, prompt, model, timeout, cancel_event, session, constraint, prefix_hash)
+    except _LlamaConnectError as e:
+        # Jak w query_llama_server: serwer mogl wstac na innym porcie/modelu – jedno ponowne wykrycie.
+        fresh = llama_probe.probe(force=True)
+        if not fresh or fresh == caps:
+            raise e.error
+        try:
+            yield from _stream_llama(fresh, prompt, model, timeout, cancel_event, session, constraint, prefix_hash)
+        except _LlamaConnectError as retry_error:
+            llama_probe.invalidate()
+            raise retry_error.error
+
+
+def _stream_llama(caps, prompt, model, timeout, cancel_event, session, constraint, prefix_hash):
+    path, payload = _llama_payload(caps, prompt, stream=True, session=session, constraint=constraint)
+    with llama_pool.lease(caps["base"], session) as base:
+        # Slot sesji z pliku (pierwsza tura po restarcie) – prefiks nie jest liczony od nowa.
+        slot_store.before_turn(base, caps, session, prefix_hash)
+        start = time.time()
+        try:
+            response = conn.post("llama", path, base_url=base, json=payload, timeout=timeout, stream=True)
+        except Exception as e:
+            raise _LlamaConnectError(e)
+        if response.status_code != 200:
+            response.close()
+            raise _LlamaConnectError(RuntimeError(f"Błąd llama-server: Status {response.status_code}"))
+        completion = caps.get("dialect") == "completion"
+        ttft = None
+        last = None
+        for data in _iter_stream(response, _parse_sse, cancel_event):
+            if completion:
+                token = data.get("content") or ""
+            else:
+                choices = data.get("choices") or [{}]
+                token = (choices[0].get("delta") or {}).get("content") or choices[0].get("text") or ""
+            if token:
+                if ttft is None:
+                    ttft = time.time() - start
+                yield token
+            if completion and data.get("stop"):
+                last = data
+                break
+            if not completion and (data.get("usage") or (data.get("choices") or [{}])[0].get("finish_reason")):
+                # `usage`/`timings` moga przyjsc w tym samym albo osobnym, ostatnim fragmencie.
+                last = dict(last or {}, **data)
+                if data.get("usage"):
+                    break
+        if last is not None:
+            stats = _llama_result_stats(caps, last, time.time() - start, ttft)
+            stats["instance"] = base
+            _publish_stats(stats, caps.get("model") or model)
+            slot_store.after_turn(base, caps, session, prefix_hash)
+
 
 def internet_ok():
     """Szybki test, czy jest połączenie z internetem (ping do Google DNS)."""
@@ -147,8 +400,8 @@ def internet_ok():
     except socket.error:
         return False
 
-def _query_openai(prompt, model_name=None, timeout=20):
-    if not openai:
+def _query_openai(prompt, model_name=None, timeout=20, on_token=None):
+    if not cloud_client.available():
         return "Błąd API: brak biblioteki openai"
     if os.environ.get("LYRA_CLOUD_ONCE") == "1":
         pass
@@ -158,28 +411,30 @@ def _query_openai(prompt, model_name=None, timeout=20):
             return "Błąd API: zgoda wylaczona"
         if consent != "always":
             return "CONSENT_REQUIRED"
-    cfg = _load_config()
-    api_key = cfg.get("openai_api_key")
-    if not api_key or "TWÓJ_KLUCZ" in api_key:
+    if not cloud_client.key_configured():
         return "Błąd API: brak klucza"
     model_name = model_name or _get_cloud_model()
     try:
-        client = openai.OpenAI(api_key=api_key)
-        resp = client.chat.completions.create(
-            model=model_name,
-            messages=[
+        return cloud_client.chat(
+            [
                 {"role": "system", "content": "Jesteś Lyra, zaawansowany asystent AI."},
                 {"role": "user", "content": prompt},
             ],
+            model=model_name,
             timeout=timeout,
+            on_token=on_token,
         )
-        return resp.choices[0].message.content or ""
     except Exception as e:
         return f"Błąd API: {e}"
 
 # Dalej idzie Twoja funkcja query_model...
 # Reszta Twojego kodu query_model...
 def query_model(prompt, local_model, remote_model, config, history):
+    # config={"schema": {...}} albo {"grammar": "..."} -> (sparsowany obiekt, zrodlo)
+    constraint = structured_output.from_config(config)
+    if constraint:
+        return _query_structured(prompt, local_model, remote_model, config, constraint)
+
     # Lyra próbuje najpierw sprawdzić, czy już o tym rozmawialiście
     try:
         mem_answer = search_memory(prompt)
@@ -194,14 +449,7 @@ def query_model(prompt, local_model, remote_model, config, history):
     # =====================
     # Tryb pracy
     # =====================
-    STATE_PATH = os.path.expanduser("~/lyra_agent/system_state.json")
-    mode = "auto"
-
-    if os.path.exists(STATE_PATH):
-        try:
-            mode = json.load(open(STATE_PATH, "r", encoding="utf-8")).get("mode", "auto")
-        except:
-            mode = "auto"
+    mode = _read_mode()
 
     # =====================
     # 1. Pamięć
@@ -214,23 +462,24 @@ def query_model(prompt, local_model, remote_model, config, history):
     # 2. Offline wymuszony
     # =====================
     # POPRAWNA LOGIKA:
+    deadline = deadline_mod.from_config(config, default=50)
     if mode == "offline":
         backend = _get_local_backend()
-        if backend == "llama":
-            odpowiedz = query_llama_server(prompt, model=local_model, timeout=30)
-            return odpowiedz, "llama"
-        odpowiedz = query_ollama(prompt, local_model, timeout=30)
-        return odpowiedz, "ollama"
+        odpowiedz = _query_local(prompt, local_model, backend, config, timeout=deadline.timeout())
+        return odpowiedz, backend
 
     # =====================
     # 3. Lokalny model (Ollama)
     # =====================
     try:
         backend = _get_local_backend()
-        if backend == "llama":
-            local_resp = query_llama_server(prompt, model=local_model, timeout=30)
-        else:
-            local_resp = query_ollama(prompt, local_model, timeout=30)
+        threshold = _hedge_threshold(config)
+        if threshold is not None:
+            cached, key = _cached_response(prompt, local_model, backend, config)
+            if cached:
+                return cached, "local"
+            return _hedged_shared(prompt, local_model, remote_model, backend, config or {}, deadline, threshold, key)
+        local_resp = _query_local(prompt, local_model, backend, config, timeout=_local_budget(config, deadline))
 
         if local_resp and isinstance(local_resp, str) and local_resp.strip():
             # Jeśli backend zwrócił błąd, przejdź dalej do fallbacku
@@ -239,19 +488,395 @@ def query_model(prompt, local_model, remote_model, config, history):
     except:
         pass
 
+    return _cloud_fallback(prompt, remote_model, dict(config or {}, deadline=deadline))
+
+def _query_structured(prompt, local_model, remote_model, config, constraint):
+    """
+    Wariant query_model z ograniczonym generowaniem: bez pamieci i wyscigu z chmura,
+    lokalny backend dostaje schemat/gramatyke, chmura – schemat w poleceniu.
+    Zwraca (obiekt, zrodlo) albo rzuca StructuredOutputError.
+    """
+    mode = _read_mode()
+    backend = _get_local_backend()
+    deadline = deadline_mod.from_config(config, default=50)
+    timeout = deadline.timeout() if mode == "offline" else _local_budget(config, deadline)
+    text = _query_local(prompt, local_model, backend, config, timeout=timeout)
+    return _structured_result(text, prompt, remote_model, config, constraint, deadline, mode, backend)
+
+def _structured_result(text, prompt, remote_model, config, constraint, deadline, mode, backend):
+    """Parsowanie odpowiedzi lokalnej; przy bledzie – chmura (gdy dozwolona). Wspolne z query_model_async."""
+    try:
+        if isinstance(text, str) and text.startswith("Błąd"):
+            raise StructuredOutputError(text, text)
+        return structured_output.parse(text, constraint), backend if mode == "offline" else "local"
+    except StructuredOutputError as e:
+        local_error = e
+    if mode == "offline" or not (config or {}).get("allow_cloud"):
+        raise local_error
+    resp, source = _cloud_fallback(structured_output.cloud_prompt(prompt, constraint), remote_model,
+                                   dict(config or {}, deadline=deadline))
+    if source != "cloud":
+        raise StructuredOutputError(f"{local_error}; chmura: {resp}", local_error.raw)
+    return structured_output.parse(resp, constraint), "cloud"
+
+def _is_error_response(text):
+    low = (text or "").lower()
+    return "błąd" in low or "error" in low
+
+def _cache_key(prompt, local_model, backend):
+    model = local_model
+    params = {}
+    if backend == "llama":
+        # llama-server ignoruje nazwe modelu z zapytania – kluczem jest model faktycznie zaladowany.
+        caps = llama_probe.get_capabilities() or {}
+        model = caps.get("model") or local_model
+        params = {"dialect": caps.get("dialect"), "n_predict": 256, "temperature": 0.7}
+    return response_cache.make_key(prompt, model, backend, params), model
+
+def _cached_response(prompt, local_model, backend, config):
+    """Zwraca (odpowiedz_z_cache | None, klucz | None)."""
+    global LAST_STATS
+    if not response_cache.enabled(config):
+        return None, None
+    key, _ = _cache_key(prompt, local_model, backend)
+    cached = response_cache.get(key)
+    if cached:
+        LAST_STATS = {"prompt_tps": None, "gen_tps": None, "backend": backend, "cache_hit": True}
+        perf_store.record(LAST_STATS, model=local_model, backend=backend, path="cache")
+    return cached, key
+
+def _store_response(key, text, local_model, backend):
+    if key and text and text.strip() and not _is_error_response(text):
+        response_cache.put(key, text, model=local_model, backend=backend)
+
+def _flight_key(prompt, local_model, backend, priority, constraint=None, key=None):
+    """Klucz single-flight wspolny dla sciezki synchronicznej i async (prompt, model, parametry, klasa)."""
+    base_key = key or _cache_key(prompt, local_model, backend)[0]
+    return f"{base_key}:{priority}:{json.dumps(constraint, sort_keys=True) if constraint else ''}"
+
+def _collect_stream(prompt, local_model, backend, timeout, cancel_event, session=None, constraint=None,
+                    prefix_hash=None):
+    """Zapytanie przez strumien, zeby harmonogram mogl je przerwac (StreamCancelled)."""
+    stream_fn = stream_llama_server if backend == "llama" else stream_ollama
+    parts = []
+    try:
+        for token in stream_fn(prompt, model=local_model, timeout=timeout, cancel_event=cancel_event, session=session,
+                               constraint=constraint, prefix_hash=prefix_hash):
+            parts.append(token)
+    except StreamCancelled:
+        raise
+    except Exception as e:
+        if parts:
+            return "".join(parts)
+        prefix = "Błąd połączenia z llama-server" if backend == "llama" else "Błąd połączenia z Ollama"
+        return f"{prefix}: {e}"
+    return "".join(parts)
+
+def _query_local(prompt, local_model, backend, config, timeout=30):
+    cfg = config or {}
+    constraint = structured_output.from_config(cfg)
+    # Odpowiedzi ograniczone schematem nie ida do cache (klucz nie uwzglednia schematu).
+    cached, key = (None, None) if constraint else _cached_response(prompt, local_model, backend, config)
+    if cached:
+        return cached
+    priority = request_scheduler.normalize_priority(cfg.get("priority"))
+
+    def _run(cancel_event):
+        if priority != "interactive":
+            # Nizsze klasy ida strumieniem – interaktywne zapytanie moze je wywlaszczyc.
+            return _collect_stream(prompt, local_model, backend, timeout, cancel_event, cfg.get("session"), constraint,
+                                   cfg.get("prefix_hash"))
+        if backend == "llama":
+            return query_llama_server(prompt, model=local_model, timeout=timeout, session=cfg.get("session"),
+                                      constraint=constraint, prefix_hash=cfg.get("prefix_hash"))
+        return query_ollama(prompt, local_model, timeout=timeout, constraint=constraint)
+
+    # Identyczne zapytanie w locie (prompt, model, parametry, klasa) – dolaczamy do niego.
+    flight_key = _flight_key(prompt, local_model, backend, priority, constraint, key)
+    try:
+        text = single_flight.do(flight_key, lambda: request_scheduler.run(_run, priority, timeout=timeout),
+                                timeout=timeout, retry_on=FLIGHT_RETRY)
+    except (request_scheduler.SchedulerBusy, request_scheduler.Preempted, StreamCancelled) as e:
+        return f"Błąd harmonogramu: {str(e) or priority}"
+    except TimeoutError:
+        return deadline_mod.TIMEOUT_MESSAGE
+    _store_response(key, text, local_model, backend)
+    return text
+
+def _read_mode():
+    state_path = os.path.expanduser("~/lyra_agent/system_state.json")
+    if os.path.exists(state_path):
+        try:
+            return json.load(open(state_path, "r", encoding="utf-8")).get("mode", "auto")
+        except Exception:
+            return "auto"
+    return "auto"
+
+def _cloud_fallback(prompt, remote_model, config, on_token=None):
     # =====================
     # 4. Tryb online → GPT
     # =====================
     allow_cloud = bool((config or {}).get("allow_cloud"))
+    deadline = deadline_mod.from_config(config, default=20)
+    if allow_cloud and deadline.expired():
+        return deadline_mod.TIMEOUT_MESSAGE, "timeout"
     if allow_cloud and internet_ok():
         cloud_model = remote_model or _get_cloud_model()
-        resp = _query_openai(prompt, cloud_model, timeout=20)
+        start = time.time()
+        resp = _query_openai(prompt, cloud_model, timeout=deadline.timeout(cap=CLOUD_TIMEOUT), on_token=on_token)
         if resp == "CONSENT_REQUIRED":
             return "[Zgoda GPT wymagana] Uzyj: zgoda gpt zawsze|raz|nie", "consent"
         if resp and "błąd api" not in resp.lower():
+            perf_store.record({"wall_s": time.time() - start}, model=cloud_model, backend="openai", path="local>cloud")
             return resp, "cloud"
 
     # =====================
     # 5. Brak internetu i brak lokalnego
     # =====================
     return "[Brak odpowiedzi] Offline + lokalny model nie działa.", "offline"
+
+# Ile sekund budzetu zostawic chmurze, gdy lokalny model zawiedzie.
+CLOUD_TIMEOUT = 20
+DEFAULT_HEDGE_TTFT = 4.0
+
+
+class _LeaderCancelled(StreamCancelled):
+    """Wyscig lidera przerwany (Ctrl-C); niesie czesciowa odpowiedz tylko dla niego."""
+
+    def __init__(self, text):
+        super().__init__()
+        self.text = text
+
+
+# Przerwanie lidera (wywlaszczenie, Ctrl-C) – dolaczone zapytania ponawiaja, zamiast dostac blad.
+FLIGHT_RETRY = (StreamCancelled, request_scheduler.Preempted)
+
+
+class _AnyEvent:
+    """Anulowanie, gdy ustawione jest ktorekolwiek ze zdarzen (Ctrl-C, harmonogram, wyscig) lub minal deadline."""
+
+    def __init__(self, *events, deadline=None):
+        self.events = [e for e in events if e is not None]
+        self.deadline = deadline
+
+    def is_set(self):
+        if self.deadline is not None and self.deadline.expired():
+            return True
+        return any(e.is_set() for e in self.events)
+
+
+def _local_budget(config, deadline):
+    """Lokalny etap nie moze zjesc czasu zarezerwowanego na fallback do chmury."""
+    if (config or {}).get("allow_cloud"):
+        return deadline.timeout(cap=max(1.0, deadline.remaining() - CLOUD_TIMEOUT))
+    return deadline.timeout()
+
+
+def _hedge_threshold(config):
+    """Prog TTFT (s) dla wyscigu lokalny/chmura albo None, gdy wyscig wylaczony."""
+    # Zapytanie tylko lokalne (allow_cloud=False, FORCE_LOCAL) nigdy nie trafia do chmury.
+    if not (config or {}).get("allow_cloud"):
+        return None
+    cfg = config_cache.load(CONFIG_PATH)
+    enabled = (config or {}).get("hedge")
+    if enabled is None:
+        enabled = str(cfg.get("hedge_cloud", "off")).lower() in ["on", "true", "1", "yes", "tak"]
+    if not enabled or not cloud_client.available() or _cloud_consent_state() != "always" or _read_mode() == "offline":
+        return None
+    if not internet_ok():
+        return None
+    try:
+        return float(cfg.get("hedge_ttft_sec", DEFAULT_HEDGE_TTFT))
+    except Exception:
+        return DEFAULT_HEDGE_TTFT
+
+
+def _hedged_query(prompt, local_model, remote_model, backend, cfg, deadline, threshold, on_token=None):
+    """
+    Lokalny strumien w osobnym watku; jesli pierwszy token nie przyjdzie w `threshold` s,
+    rownolegle startuje chmura. Wygrywa pierwsza odpowiedz – przegrany lokalny strumien
+    jest zamykany. Gdy lokalny model juz pisze, zostajemy przy nim.
+    """
+    events = queue.Queue()
+    hedge_cancel = threading.Event()
+    cancel = _AnyEvent(hedge_cancel, cfg.get("cancel_event"), deadline=deadline)
+    stream_fn = stream_llama_server if backend == "llama" else stream_ollama
+    start = time.monotonic()
+
+    def _local():
+        try:
+            ticket = request_scheduler.acquire(cfg.get("priority"), timeout=deadline.remaining())
+        except request_scheduler.SchedulerBusy as e:
+            events.put(("error", e))
+            return
+        try:
+            for token in stream_fn(prompt, model=local_model, timeout=deadline.timeout(), cancel_event=cancel,
+                                   session=cfg.get("session"), prefix_hash=cfg.get("prefix_hash")):
+                events.put(("token", token))
+            events.put(("done", None))
+        except StreamCancelled:
+            events.put(("cancelled", None))
+        except Exception as e:
+            events.put(("error", e))
+        finally:
+            request_scheduler.release(ticket)
+
+    def _cloud():
+        cloud_start = time.time()
+        cloud_model = remote_model if remote_model and remote_model != "local" else _get_cloud_model()
+        resp = _query_openai(prompt, cloud_model, timeout=deadline.timeout(cap=CLOUD_TIMEOUT))
+        if resp and "błąd api" not in resp.lower():
+            perf_store.record({"wall_s": time.time() - cloud_start}, model=cloud_model, backend="openai", path="hedge>cloud")
+        events.put(("cloud", resp))
+
+    def _start_cloud():
+        threading.Thread(target=_cloud, daemon=True).start()
+        return True
+
+    threading.Thread(target=_local, daemon=True).start()
+    parts = []
+    cloud_started = False
+    cloud_failed = False
+    local_failed = False
+    while True:
+        wait = deadline.remaining()
+        if not parts and not cloud_started:
+            wait = min(wait, max(0.0, threshold - (time.monotonic() - start)))
+        try:
+            kind, value = events.get(timeout=max(0.05, wait))
+        except queue.Empty:
+            if deadline.expired():
+                hedge_cancel.set()
+                return ("".join(parts), "local") if parts else (deadline_mod.TIMEOUT_MESSAGE, "timeout")
+            if not parts and not cloud_started:
+                cloud_started = _start_cloud()
+            continue
+        except KeyboardInterrupt:
+            hedge_cancel.set()
+            return "".join(parts), "cancelled"
+        if kind == "token":
+            parts.append(value)
+            if on_token:
+                on_token(value)
+        elif kind == "done":
+            text = "".join(parts)
+            if text.strip():
+                return text, "local"
+            local_failed = True
+        elif kind in ["error", "cancelled"]:
+            if parts:
+                return "".join(parts), "local"
+            if kind == "cancelled" and cfg.get("cancel_event") is not None and cfg["cancel_event"].is_set():
+                return "", "cancelled"
+            local_failed = True
+        elif kind == "cloud":
+            if not parts and value and "błąd api" not in value.lower():
+                hedge_cancel.set()
+                if on_token:
+                    on_token(value)
+                return value, "cloud"
+            cloud_failed = True
+        if local_failed and not cloud_started:
+            cloud_started = _start_cloud()
+        if local_failed and cloud_failed:
+            return "[Brak odpowiedzi] Offline + lokalny model nie działa.", "offline"
+
+
+def _hedged_shared(prompt, local_model, remote_model, backend, cfg, deadline, threshold, key, on_token=None):
+    """
+    Wyscig przez single-flight i cache: identyczne zapytanie w locie dolacza do trwajacego
+    wyscigu (bez drugiego zapytania do chmury), wygrana lokalna trafia do cache.
+    """
+    is_leader = []
+
+    def _run():
+        is_leader.append(True)
+        text, source = _hedged_query(prompt, local_model, remote_model, backend, cfg, deadline, threshold, on_token)
+        if source == "cancelled":
+            raise _LeaderCancelled(text)
+        return text, source
+
+    priority = request_scheduler.normalize_priority(cfg.get("priority"))
+    flight_key = _flight_key(prompt, local_model, backend, f"{priority}:hedge", key=key)
+    try:
+        text, source = single_flight.do(flight_key, _run, timeout=deadline.remaining(), retry_on=FLIGHT_RETRY)
+    except _LeaderCancelled as e:
+        return e.text, "cancelled"
+    except TimeoutError:
+        return deadline_mod.TIMEOUT_MESSAGE, "timeout"
+    if not is_leader and on_token and text:
+        # Dolaczone zapytanie nie widzialo tokenow lidera – dostaje cala odpowiedz naraz.
+        on_token(text)
+    if source == "local":
+        _store_response(key, text, local_model, backend)
+    return text, source
+
+
+def query_model_stream(prompt, local_model, remote_model, config, history, on_token=None):
+    """
+    Strumieniowy wariant query_model: kazdy fragment odpowiedzi trafia do on_token.
+    Zwraca (pelny_tekst, zrodlo) jak query_model; przy Ctrl-C zrodlo = "cancelled".
+    """
+    def _emit(text):
+        if on_token and text:
+            on_token(text)
+
+    mem_answer = search_memory(prompt)
+    if mem_answer:
+        text = f"[Z pamięci] {mem_answer}"
+        _emit(text)
+        return text, "memory"
+
+    cfg = config or {}
+    deadline = deadline_mod.from_config(cfg, default=50)
+    backend = _get_local_backend()
+    cached, cache_key = _cached_response(prompt, local_model, backend, cfg)
+    if cached:
+        _emit(cached)
+        return cached, "local"
+    threshold = _hedge_threshold(cfg)
+    if threshold is not None:
+        return _hedged_shared(prompt, local_model, remote_model, backend, cfg, deadline, threshold, cache_key,
+                              on_token)
+    stream_fn = stream_llama_server if backend == "llama" else stream_ollama
+    parts = []
+    try:
+        ticket = request_scheduler.acquire(cfg.get("priority"), timeout=deadline.remaining())
+    except request_scheduler.SchedulerBusy as e:
+        return f"Błąd harmonogramu: {e}", backend
+    cancel_event = _AnyEvent(cfg.get("cancel_event"), ticket.cancel_event, deadline=deadline)
+    timeout = _local_budget(cfg, deadline)
+    try:
+        for token in stream_fn(prompt, model=local_model, timeout=timeout, cancel_event=cancel_event,
+                               session=cfg.get("session"), prefix_hash=cfg.get("prefix_hash")):
+            parts.append(token)
+            _emit(token)
+    except (KeyboardInterrupt, StreamCancelled):
+        if deadline.expired() and not any(e.is_set() for e in cancel_event.events):
+            # Minal limit czasu, nie Ctrl-C – zwracamy to, co zdazylo przyjsc.
+            return ("".join(parts), "local") if parts else (deadline_mod.TIMEOUT_MESSAGE, "timeout")
+        return "".join(parts), "cancelled"
+    except Exception as e:
+        if parts:
+            return "".join(parts), "local"
+        if _read_mode() == "offline":
+            prefix = "Błąd połączenia z llama-server" if backend == "llama" else "Błąd połączenia z Ollama"
+            return f"{prefix}: {e}", backend
+    finally:
+        request_scheduler.release(ticket)
+    text = "".join(parts)
+    if text.strip():
+        _store_response(cache_key, text, local_model, backend)
+        return text, "local"
+    if _read_mode() == "offline":
+        return text, backend
+    streamed = []
+
+    def _cloud_token(token):
+        streamed.append(token)
+        _emit(token)
+
+    resp, source = _cloud_fallback(prompt, remote_model, dict(cfg, deadline=deadline), on_token=_cloud_token)
+    if source != "cloud" or not streamed:
+        _emit(resp)
+    return resp, source
@@ -1,13 +1,18 @@
+import hashlib
 import json
 import os
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from modules import gguf_index
 from modules.model_paths import get_models_path, get_models_dir
 
 # JEDNA, SPÓJNA KONFIGURACJA ŚCIEŻEK
 MODELS_DIR = get_models_dir()
 MAP_FILE = get_models_path()
+CONFIG_PATH = Path(__file__).resolve().parent.parent / "config.json"
 
 # ===========================================
 # POMOCNIKI ZAPISU/ODCZYTU (Zawsze UTF-8)
@@ -36,14 +41,128 @@ def _save_map(data):
         MODELS_DIR = fallback.parent
 
 # ===========================================
-# SKANOWANIE (JEDNA KOMPLEKSOWA FUNKCJA)
+# SKANOWANIE (INDEKS + PRZYROSTOWO)
 # ===========================================
 
+# Indeks skanowania: katalog -> (mtime, pliki .gguf z rozmiarem/mtime, podkatalogi)
+# oraz cache rejestracji w Ollama (model -> odcisk pliku).
+SCAN_INDEX = Path(__file__).resolve().parent.parent / "logs" / "model_scan_index.json"
+REGISTER_WORKERS = 2
+# `ollama create` kopiuje wagi do blobow – duzy model to minuty, ale nie bez konca.
+REGISTER_TIMEOUT_SEC = 900
+
+
+def _load_index():
+    try:
+        data = json.loads(SCAN_INDEX.read_text("utf-8"))
+    except Exception:
+        data = {}
+    data.setdefault("dirs", {})
+    data.setdefault("registered", {})
+    return data
+
+def _save_index(index):
+    try:
+        SCAN_INDEX.parent.mkdir(parents=True, exist_ok=True)
+        SCAN_INDEX.write_text(json.dumps(index, ensure_ascii=False), "utf-8")
+    except Exception:
+        pass
+
+def _list_dir(path):
+    """Jeden katalog z dysku: ({nazwa.gguf: [rozmiar, mtime]}, [podkatalogi])."""
+    files, subdirs = {}, []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.name.endswith(".gguf") and entry.is_file():
+                    st = entry.stat()
+                    files[entry.name] = [st.st_size, int(st.st_mtime)]
+            except OSError:
+                continue
+    return files, sorted(subdirs)
+
+def _scan_root(root, max_depth, old_dirs):
+    """
+    Przechodzi drzewo do max_depth (glebiej nie schodzi w ogole). Katalog, ktorego
+    mtime sie nie zmienil, bierze z indeksu – na dysku tylko stat katalogu i jego
+    plikow .gguf, bez listowania.
+    Zwraca (modele [(sciezka, rozmiar, mtime)], nowe wpisy indeksu, listowane, z_indeksu).
+    """
+    found, dirs = [], {}
+    listed = reused = 0
+    stack = [(str(root), 0)]
+    while stack:
+        path, depth = stack.pop()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        cached = old_dirs.get(path)
+        if cached and cached.get("mtime") == mtime:
+            subdirs = cached.get("subdirs", [])
+            # Plik nadpisany w miejscu nie zmienia mtime katalogu – stat kazdego .gguf z indeksu.
+            files = {}
+            for name in cached.get("files", {}):
+                try:
+                    st = os.stat(os.path.join(path, name))
+                except OSError:
+                    continue
+                files[name] = [st.st_size, int(st.st_mtime)]
+            reused += 1
+        else:
+            try:
+                files, subdirs = _list_dir(path)
+            except OSError:
+                continue
+            listed += 1
+        dirs[path] = {"mtime": mtime, "files": files, "subdirs": subdirs}
+        for name, (size, fmtime) in files.items():
+            found.append((os.path.join(path, name), size, fmtime))
+        if depth < max_depth:
+            stack.extend((os.path.join(path, sub), depth + 1) for sub in subdirs)
+    return found, dirs, listed, reused
+
+def _file_digest(path, size, mtime):
+    """Odcisk pliku bez czytania gigabajtow: sciezka + rozmiar + mtime."""
+    return hashlib.sha1(f"{path}|{size}|{mtime}".encode("utf-8")).hexdigest()[:16]
+
+def _ollama_names():
+    """Nazwy modeli w Ollama (bez :latest) albo None, gdy Ollama nie odpowiada."""
+    try:
+        result = subprocess.run(["ollama", "list"], capture_output=True, text=True, timeout=5)
+    except Exception:
+        return None
+    if result.returncode != 0:
+        return None
+    names = set()
+    for line in (result.stdout or "").splitlines()[1:]:
+        if line.strip():
+            name = line.split()[0].lower()
+            names.add(name[:-7] if name.endswith(":latest") else name)
+    return names
+
+def _register_ollama(model_key, full_path, timeout=REGISTER_TIMEOUT_SEC):
+    with tempfile.NamedTemporaryFile("w", prefix="lyra_modelfile_", delete=False) as mf:
+        mf.write(f"FROM {full_path}")
+    try:
+        result = subprocess.run(["ollama", "create", model_key, "-f", mf.name], capture_output=True, text=True,
+                                timeout=timeout)
+        return model_key, result.returncode == 0, (result.stderr or result.stdout or "").strip()[-200:]
+    except subprocess.TimeoutExpired:
+        return model_key, False, f"przekroczono czas rejestracji ({timeout} s)"
+    except Exception as e:
+        return model_key, False, str(e)
+    finally:
+        os.unlink(mf.name)
+
 def tool_SCAN_MODELS(arg, system, log):
-    """Skanuje dyski i automatycznie rejestruje nowe modele w Ollama."""
+    """Skanuje dyski (przyrostowo, rownolegle per dysk) i rejestruje nowe modele w Ollama."""
     arg_l = (arg or "").lower()
     fast_scan = "szybko" in arg_l or "fast" in arg_l
     no_ollama = "bez ollama" in arg_l or "no-ollama" in arg_l
+    full_scan = "pelne" in arg_l or "pełne" in arg_l or "full" in arg_l
     roots = []
     models_dir = get_models_dir()
     if models_dir.exists():
@@ -61,52 +180,95 @@ def tool_SCAN_MODELS(arg, system, log):
     if not roots:
         return "❌ Nie znaleziono katalogu z modelami do skanowania."
 
-    # Pobieramy listę modeli już zarejestrowanych w Ollama
-    ollama_list = ""
-    if not no_ollama:
+    index = _load_index()
+    old_dirs = {} if full_scan else index["dirs"]
+    max_depth = 1 if fast_scan else 4
+    # Kazdy dysk we wlasnym watku – HDD archiwum nie blokuje szybkiego SSD.
+    with ThreadPoolExecutor(max_workers=len(roots)) as pool:
+        results = list(pool.map(lambda r: _scan_root(r, max_depth, old_dirs), roots))
+    models, listed, reused = [], 0, 0
+    for root, (found, dirs, n_listed, n_reused) in zip(roots, results):
+        models.extend(found)
+        if not fast_scan:
+            # Pelny przebieg korzenia: usuwamy z indeksu katalogi, ktorych juz nie ma.
+            prefix = str(root).rstrip(os.sep) + os.sep
+            for path in [p for p in index["dirs"] if p == str(root) or p.startswith(prefix)]:
+                if path not in dirs:
+                    del index["dirs"][path]
+        index["dirs"].update(dirs)
+        listed += n_listed
+        reused += n_reused
+
+    # Shardy (-0000N-of-0000M) to jeden model: wpis tylko dla pierwszej czesci, nazwa bez sufiksu.
+    models = [m for m in models if not gguf_index.is_extra_shard(m[0])]
+    collapsed = gguf_index.collapse(data["available"])
+    migrated = collapsed != data["available"]
+    data["available"] = collapsed
+    active = str(data.get("active") or "")
+    if gguf_index.SHARD_RE.search(active):
+        data["active"] = gguf_index.SHARD_RE.sub("", active)
+        migrated = True
+    for full_path, _, _ in models:
+        model_key = gguf_index.logical_name(full_path)
+        # 1. Dodaj do bazy JSON Lyry, jeśli brakuje
+        if model_key not in data["available"]:
+            data["available"][model_key] = full_path
+            found_count += 1
+
+    # Metadane z naglowkow GGUF (cache wg mtime – czytane tylko nowe/zmienione pliki).
+    gguf_paths = [str(p) for _, path in data["available"].items() if str(path).endswith(".gguf")
+                  for p in gguf_index.shard_paths(path)]
+    gguf_index.refresh([p for p in gguf_paths if os.path.exists(p)])
+    if not fast_scan:
+        gguf_index.prune()
+
+    # 2. AUTOMATYCZNA REJESTRACJA W OLLAMA (opcjonalna, ograniczona pula)
+    ollama_names = None if no_ollama else _ollama_names()
+    if ollama_names is not None:
+        registered = index["registered"]
+        todo = {}
+        for full_path, size, mtime in models:
+            model_key = gguf_index.logical_name(full_path)
+            digest = _file_digest(full_path, size, mtime)
+            if registered.get(model_key) == digest or model_key in todo:
+                continue
+            if model_key in ollama_names and model_key not in registered:
+                # Zarejestrowany wczesniej (recznie lub starsza wersja skanera) – tylko zapamietaj.
+                registered[model_key] = digest
+                continue
+            todo[model_key] = (full_path, digest)
         try:
-            result = subprocess.run(["ollama", "list"], capture_output=True, text=True, timeout=5)
-            ollama_list = result.stdout or ""
+            cfg = json.loads(CONFIG_PATH.read_text("utf-8"))
         except Exception:
-            ollama_list = ""
-
-    for search_root in roots:
-        base_depth = len(Path(search_root).parts)
-        for root, _, files in os.walk(search_root):
-            cur_depth = len(Path(root).parts) - base_depth
-            max_depth = 1 if fast_scan else 4
-            if cur_depth > max_depth:
-                continue
-            for file in files:
-                if file.endswith(".gguf"):
-                    model_key = Path(file).stem.lower()
-                    full_path = str(Path(root) / file)
-                    
-                    # 1. Dodaj do bazy JSON Lyry, jeśli brakuje
-                    if model_key not in data["available"]:
-                        data["available"][model_key] = full_path
-                        found_count += 1
-
-                    # 2. AUTOMATYCZNA REJESTRACJA W OLLAMA (opcjonalna)
-                    if not no_ollama and ollama_list and model_key not in ollama_list.lower():
-                        print(f"📦 Rejestruję nowy model w Ollama: {model_key}...")
-                        modelfile_content = f"FROM {full_path}"
-                        temp_mf = Path("/tmp/lyra_modelfile")
-                        temp_mf.write_text(modelfile_content)
-                        try:
-                            subprocess.run(["ollama", "create", model_key, "-f", str(temp_mf)], check=True)
-                            registered_count += 1
-                        except subprocess.CalledProcessError:
-                            print(f"❌ Błąd rejestracji modelu {model_key}")
-                        finally:
-                            if temp_mf.exists():
-                                temp_mf.unlink()
-
-    if found_count > 0 or registered_count > 0:
+            cfg = {}
+        try:
+            workers = max(1, int(cfg.get("scan_register_workers", REGISTER_WORKERS)))
+        except Exception:
+            workers = REGISTER_WORKERS
+        try:
+            register_timeout = max(1, int(cfg.get("scan_register_timeout_sec", REGISTER_TIMEOUT_SEC)))
+        except Exception:
+            register_timeout = REGISTER_TIMEOUT_SEC
+        if todo:
+            print(f"📦 Rejestruję w Ollama: {', '.join(sorted(todo))} (rownolegle: {workers})...")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(_register_ollama, key, path, register_timeout) for key, (path, _) in todo.items()]
+            for job in as_completed(jobs):
+                model_key, ok, detail = job.result()
+                if ok:
+                    registered[model_key] = todo[model_key][1]
+                    registered_count += 1
+                    if log: log(f"Zarejestrowano model w Ollama: {model_key}")
+                else:
+                    print(f"❌ Błąd rejestracji modelu {model_key}: {detail}")
+
+    _save_index(index)
+    stats = f"(katalogi: listowane {listed}, z indeksu {reused})"
+    if found_count > 0 or registered_count > 0 or migrated:
         _save_map(data)
-        return f"✅ Skanowanie OK! Znaleziono: {found_count}, zarejestrowano w Ollama: {registered_count}."
+        return f"✅ Skanowanie OK! Znaleziono: {found_count}, zarejestrowano w Ollama: {registered_count}. {stats}"
     
-    return "🔍 Wszystkie modele są już zarejestrowane i aktualne."
+    return f"🔍 Wszystkie modele są już zarejestrowane i aktualne. {stats}"
 
 # ===========================================
 # LISTA MODELI (CZYTELNA I POSORTOWANA)
@@ -123,11 +285,14 @@ def tool_MODEL_LIST(arg, system, log):
     out = ["📦 Dostępne modele lokalne:"]
     
     # Sortowanie alfabetyczne nazw dla lepszej czytelności
+    models = gguf_index.collapse(models)
     for name in sorted(models.keys()):
         path = models[name]
         # Sprawdzamy czy to ten aktywny (ignorując wielkość liter)
         flag = " 🔥 [AKTYWNY]" if name.lower() == active.lower() else ""
         out.append(f" • {name}{flag}\n    ↳ {path}")
+        if str(path).endswith(".gguf"):
+            out.append(f"    ↳ {gguf_index.describe(gguf_index.model_info(path))}")
 
     out.append("\nUżyj: lyra użyj <nazwa>")
     return "\n".join(out)
@@ -0,0 +1,208 @@
+import datetime
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from modules import config_cache
+
+# =========================================================
+# PERF STORE – dopisywana historia kazdego zapytania (SQLite):
+# model, backend, tokeny, t/s, TTFT, czas, cache, sciezka;
+# raport `lyra perf` z percentylami i trendem
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+PERF_DB = BASE_DIR / "logs" / "perf.sqlite"
+DEFAULT_RETENTION_DAYS = 90
+
+_LOCK = threading.Lock()
+_DB = None
+_FIELDS = ["ts", "model", "backend", "path", "prompt_tokens", "gen_tokens", "prompt_tps",
+           "gen_tps", "ttft", "wall_s", "cached_tokens", "cache_hit", "draft_acceptance"]
+
+
+def enabled():
+    return str(config_cache.load().get("perf_store", "on")).lower() in ["on", "true", "1", "yes", "tak"]
+
+
+def _connect():
+    """Jedno polaczenie na proces (uzywane tylko pod _LOCK); schemat tworzony raz."""
+    global _DB
+    if _DB is not None:
+        return _DB
+    PERF_DB.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(PERF_DB), timeout=5, check_same_thread=False)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS inferences ("
+        "ts REAL, model TEXT, backend TEXT, path TEXT, prompt_tokens INTEGER, gen_tokens INTEGER, "
+        "prompt_tps REAL, gen_tps REAL, ttft REAL, wall_s REAL, cached_tokens INTEGER, "
+        "cache_hit INTEGER, draft_acceptance REAL)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_inferences_model_ts ON inferences(model, ts)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_inferences_ts ON inferences(ts)")
+    _DB = db
+    return db
+
+
+def _drop():
+    """Po bledzie (np. usuniety plik bazy) kolejne wywolanie otwiera polaczenie od nowa."""
+    global _DB
+    if _DB is not None:
+        try:
+            _DB.close()
+        except Exception:
+            pass
+    _DB = None
+
+
+def record(stats, model=None, backend=None, path="local"):
+    """Dopisuje jeden wiersz; stats w formacie LAST_STATS (brakujace pola = NULL)."""
+    if not enabled():
+        return
+    stats = stats or {}
+    row = {
+        "ts": time.time(),
+        "model": model or stats.get("model") or "",
+        "backend": backend or stats.get("backend") or "",
+        "path": path,
+        "prompt_tokens": stats.get("prompt_tokens"),
+        "gen_tokens": stats.get("gen_tokens"),
+        "prompt_tps": stats.get("prompt_tps"),
+        "gen_tps": stats.get("gen_tps"),
+        "ttft": stats.get("ttft"),
+        "wall_s": stats.get("wall_s"),
+        "cached_tokens": stats.get("cached_tokens"),
+        "cache_hit": 1 if stats.get("cache_hit") else 0,
+        "draft_acceptance": stats.get("draft_acceptance"),
+    }
+    try:
+        with _LOCK:
+            db = _connect()
+            db.execute(
+                f"INSERT INTO inferences({', '.join(_FIELDS)}) VALUES({', '.join('?' for _ in _FIELDS)})",
+                [row[f] for f in _FIELDS],
+            )
+            db.commit()
+    except Exception:
+        with _LOCK:
+            _drop()
+
+
+def parse_since(text):
+    """'30m' | '24h' | '7d' | '2w' | 'RRRR-MM-DD' -> znacznik czasu (None = bez limitu)."""
+    if not text:
+        return None
+    text = text.strip().lower()
+    m = re.fullmatch(r"(\d+)\s*(m|min|h|d|w)", text)
+    if m:
+        mult = {"m": 60, "min": 60, "h": 3600, "d": 86400, "w": 7 * 86400}[m.group(2)]
+        return time.time() - int(m.group(1)) * mult
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except Exception:
+        return None
+
+
+def prune(days=None):
+    try:
+        days = int(days or config_cache.load().get("perf_retention_days", DEFAULT_RETENTION_DAYS))
+    except Exception:
+        days = DEFAULT_RETENTION_DAYS
+    try:
+        with _LOCK:
+            db = _connect()
+            cur = db.execute("DELETE FROM inferences WHERE ts < ?", (time.time() - days * 86400,))
+            db.commit()
+            return cur.rowcount or 0
+    except Exception:
+        with _LOCK:
+            _drop()
+        return 0
+
+
+def query(model=None, since=None):
+    sql = f"SELECT {', '.join(_FIELDS)} FROM inferences WHERE 1=1"
+    args = []
+    if model:
+        sql += " AND model LIKE ?"
+        args.append(f"%{model}%")
+    if since:
+        sql += " AND ts >= ?"
+        args.append(since)
+    sql += " ORDER BY ts"
+    try:
+        with _LOCK:
+            db = _connect()
+            return [dict(zip(_FIELDS, r)) for r in db.execute(sql, args).fetchall()]
+    except Exception:
+        with _LOCK:
+            _drop()
+        return []
+
+
+def percentile(values, pct):
+    """Percentyl metoda najblizszej rangi."""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(values) + 0.4999)))
+    return values[min(rank, len(values)) - 1]
+
+
+def _fmt(value, digits=1, suffix=""):
+    return "-" if value is None else f"{value:.{digits}f}{suffix}"
+
+
+def _fmt_pct(value):
+    return "-" if value is None else f"{value:+.0f}%"
+
+
+def _trend(rows, field):
+    """Zmiana mediany pola miedzy pierwsza a druga polowa okna (w %)."""
+    values = [r[field] for r in rows if r.get(field) is not None]
+    if len(values) < 6:
+        return None
+    half = len(values) // 2
+    old, new = percentile(values[:half], 50), percentile(values[half:], 50)
+    if not old:
+        return None
+    return (new - old) / old * 100.0
+
+
+def format_report(model=None, since_text=None):
+    since = parse_since(since_text)
+    prune()
+    rows = query(model, since)
+    scope = f"model~{model}" if model else "wszystkie modele"
+    scope += f", od {since_text}" if since else ""
+    if not rows:
+        return f"Perf ({scope}): brak pomiarow."
+    lines = [f"Perf ({scope}): {len(rows)} zapytan"]
+    groups = {}
+    for r in rows:
+        groups.setdefault((r["model"] or "?", r["backend"] or "?"), []).append(r)
+    for (name, backend), items in sorted(groups.items(), key=lambda kv: -len(kv[1])):
+        gen = [r["gen_tps"] for r in items]
+        ttft = [r["ttft"] for r in items]
+        wall = [r["wall_s"] for r in items]
+        hits = sum(1 for r in items if r["cache_hit"])
+        paths = {}
+        for r in items:
+            paths[r["path"]] = paths.get(r["path"], 0) + 1
+        lines.append(f"- {name} [{backend}] n={len(items)} | cache {hits / len(items) * 100:.0f}% | "
+                     + ", ".join(f"{p} {c}" for p, c in sorted(paths.items(), key=lambda kv: -kv[1])))
+        # Dla t/s ogon to najwolniejsze zapytania, wiec p95/p99 licza od dolu.
+        lines.append(f"    G t/s  p50 {_fmt(percentile(gen, 50))} | p95 {_fmt(percentile(gen, 5))} | "
+                     f"p99 {_fmt(percentile(gen, 1))}")
+        lines.append(f"    TTFT   p50 {_fmt(percentile(ttft, 50), 2, 's')} | p95 {_fmt(percentile(ttft, 95), 2, 's')} | "
+                     f"p99 {_fmt(percentile(ttft, 99), 2, 's')}")
+        lines.append(f"    Czas   p50 {_fmt(percentile(wall, 50), 2, 's')} | p95 {_fmt(percentile(wall, 95), 2, 's')} | "
+                     f"p99 {_fmt(percentile(wall, 99), 2, 's')}")
+        trend_gen = _trend(items, "gen_tps")
+        trend_ttft = _trend(items, "ttft")
+        if trend_gen is not None or trend_ttft is not None:
+            lines.append(f"    Trend  G {_fmt_pct(trend_gen)} | TTFT {_fmt_pct(trend_ttft)} "
+                         f"(mediana 2. polowy okna vs 1.)")
+    return "\n".join(lines)
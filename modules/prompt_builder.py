@@ -0,0 +1,52 @@
+import hashlib
+import zlib
+
+# =========================================================
+# PROMPT BUILDER – skladanie promptu od najbardziej stalych
+# segmentow do najbardziej zmiennych, zeby llama-server mogl
+# ponownie uzyc KV cache wspolnego prefiksu
+# =========================================================
+
+# Kolejnosc = stabilnosc (od najrzadziej zmienianych).
+SEGMENTS = [
+    ("system", ""),
+    ("soul", ""),
+    ("memory", "PAMIEC LYRY:\n"),
+    ("recent", ""),
+    ("history", "KONTEKST LOKALNY:\n"),
+    # Fakty dobrane do pytania – zmienne co ture, wiec za prefiksem.
+    ("related", ""),
+]
+# Segmenty wchodzace do hasha prefiksu (zmieniaja sie rzadko).
+STABLE_SEGMENTS = ("system", "soul", "memory")
+
+
+def assemble_prompt(question, question_label="Zapytanie: ", **parts):
+    """
+    Sklada prompt: system -> dusza -> pamiec dluga -> pamiec biezaca -> historia -> pamiec do pytania -> pytanie.
+    Zwraca dict: prompt, prefix (stala czesc), prefix_hash.
+    """
+    blocks = []
+    stable = []
+    for name, label in SEGMENTS:
+        text = (parts.get(name) or "").strip()
+        if not text:
+            continue
+        block = f"{label}{text}"
+        blocks.append(block)
+        if name in STABLE_SEGMENTS:
+            stable.append(block)
+    blocks.append(f"{question_label}{question}")
+    prefix = "\n\n".join(stable)
+    return {
+        "prompt": "\n\n".join(blocks),
+        "prefix": prefix,
+        "prefix_hash": hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16] if prefix else "",
+    }
+
+
+def session_slot(session, slots):
+    """Staly slot llama-server dla sesji (ten sam we wszystkich procesach)."""
+    if not session or not slots or slots < 1:
+        return None
+    return zlib.crc32(str(session).encode("utf-8")) % int(slots)
@@ -0,0 +1,293 @@
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+from modules import config_cache
+from modules import connection_manager as conn
+from modules import llama_pool
+from modules import llama_probe
+
+# =========================================================
+# REQUEST SCHEDULER – kolejka priorytetowa przed lokalnym
+# modelem: interactive > background > bulk, limit glebokosci,
+# starzenie (fair sharing) i wywlaszczanie nizszych klas
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+STATS_PATH = BASE_DIR / "logs" / "scheduler_stats.json"
+
+PRIORITIES = {"interactive": 0, "background": 1, "bulk": 2}
+DEFAULT_PRIORITY = "interactive"
+DEFAULT_MAX_QUEUE = 32
+# Co tyle sekund czekania zlecenie awansuje o jedna klase (nigdy do interactive).
+AGING_SEC = 5.0
+MAX_REQUEUE = 3
+WAIT_WINDOW = 50
+# Pojemnosc (config + probe serwera) liczona poza lockiem i trzymana krotko w pamieci.
+CAPACITY_TTL = 2.0
+
+_CAPACITY = {"value": None, "at": 0.0}
+
+
+class SchedulerBusy(Exception):
+    """Kolejka danej klasy jest pelna."""
+
+
+class Preempted(Exception):
+    """Zlecenie przerwane na rzecz zapytania o wyzszym priorytecie."""
+
+
+def normalize_priority(priority):
+    value = str(priority or DEFAULT_PRIORITY).lower()
+    return value if value in PRIORITIES else DEFAULT_PRIORITY
+
+
+def _max_queue():
+    try:
+        return max(1, int(config_cache.load().get("scheduler_max_queue", DEFAULT_MAX_QUEUE)))
+    except Exception:
+        return DEFAULT_MAX_QUEUE
+
+
+def _preempt_enabled():
+    return str(config_cache.load().get("scheduler_preempt", "on")).lower() in ["on", "true", "1", "yes", "tak"]
+
+
+def _read_capacity():
+    """Sloty wszystkich instancji lokalnego serwera (moze pytac serwer – nigdy pod lockiem)."""
+    backend = str(config_cache.load().get("local_backend") or "ollama").lower()
+    if backend.startswith("llama"):
+        caps = llama_probe.get_capabilities() or {}
+        slots = int(caps.get("slots") or conn.parallel_slots("llama"))
+        return max(1, slots) * max(1, len(llama_pool.instances()))
+    return conn.parallel_slots("ollama")
+
+
+def _capacity():
+    now = time.time()
+    if _CAPACITY["value"] is None or now - _CAPACITY["at"] > CAPACITY_TTL:
+        try:
+            _CAPACITY["value"] = _read_capacity()
+        except Exception:
+            _CAPACITY["value"] = _CAPACITY["value"] or 1
+        _CAPACITY["at"] = now
+    return _CAPACITY["value"]
+
+
+class Ticket:
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.rank = PRIORITIES[priority]
+        self.seq = seq
+        self.enqueued = time.time()
+        self.started = None
+        self.cancel_event = threading.Event()
+        self.preempted = False
+        self.granted = threading.Event()
+
+    def effective_rank(self, now):
+        if self.rank == 0:
+            return 0
+        aged = int((now - self.enqueued) / AGING_SEC)
+        return max(1, self.rank - aged)
+
+
+class Scheduler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._running = []
+        self._seq = itertools.count()
+        self._waits = {name: deque(maxlen=WAIT_WINDOW) for name in PRIORITIES}
+        self._counts = {name: 0 for name in PRIORITIES}
+        self._preemptions = 0
+        self._last_save = 0.0
+
+    def _queued(self, priority):
+        return sum(1 for t in self._waiting if t.priority == priority)
+
+    def _dispatch(self, capacity):
+        """Przydziela wolne sloty czekajacym (wywolywane pod lockiem, capacity liczone przed nim)."""
+        free = capacity - len(self._running)
+        if free <= 0 or not self._waiting:
+            return
+        now = time.time()
+        order = sorted(self._waiting, key=lambda t: (t.effective_rank(now), t.seq))
+        for ticket in order[:free]:
+            self._waiting.remove(ticket)
+            ticket.started = now
+            self._running.append(ticket)
+            self._record_wait(ticket.priority, now - ticket.enqueued)
+            ticket.granted.set()
+
+    def _preempt_for(self, ticket, capacity, preempt):
+        """Interaktywne zapytanie bez wolnego slotu przerywa najmlodsze zlecenie najnizszej klasy."""
+        if ticket.rank != 0 or not preempt:
+            return
+        if len(self._running) < capacity:
+            return
+        victims = [t for t in self._running if t.rank > 0 and not t.cancel_event.is_set()]
+        if not victims:
+            return
+        victim = max(victims, key=lambda t: (t.rank, t.started or 0))
+        victim.preempted = True
+        victim.cancel_event.set()
+        self._preemptions += 1
+
+    def _record_wait(self, priority, seconds):
+        self._waits[priority].append(seconds)
+        self._counts[priority] += 1
+
+    def enqueue(self, priority=None):
+        """Wstawia zlecenie do kolejki bez czekania; przydzial sygnalizuje ticket.granted."""
+        priority = normalize_priority(priority)
+        max_queue, preempt, capacity = _max_queue(), _preempt_enabled(), _capacity()
+        with self._lock:
+            if self._queued(priority) >= max_queue:
+                raise SchedulerBusy(f"kolejka {priority} pelna")
+            ticket = Ticket(priority, next(self._seq))
+            self._waiting.append(ticket)
+            self._preempt_for(ticket, capacity, preempt)
+            self._dispatch(capacity)
+        return ticket
+
+    def poll(self, ticket, timeout=None):
+        """
+        Jeden krok czekania (bez blokowania): True = slot przydzielony. Po `timeout`
+        sekund od wstawienia zlecenie wypada z kolejki z SchedulerBusy.
+        """
+        if ticket.granted.is_set():
+            return True
+        capacity = _capacity()
+        with self._lock:
+            if ticket.granted.is_set():
+                return True
+            if timeout is not None and time.time() - ticket.enqueued > timeout:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                raise SchedulerBusy(f"przekroczono czas oczekiwania ({ticket.priority})")
+            # Starzenie moglo zmienic kolejnosc – ponowny przydzial.
+            self._dispatch(capacity)
+            return ticket.granted.is_set()
+
+    def acquire(self, priority=None, timeout=None):
+        ticket = self.enqueue(priority)
+        while not ticket.granted.wait(0.1):
+            if self.poll(ticket, timeout):
+                break
+        return ticket
+
+    def release(self, ticket):
+        """Zwalnia slot; zlecenie jeszcze czekajace (porzucone) po prostu wypada z kolejki."""
+        capacity = _capacity()
+        with self._lock:
+            if ticket in self._running:
+                self._running.remove(ticket)
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+            self._dispatch(capacity)
+        self._maybe_save()
+
+    def run(self, fn, priority=None, timeout=None):
+        """
+        Wykonuje fn(cancel_event) w slocie danej klasy. Zlecenie wywlaszczone
+        (fn rzuca wyjatek przy ustawionym cancel_event) wraca do kolejki.
+        """
+        for attempt in range(MAX_REQUEUE + 1):
+            ticket = self.acquire(priority, timeout=timeout)
+            try:
+                return fn(ticket.cancel_event)
+            except Exception:
+                if not ticket.preempted or attempt >= MAX_REQUEUE:
+                    raise
+            finally:
+                self.release(ticket)
+        raise Preempted(normalize_priority(priority))
+
+    def wait_stats(self):
+        with self._lock:
+            out = {}
+            for name, waits in self._waits.items():
+                out[name] = {
+                    "avg": (sum(waits) / len(waits)) if waits else None,
+                    "last": waits[-1] if waits else None,
+                    "count": self._counts[name],
+                    "queued": self._queued(name),
+                    "running": sum(1 for t in self._running if t.priority == name),
+                }
+            out["preemptions"] = self._preemptions
+            return out
+
+    def _maybe_save(self):
+        now = time.time()
+        if now - self._last_save < 1.0:
+            return
+        self._last_save = now
+        try:
+            data = self.wait_stats()
+            data["saved_at"] = now
+            STATS_PATH.parent.mkdir(parents=True, exist_ok=True)
+            STATS_PATH.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        except Exception:
+            pass
+
+
+SCHEDULER = Scheduler()
+
+
+def run(fn, priority=None, timeout=None):
+    return SCHEDULER.run(fn, priority, timeout)
+
+
+def acquire(priority=None, timeout=None):
+    return SCHEDULER.acquire(priority, timeout)
+
+
+def enqueue(priority=None):
+    return SCHEDULER.enqueue(priority)
+
+
+def poll(ticket, timeout=None):
+    return SCHEDULER.poll(ticket, timeout)
+
+
+def release(ticket):
+    SCHEDULER.release(ticket)
+
+
+def wait_stats():
+    """Statystyki tego procesu; gdy puste – ostatni zapis z logs/scheduler_stats.json."""
+    stats = SCHEDULER.wait_stats()
+    if any(stats[name]["count"] for name in PRIORITIES):
+        return stats
+    try:
+        if STATS_PATH.exists():
+            return json.loads(STATS_PATH.read_text(encoding="utf-8"))
+    except Exception:
+        pass
+    return stats
+
+
+def format_waits(stats=None):
+    """Krotka linia do banera: sredni czas oczekiwania per klasa."""
+    stats = stats or wait_stats()
+    labels = {"interactive": "I", "background": "B", "bulk": "Bulk"}
+    parts = []
+    for name in PRIORITIES:
+        item = stats.get(name) or {}
+        if not item.get("count"):
+            continue
+        avg = item.get("avg") or 0.0
+        part = f"{labels[name]} {avg:.1f}s".replace(".", ",")
+        if item.get("queued"):
+            part += f" ({item['queued']} w kolejce)"
+        parts.append(part)
+    if not parts:
+        return ""
+    text = "Kolejka: " + " | ".join(parts)
+    if stats.get("preemptions"):
+        text += f" | wywlaszczone {stats['preemptions']}"
+    return text
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from modules import config_cache
+
+# =========================================================
+# RESPONSE CACHE – trwaly cache odpowiedzi modeli (SQLite)
+# klucz = hash(prompt, model, backend, parametry probkowania)
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+CACHE_DB = BASE_DIR / "logs" / "response_cache.sqlite"
+DEFAULT_TTL_SEC = 7 * 24 * 3600
+DEFAULT_MAX_MB = 50
+
+_LOCK = threading.Lock()
+_COUNTERS = {"hits": 0, "misses": 0, "stores": 0, "evicted": 0}
+
+
+def enabled(call_config=None):
+    """Globalnie: config.json response_cache on/off; per wywolanie: config={'cache': False}."""
+    if call_config and call_config.get("cache") is False:
+        return False
+    val = str(config_cache.load().get("response_cache", "on")).lower()
+    return val in ["on", "true", "1", "yes", "tak"]
+
+
+def _limits():
+    cfg = config_cache.load()
+    try:
+        ttl = int(cfg.get("response_cache_ttl_sec", DEFAULT_TTL_SEC))
+    except Exception:
+        ttl = DEFAULT_TTL_SEC
+    try:
+        max_bytes = int(float(cfg.get("response_cache_max_mb", DEFAULT_MAX_MB)) * 1024 * 1024)
+    except Exception:
+        max_bytes = DEFAULT_MAX_MB * 1024 * 1024
+    return ttl, max_bytes
+
+
+def _connect():
+    CACHE_DB.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(CACHE_DB), timeout=5)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS entries ("
+        "key TEXT PRIMARY KEY, response TEXT, model TEXT, backend TEXT, "
+        "created REAL, last_access REAL, size INTEGER, hits INTEGER DEFAULT 0)"
+    )
+    db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries(last_access)")
+    return db
+
+
+def make_key(prompt, model, backend, params=None):
+    raw = json.dumps(
+        {"prompt": prompt, "model": model or "", "backend": backend or "", "params": params or {}},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _bump(db, name, n=1):
+    _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+    db.execute(
+        "INSERT INTO counters(name, value) VALUES(?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        (name, n),
+    )
+
+
+def get(key):
+    ttl, _ = _limits()
+    now = time.time()
+    try:
+        with _LOCK:
+            db = _connect()
+            try:
+                row = db.execute("SELECT response, created FROM entries WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] <= ttl:
+                    db.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+                    _bump(db, "hits")
+                    db.commit()
+                    return row[0]
+                if row:
+                    db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    _bump(db, "evicted")
+                _bump(db, "misses")
+                db.commit()
+            finally:
+                db.close()
+    except Exception:
+        pass
+    return None
+
+
+def put(key, response, model=None, backend=None):
+    if not response:
+        return
+    ttl, max_bytes = _limits()
+    now = time.time()
+    size = len(response.encode("utf-8"))
+    try:
+        with _LOCK:
+            db = _connect()
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO entries(key, response, model, backend, created, last_access, size, hits) "
+                    "VALUES(?, ?, ?, ?, ?, ?, ?, 0)",
+                    (key, response, model or "", backend or "", now, now, size),
+                )
+                _bump(db, "stores")
+                cur = db.execute("DELETE FROM entries WHERE created < ?", (now - ttl,))
+                evicted = cur.rowcount or 0
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                if total > max_bytes:
+                    # LRU: usuwamy najdawniej uzywane wpisy az zmiescimy sie w limicie.
+                    for old_key, old_size in db.execute(
+                        "SELECT key, size FROM entries ORDER BY last_access ASC"
+                    ).fetchall():
+                        if total <= max_bytes:
+                            break
+                        db.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                        total -= old_size or 0
+                        evicted += 1
+                if evicted:
+                    _bump(db, "evicted", evicted)
+                db.commit()
+            finally:
+                db.close()
+    except Exception:
+        pass
+
+
+def stats():
+    out = {"entries": 0, "size_bytes": 0, "session": dict(_COUNTERS), "total": {}}
+    try:
+        with _LOCK:
+            db = _connect()
+            try:
+                count, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+                out["entries"] = count
+                out["size_bytes"] = size
+                out["total"] = {name: value for name, value in db.execute("SELECT name, value FROM counters")}
+            finally:
+                db.close()
+    except Exception:
+        pass
+    return out
+
+
+def clear():
+    try:
+        with _LOCK:
+            db = _connect()
+            try:
+                count = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                db.execute("DELETE FROM entries")
+                db.execute("DELETE FROM counters")
+                db.commit()
+            finally:
+                db.close()
+            for name in _COUNTERS:
+                _COUNTERS[name] = 0
+        return count
+    except Exception:
+        return 0
+
+
+def format_stats():
+    st = stats()
+    total = st.get("total") or {}
+    hits = total.get("hits", 0)
+    misses = total.get("misses", 0)
+    ratio = (hits / (hits + misses) * 100.0) if (hits + misses) else 0.0
+    session = st.get("session") or {}
+    lines = [
+        "Cache odpowiedzi:",
+        f"- Wpisy: {st['entries']} ({st['size_bytes'] / 1024:.1f} KB)",
+        f"- Trafienia: {hits} | Chybienia: {misses} | Skutecznosc: {ratio:.1f}%",
+        f"- Zapisane: {total.get('stores', 0)} | Usuniete (LRU/TTL): {total.get('evicted', 0)}",
+        f"- Ta sesja: {session.get('hits', 0)} trafien / {session.get('misses', 0)} chybien",
+        f"- Plik: {CACHE_DB}",
+    ]
+    return "\n".join(lines)
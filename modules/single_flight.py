@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+
+from modules import config_cache
+
+# =========================================================
+# SINGLE FLIGHT – identyczne zapytania w locie (ten sam hash
+# promptu, model, parametry) dolaczaja do jednego wywolania
+# backendu i dostaja jego wynik; liczniki zaoszczedzonej pracy
+# =========================================================
+
+
+def enabled():
+    return str(config_cache.load().get("single_flight", "on")).lower() in ["on", "true", "1", "yes", "tak"]
+
+
+_RETRY = object()
+# Krok sprawdzania wyniku lidera przez czekajace korutyny.
+ASYNC_POLL_SEC = 0.05
+_ALWAYS_RETRY = (KeyboardInterrupt, asyncio.CancelledError)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.elapsed = 0.0
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {"leaders": 0, "coalesced": 0, "saved_s": 0.0, "max_group": 1}
+
+    def _join(self, key):
+        """(wywolanie, czy_lider) – pierwsze wywolanie z kluczem zostaje liderem."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self._counters["leaders"] += 1
+                return call, True
+            call.followers += 1
+            self._counters["coalesced"] += 1
+            self._counters["max_group"] = max(self._counters["max_group"], call.followers + 1)
+            return call, False
+
+    def _finish(self, key, call, start):
+        call.elapsed = time.monotonic() - start
+        with self._lock:
+            self._calls.pop(key, None)
+        call.done.set()
+
+    def _shared(self, call, retry_on):
+        """Wynik lidera dla dolaczonego; _RETRY, gdy lider zostal przerwany (anulowanie, wywlaszczenie)."""
+        if call.error is not None:
+            # Przerwanie dotyczylo lidera, nie dolaczonych – ci ponawiaja zapytanie sami.
+            if isinstance(call.error, _ALWAYS_RETRY + tuple(retry_on)):
+                return _RETRY
+            raise call.error
+        with self._lock:
+            self._counters["saved_s"] += call.elapsed
+        return call.result
+
+    def do(self, key, fn, timeout=None, retry_on=()):
+        """
+        Wywoluje fn() raz na klucz; rownolegle wywolania z tym samym kluczem czekaja
+        na wynik (lub wyjatek) pierwszego. TimeoutError, gdy czekajacy nie doczeka sie.
+        Wyjatek z retry_on (oraz Ctrl-C/anulowanie) lidera nie przechodzi na dolaczonych.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                break
+            remaining = None if end is None else max(0.0, end - time.monotonic())
+            if not call.done.wait(remaining):
+                raise TimeoutError("oczekiwanie na identyczne zapytanie")
+            result = self._shared(call, retry_on)
+            if result is not _RETRY:
+                return result
+        start = time.monotonic()
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call, start)
+
+    async def do_async(self, key, coro_fn, timeout=None, retry_on=()):
+        """do() dla korutyn: ta sama tabela, wiec sciezka async i synchroniczna lacza sie ze soba."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                break
+            # Czekanie w petli zdarzen, nie w watku puli – watki sa potrzebne liderowi.
+            while not call.done.is_set():
+                if end is not None and time.monotonic() >= end:
+                    raise TimeoutError("oczekiwanie na identyczne zapytanie")
+                await asyncio.sleep(ASYNC_POLL_SEC)
+            result = self._shared(call, retry_on)
+            if result is not _RETRY:
+                return result
+        start = time.monotonic()
+        try:
+            call.result = await coro_fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call, start)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._counters)
+            out["in_flight"] = len(self._calls)
+            return out
+
+
+GROUP = SingleFlight()
+
+
+def do(key, fn, timeout=None, retry_on=()):
+    if not enabled() or key is None:
+        return fn()
+    return GROUP.do(key, fn, timeout, retry_on)
+
+
+async def do_async(key, coro_fn, timeout=None, retry_on=()):
+    if not enabled() or key is None:
+        return await coro_fn()
+    return await GROUP.do_async(key, coro_fn, timeout, retry_on)
+
+
+def stats():
+    return GROUP.stats()
+
+
+def format_stats():
+    st = stats()
+    total = st["leaders"] + st["coalesced"]
+    ratio = (st["coalesced"] / total * 100.0) if total else 0.0
+    return (f"Single-flight: {st['coalesced']}/{total} zapytan dolaczonych do trwajacych ({ratio:.1f}%) | "
+            f"zaoszczedzone ~{st['saved_s']:.1f}s backendu | max grupa {st['max_group']} | w locie {st['in_flight']}")
@@ -0,0 +1,168 @@
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+from modules import config_cache
+from modules import connection_manager as conn
+from modules import llama_supervisor
+from modules.prompt_builder import session_slot
+
+# =========================================================
+# SLOT STORE – trwaly KV cache sesji: llama-server zapisuje
+# slot sesji po kazdej turze (--slot-save-path), a po restarcie
+# procesu/serwera slot wraca z pliku, gdy zgadza sie hash
+# prefiksu; pliki sprzatane LRU do limitu rozmiaru
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_SLOT_DIR = BASE_DIR / "logs" / "llama_slots"
+DEFAULT_MAX_MB = 4096
+
+_LOCK = threading.Lock()
+# (base, model, sesja) -> (instancja serwera, prefix_hash) po ostatniej turze w tym procesie.
+_PREPARED = {}
+_SAVING = set()
+
+
+def enabled():
+    return str(config_cache.load().get("llama_slot_persist", "on")).lower() in ["on", "true", "1", "yes", "tak"]
+
+
+def slot_dir():
+    return Path(config_cache.load().get("llama_slot_dir") or DEFAULT_SLOT_DIR).expanduser()
+
+
+def server_args():
+    """Argumenty llama-server wlaczajace zapis/odczyt slotow."""
+    if not enabled():
+        return []
+    path = slot_dir()
+    path.mkdir(parents=True, exist_ok=True)
+    return ["--slot-save-path", str(path)]
+
+
+def _safe(text):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", str(text or ""))[:48] or "_"
+
+
+def filename(session, model, prefix_hash):
+    """Nazwa pliku (bez katalogu – llama-server przyjmuje tylko nazwe w --slot-save-path)."""
+    return f"{_safe(session)}-{_safe(Path(str(model or '')).name)}-{_safe(prefix_hash)}.bin"
+
+
+def _slot_request(base, slot, action, name, timeout):
+    r = conn.post("llama", f"/slots/{slot}?action={action}", base_url=base, json={"filename": name}, timeout=timeout)
+    return r.status_code == 200
+
+
+def _instance(base):
+    """Tozsamosc procesu llama-server pod adresem (start nadzorcy + pid dziecka); bez nadzoru – (None, None)."""
+    try:
+        data = llama_supervisor.state(urlparse(base).port) or {}
+    except Exception:
+        data = {}
+    return data.get("started_at"), data.get("child_pid")
+
+
+def forget():
+    """Po utracie serwera (llama_probe.invalidate) kolejna tura kazdej sesji znow przywraca slot."""
+    with _LOCK:
+        _PREPARED.clear()
+
+
+def before_turn(base, caps, session, prefix_hash):
+    """
+    Pierwsza tura sesji na danej instancji serwera w tym procesie (takze po restarcie
+    llama-server): przywraca zapisany slot, jesli istnieje plik dla tego modelu i hasha prefiksu.
+    """
+    if not session or not prefix_hash or not enabled():
+        return False
+    slot = session_slot(session, caps.get("slots") or 1)
+    if slot is None:
+        return False
+    key = (base, caps.get("model"), session)
+    marker = (_instance(base), prefix_hash)
+    with _LOCK:
+        if _PREPARED.get(key) == marker:
+            return False
+        _PREPARED[key] = marker
+    name = filename(session, caps.get("model"), prefix_hash)
+    path = slot_dir() / name
+    if not path.exists():
+        return False
+    try:
+        ok = _slot_request(base, slot, "restore", name, timeout=30)
+    except Exception:
+        return False
+    if ok:
+        try:
+            os.utime(path)
+        except Exception:
+            pass
+    return ok
+
+
+def after_turn(base, caps, session, prefix_hash):
+    """Po udanej turze zapisuje slot sesji w tle (najwyzej jeden zapis na sesje naraz)."""
+    if not session or not prefix_hash or not enabled():
+        return
+    slot = session_slot(session, caps.get("slots") or 1)
+    if slot is None:
+        return
+    key = (base, caps.get("model"), session)
+    marker = (_instance(base), prefix_hash)
+    with _LOCK:
+        if key in _SAVING:
+            return
+        _SAVING.add(key)
+        _PREPARED[key] = marker
+
+    def _save():
+        try:
+            _slot_request(base, slot, "save", filename(session, caps.get("model"), prefix_hash), timeout=60)
+            cleanup()
+        except Exception:
+            pass
+        finally:
+            with _LOCK:
+                _SAVING.discard(key)
+
+    threading.Thread(target=_save, daemon=True).start()
+
+
+def cleanup(max_mb=None):
+    """Usuwa najdawniej uzywane pliki slotow, az suma zmiesci sie w llama_slot_cache_mb."""
+    try:
+        max_mb = int(max_mb or config_cache.load().get("llama_slot_cache_mb", DEFAULT_MAX_MB))
+    except Exception:
+        max_mb = DEFAULT_MAX_MB
+    try:
+        files = [(p.stat().st_mtime, p.stat().st_size, p) for p in slot_dir().glob("*.bin")]
+    except Exception:
+        return 0
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files, key=lambda item: item[0]):
+        if total <= max_mb * 1024 * 1024:
+            break
+        try:
+            path.unlink()
+            total -= size
+            removed += 1
+        except Exception:
+            pass
+    return removed
+
+
+def format_status():
+    files = sorted(slot_dir().glob("*.bin"), key=lambda p: -p.stat().st_mtime) if slot_dir().exists() else []
+    total = sum(p.stat().st_size for p in files)
+    lines = [f"Sloty KV (llama-server): {'ON' if enabled() else 'OFF'} | {len(files)} plikow, "
+             f"{total / 1024 ** 2:.0f} MB | {slot_dir()}"]
+    for path in files[:10]:
+        age = (time.time() - path.stat().st_mtime) / 60
+        lines.append(f"- {path.name}: {path.stat().st_size / 1024 ** 2:.0f} MB, {age:.0f} min temu")
+    return "\n".join(lines)
@@ -0,0 +1,147 @@
+import json
+import re
+
+# =========================================================
+# STRUCTURED OUTPUT – ograniczone generowanie: JSON schema
+# albo gramatyka GBNF tlumaczona per backend (llama-server
+# json_schema/grammar, Ollama format) + parsowanie wyniku
+# =========================================================
+
+# Odpowiedz JSON jest dluzsza niz luzny tekst – domyslne n_predict=256 ucinaloby obiekt.
+MIN_PREDICT = 1024
+
+_FENCE = re.compile(r"^```(?:json)?\s*(.*?)\s*```$", re.DOTALL)
+
+
+class StructuredOutputError(Exception):
+    """Model nie zwrocil poprawnego obiektu; `raw` to surowa odpowiedz (lub komunikat bledu)."""
+
+    def __init__(self, message, raw=None):
+        super().__init__(message)
+        self.raw = raw
+
+
+def from_config(config):
+    """{'schema': dict} | {'grammar': str} z config wywolania albo None (zwykly tekst)."""
+    cfg = config or {}
+    schema = cfg.get("schema")
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    if schema:
+        return {"schema": schema}
+    if cfg.get("grammar"):
+        return {"grammar": str(cfg["grammar"])}
+    return None
+
+
+def llama_fields(constraint, dialect=None):
+    """Pola zapytania llama-server (wszystkie dialekty przyjmuja json_schema/grammar)."""
+    if not constraint:
+        return {}
+    fields = {"temperature": 0.2}
+    if constraint.get("schema"):
+        fields["json_schema"] = constraint["schema"]
+    else:
+        fields["grammar"] = constraint["grammar"]
+    if dialect == "completion":
+        fields["n_predict"] = MIN_PREDICT
+    else:
+        fields["max_tokens"] = MIN_PREDICT
+    return fields
+
+
+def ollama_fields(constraint):
+    """Pola zapytania Ollama: format = schemat JSON. GBNF Ollama nie obsluguje – StructuredOutputError."""
+    if not constraint:
+        return {}
+    if not constraint.get("schema"):
+        raise StructuredOutputError("Ollama nie obsluguje gramatyki GBNF (uzyj schema albo llama-server)")
+    return {"format": constraint["schema"], "options": {"temperature": 0.2, "num_predict": MIN_PREDICT}}
+
+
+def cloud_prompt(prompt, constraint):
+    """Chmura nie dostaje gramatyki – schemat trafia do tresci polecenia."""
+    if not constraint:
+        return prompt
+    if constraint.get("schema"):
+        spec = json.dumps(constraint["schema"], ensure_ascii=False)
+        return f"{prompt}\n\nOdpowiedz wylacznie obiektem JSON zgodnym ze schematem:\n{spec}"
+    return f"{prompt}\n\nOdpowiedz wylacznie w formacie opisanym gramatyka GBNF:\n{constraint['grammar']}"
+
+
+def _extract_json(text):
+    text = (text or "").strip()
+    m = _FENCE.match(text)
+    if m:
+        text = m.group(1)
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    # Backend bez ograniczen (np. chmura) moze dodac tekst wokol obiektu.
+    start = min([i for i in (text.find("{"), text.find("[")) if i >= 0], default=-1)
+    if start < 0:
+        raise ValueError("brak obiektu JSON")
+    obj, _ = json.JSONDecoder().raw_decode(text[start:])
+    return obj
+
+
+_TYPES = {
+    "object": dict, "array": list, "string": str, "boolean": bool,
+    "integer": int, "number": (int, float), "null": type(None),
+}
+
+
+def validate(obj, schema, path="$"):
+    """Podzbior JSON schema (type, enum, const, required, properties, items, min/maxItems, minLength, pattern)."""
+    if not isinstance(schema, dict):
+        return []
+    errors = []
+    expected = schema.get("type")
+    if expected:
+        types = expected if isinstance(expected, list) else [expected]
+        ok = any(isinstance(obj, _TYPES.get(t, object)) and not (t in ["integer", "number"] and isinstance(obj, bool))
+                 for t in types)
+        if not ok:
+            return [f"{path}: oczekiwano {expected}"]
+    if "const" in schema and obj != schema["const"]:
+        errors.append(f"{path}: oczekiwano {schema['const']!r}")
+    if "enum" in schema and obj not in schema["enum"]:
+        errors.append(f"{path}: wartosc spoza {schema['enum']}")
+    if isinstance(obj, dict):
+        for key in schema.get("required", []):
+            if key not in obj:
+                errors.append(f"{path}.{key}: brak pola")
+        for key, sub in (schema.get("properties") or {}).items():
+            if key in obj:
+                errors.extend(validate(obj[key], sub, f"{path}.{key}"))
+    if isinstance(obj, list):
+        if "minItems" in schema and len(obj) < schema["minItems"]:
+            errors.append(f"{path}: za malo elementow ({len(obj)} < {schema['minItems']})")
+        if "maxItems" in schema and len(obj) > schema["maxItems"]:
+            errors.append(f"{path}: za duzo elementow ({len(obj)} > {schema['maxItems']})")
+        for i, item in enumerate(obj):
+            errors.extend(validate(item, schema.get("items"), f"{path}[{i}]"))
+    if isinstance(obj, str):
+        if "minLength" in schema and len(obj) < schema["minLength"]:
+            errors.append(f"{path}: za krotki tekst")
+        if "pattern" in schema and not re.search(schema["pattern"], obj):
+            errors.append(f"{path}: niezgodny z wzorcem {schema['pattern']}")
+    return errors
+
+
+def parse(text, constraint):
+    """Tekst odpowiedzi -> obiekt (schema) albo przyciety tekst (GBNF). Rzuca StructuredOutputError."""
+    if not constraint.get("schema"):
+        text = (text or "").strip()
+        if not text:
+            raise StructuredOutputError("pusta odpowiedz", text)
+        return text
+    try:
+        obj = _extract_json(text)
+    except ValueError as e:
+        raise StructuredOutputError(f"niepoprawny JSON: {e}", text)
+    errors = validate(obj, constraint["schema"])
+    if errors:
+        raise StructuredOutputError("niezgodny ze schematem: " + "; ".join(errors[:5]), text)
+    return obj
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from modules import config_cache
+from modules import connection_manager as conn
+from modules import llama_probe
+from modules.prompt_builder import assemble_prompt
+
+# =========================================================
+# TOKEN BUDGET – kontekst liczony w tokenach aktywnego modelu:
+# n_ctx - rezerwa na generowanie, rozdzielone miedzy dusze,
+# pamiec, historie i pytanie; najpierw obcinamy najmniej wazne
+# =========================================================
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RATIO_CACHE = BASE_DIR / "logs" / "token_ratios.json"
+DEFAULT_CHARS_PER_TOKEN = 3.2
+DEFAULT_N_CTX = 4096
+DEFAULT_RESERVE = 512
+MAX_FIT_ROUNDS = 3
+COUNT_CACHE_SIZE = 512
+# Czesc puli zostawiana na fakty dobrane do pytania, gdy wszystko sie nie miesci.
+RELATED_SHARE = 0.15
+
+_LOCK = threading.Lock()
+_COUNTS = OrderedDict()
+_RATIOS = None
+
+
+def _backend():
+    cfg = config_cache.load()
+    value = str(cfg.get("local_backend") or "ollama").lower()
+    return "llama" if value.startswith("llama") else value
+
+
+def _ratios():
+    global _RATIOS
+    if _RATIOS is None:
+        try:
+            _RATIOS = json.loads(RATIO_CACHE.read_text(encoding="utf-8")) if RATIO_CACHE.exists() else {}
+        except Exception:
+            _RATIOS = {}
+    return _RATIOS
+
+
+def _learn_ratio(model, chars, tokens):
+    """Zapamietuje srednia liczbe znakow na token modelu (fallback bez /tokenize)."""
+    if not model or tokens <= 0 or chars < 200:
+        return
+    ratio = chars / tokens
+    with _LOCK:
+        ratios = _ratios()
+        old = ratios.get(model)
+        ratios[model] = round(ratio if old is None else old * 0.7 + ratio * 0.3, 3)
+        try:
+            RATIO_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            RATIO_CACHE.write_text(json.dumps(ratios, ensure_ascii=False, indent=2), encoding="utf-8")
+        except Exception:
+            pass
+
+
+def estimate_tokens(text, model=None):
+    if not text:
+        return 0
+    ratio = _ratios().get(model or "") or DEFAULT_CHARS_PER_TOKEN
+    return int(len(text) / ratio) + 1
+
+
+def _tokenize_remote(text, caps):
+    try:
+        r = conn.post("llama", "/tokenize", base_url=caps["base"], json={"content": text}, timeout=5)
+        if r.status_code == 200:
+            return len(r.json().get("tokens") or [])
+    except Exception:
+        pass
+    return None
+
+
+def count_tokens(text, model=None):
+    """Dokladna liczba tokenow (llama-server /tokenize) z cache; bez serwera – estymacja."""
+    if not text:
+        return 0
+    caps = llama_probe.get_capabilities() if _backend() == "llama" else None
+    model = model or (caps or {}).get("model") or ""
+    key = hashlib.sha1(f"{model}\0{text}".encode("utf-8")).hexdigest()
+    with _LOCK:
+        if key in _COUNTS:
+            _COUNTS.move_to_end(key)
+            return _COUNTS[key]
+    count = _tokenize_remote(text, caps) if caps and caps.get("dialect") == "completion" else None
+    if count is None:
+        return estimate_tokens(text, model)
+    _learn_ratio(model, len(text), count)
+    with _LOCK:
+        _COUNTS[key] = count
+        while len(_COUNTS) > COUNT_CACHE_SIZE:
+            _COUNTS.popitem(last=False)
+    return count
+
+
+def context_window(model=None):
+    """(model, n_ctx): llama-server z /props, Ollama z config model_ctx / num_ctx."""
+    cfg = config_cache.load()
+    if _backend() == "llama":
+        caps = llama_probe.get_capabilities() or {}
+        if caps.get("n_ctx"):
+            return caps.get("model") or model or "", int(caps["n_ctx"])
+    per_model = cfg.get("model_ctx") or {}
+    try:
+        return model or "", int(per_model.get(model or "") or cfg.get("num_ctx") or DEFAULT_N_CTX)
+    except Exception:
+        return model or "", DEFAULT_N_CTX
+
+
+def generation_reserve():
+    try:
+        return max(64, int(config_cache.load().get("generation_reserve_tokens", DEFAULT_RESERVE)))
+    except Exception:
+        return DEFAULT_RESERVE
+
+
+def _words(text):
+    return {w for w in re.findall(r"\w{4,}", (text or "").lower())}
+
+
+def _candidates(soul, memory_items, recent_items, history_items):
+    """
+    Elementy (wartosc, segment, kolejnosc, tekst). Wyzsza wartosc = obcinane pozniej.
+    Bez zaleznosci od pytania – wybor do stalego prefiksu nie zmienia prefix_hash co ture.
+    """
+    items = []
+    if soul:
+        items.append((90, "soul", 0, soul))
+    # Historia: najnowsza wymiana najwazniejsza, kazda starsza o 5 mniej.
+    n = len(history_items)
+    for i, text in enumerate(history_items):
+        items.append((80 - 5 * (n - 1 - i), "history", i, text))
+    n = len(recent_items)
+    for i, text in enumerate(recent_items):
+        items.append((60 - 3 * (n - 1 - i), "recent", i, text))
+    for i, text in enumerate(memory_items):
+        items.append((40, "memory", i, text))
+    return items
+
+
+def _related(question, memory_items, chosen):
+    """Fakty z pamieci dlugiej pominiete w prefiksie, a powiazane slowami z pytaniem – za prefiksem."""
+    q_words = _words(question)
+    taken = {order for seg, order, _ in chosen if seg == "memory"}
+    items = []
+    for i, text in enumerate(memory_items):
+        overlap = len(q_words & _words(text))
+        if overlap and i not in taken:
+            items.append((overlap, "related", i, text))
+    return items
+
+
+def _cost(chosen, model):
+    return sum(estimate_tokens(text, model) + 1 for _, _, text in chosen)
+
+
+def _select(candidates, budget, model):
+    chosen = []
+    used = 0
+    for value, segment, order, text in sorted(candidates, key=lambda c: (-c[0], c[2])):
+        cost = estimate_tokens(text, model) + 1
+        if used + cost <= budget:
+            chosen.append((segment, order, text))
+            used += cost
+        elif segment == "soul" and budget - used > 64:
+            # Dusze lepiej skrocic niz stracic w calosci.
+            keep = int((budget - used - 1) * (_ratios().get(model or "") or DEFAULT_CHARS_PER_TOKEN))
+            chosen.append((segment, order, text[:keep]))
+            used = budget
+    return chosen
+
+
+def _join(chosen, segment, header=""):
+    parts = sorted((order, text) for seg, order, text in chosen if seg == segment)
+    if not parts:
+        return ""
+    # Kolejnosc zrodlowa, nie wg wartosci – gdy wszystko sie miesci, prefiks jest staly.
+    return header + "\n".join(text for _, text in parts)
+
+
+def build_context(question, model=None, system="", soul="", memory_items=None, recent_items=None,
+                  history_items=None, question_label="Zapytanie: "):
+    """
+    Sklada prompt w budzecie tokenow modelu. Zwraca wynik assemble_prompt
+    uzupelniony o 'tokens', 'budget', 'n_ctx' i 'dropped' (liczba pominietych elementow).
+    """
+    model, n_ctx = context_window(model)
+    budget = max(256, n_ctx - generation_reserve())
+    memory_items = memory_items or []
+    fixed = count_tokens(f"{system}\n\n{question_label}{question}", model)
+    if fixed > budget - 64:
+        # Samo pytanie nie miesci sie w oknie – zostawiamy jego poczatek.
+        # Tokeny -> znaki przez proporcje samego pytania (znaki na token tego tekstu).
+        head = count_tokens(f"{system}\n\n{question_label}", model)
+        chars_per_token = len(question) / max(1, fixed - head)
+        question = question[:max(0, int((budget - 64 - head) * chars_per_token))] + "\n...[OBIĘTE]..."
+        fixed = count_tokens(f"{system}\n\n{question_label}{question}", model)
+    candidates = _candidates(soul, memory_items, recent_items or [], history_items or [])
+    available = budget - fixed - 16
+    result = None
+    for _ in range(MAX_FIT_ROUNDS):
+        pool = max(0, available)
+        # Rezerwa zalezy tylko od rozmiaru kandydatow, nie od tresci pytania.
+        if _cost([c[1:] for c in candidates], model) > pool:
+            pool = int(pool * (1 - RELATED_SHARE))
+        chosen = _select(candidates, pool, model)
+        left = max(0, available) - _cost(chosen, model)
+        chosen += _select(_related(question, memory_items, chosen), left, model)
+        result = assemble_prompt(
+            question,
+            question_label=question_label,
+            system=system,
+            soul=_join(chosen, "soul"),
+            memory=_join(chosen, "memory", "Pamiec_dluga:\n"),
+            recent=_join(chosen, "recent", "Pamiec_biezaca:\n"),
+            history=_join(chosen, "history"),
+            related=_join(chosen, "related", "Pamiec_do_pytania:\n"),
+        )
+        tokens = count_tokens(result["prompt"], model)
+        result.update({"tokens": tokens, "budget": budget, "n_ctx": n_ctx,
+                       "dropped": len(candidates) - len(chosen)})
+        if tokens <= budget or not chosen:
+            break
+        # Estymacja byla zbyt optymistyczna – zmniejszamy pule o nadmiar.
+        available -= tokens - budget + 16
+    return result
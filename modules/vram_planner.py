@@ -0,0 +1,224 @@
+import os
+import subprocess
+from pathlib import Path
+
+from modules import config_cache
+from modules import gguf_index
+
+# =========================================================
+# VRAM PLANNER – parametry startu llama-server dopasowane do
+# modelu i wolnej VRAM kart (sysfs): warstwy na GPU, podzial
+# proporcjonalny do wolnej pamieci, maksymalny bezpieczny
+# kontekst, kwantyzacja KV cache; odmowa, gdy model sie nie zmiesci
+# =========================================================
+
+DRM_DIR = Path("/sys/class/drm")
+MB = 1024 ** 2
+
+# Bufory obliczen, kontekst HIP, fragmentacja – per karta, poza wagami i KV.
+DEFAULT_CARD_RESERVE_MB = 768
+DEFAULT_CTX = 8192
+DEFAULT_MIN_CTX = 2048
+CTX_STEP = 256
+# Bajty na element KV cache: f16 i q8_0 (blok 32 wartosci = 34 bajty).
+KV_BYTES = {"f16": 2.0, "q8_0": 34 / 32}
+# Zapas RAM przy czesciowym offloadzie (system, Lyra, bufory mmap).
+RAM_RESERVE_MB = 2048
+DRAFT_OVERHEAD = 1.1
+
+
+def _cfg_int(cfg, key, default):
+    try:
+        return int(cfg.get(key, default))
+    except Exception:
+        return int(default)
+
+
+def enabled():
+    """llama_plan: auto (planer) | off (stare llama_gpu_layers / llama_tensor_split z config)."""
+    return str(config_cache.load().get("llama_plan", "auto")).lower() not in ["off", "false", "0", "no", "nie"]
+
+
+def cards():
+    """Karty z sysfs w kolejnosci urzadzen: [{card, total_mb, free_mb}]."""
+    out = []
+    try:
+        names = sorted(d for d in os.listdir(DRM_DIR) if d.startswith("card") and len(d) == 5)
+    except OSError:
+        return out
+    for card in names:
+        base = DRM_DIR / card / "device"
+        try:
+            total = int((base / "mem_info_vram_total").read_text().strip())
+            used = int((base / "mem_info_vram_used").read_text().strip())
+        except (OSError, ValueError):
+            continue
+        out.append({"card": card, "total_mb": total // MB, "free_mb": max(0, total - used) // MB})
+    return out
+
+
+def ram_available_mb():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except Exception:
+        pass
+    return None
+
+
+def kv_bytes_per_token(info, kv_type="f16", layers=None):
+    """KV cache jednego tokenu: K i V dla kazdej warstwy (tylko glowice KV – GQA)."""
+    n_layer = layers if layers is not None else (info.get("n_layer") or 0)
+    width = (info.get("n_head_kv") or 0) * ((info.get("key_length") or 0) + (info.get("value_length") or 0))
+    return n_layer * width * KV_BYTES[kv_type]
+
+
+def _head_bytes(info):
+    """Glowica wyjsciowa na GPU; bez osobnego output.weight (wspolne embeddingi) llama.cpp kopiuje token_embd."""
+    other = info.get("other_bytes") or 0
+    embd = info.get("embd_bytes") or 0
+    return other if other >= embd / 2 else other + embd
+
+
+def _split(usable):
+    """--tensor-split proporcjonalny do wolnej pamieci kart (w MB, llama.cpp normalizuje)."""
+    if len(usable) < 2:
+        return None
+    return ",".join(str(max(1, int(mb))) for mb in usable)
+
+
+def _round_ctx(ctx):
+    return int(ctx) // CTX_STEP * CTX_STEP
+
+
+def plan(model_path, parallel=1, card_list=None, extra_bytes=0):
+    """
+    Plan startu llama-server dla modelu. Kolejnosc prob: pelny offload z KV f16 ->
+    KV q8_0 -> krotszy kontekst (do llama_min_ctx) -> czesc warstw na CPU (gdy starczy RAM).
+    Zwraca dict: ok, reason, gpu_layers, n_layer, n_ctx, kv_type, tensor_split, need_mb, free_mb.
+    """
+    cfg = config_cache.load()
+    parallel = max(1, int(parallel or 1))
+    info = gguf_index.model_info(model_path)
+    card_list = cards() if card_list is None else card_list
+    result = {"ok": False, "model": str(model_path), "cards": card_list, "parallel": parallel}
+    if not info or not info.get("n_layer") or not info.get("layer_bytes"):
+        result.update({"reason": "brak metadanych GGUF (warstwy/tensory)", "unknown": True})
+        return result
+    if info.get("missing_shards"):
+        result["reason"] = f"brak shardow: {', '.join(Path(p).name for p in info['missing_shards'])}"
+        return result
+    if not card_list:
+        result.update({"reason": "brak danych VRAM z sysfs (mem_info_vram_*)", "unknown": True})
+        return result
+
+    n_layer = int(info["n_layer"])
+    layers = list(info["layer_bytes"])[:n_layer]
+    train_ctx = int(info.get("context_length") or DEFAULT_CTX)
+    slot_ctx = min(train_ctx, _cfg_int(cfg, "llama_ctx", DEFAULT_CTX))
+    min_ctx = min(slot_ctx, _cfg_int(cfg, "llama_min_ctx", DEFAULT_MIN_CTX))
+    reserve = _cfg_int(cfg, "llama_card_reserve_mb", DEFAULT_CARD_RESERVE_MB)
+    usable = [max(0, c["free_mb"] - reserve) for c in card_list]
+    # Warstwy nie dziela sie miedzy karty – na kazdej karcie zapas jednej warstwy na zaokraglenie.
+    slack = max(layers) if len(card_list) > 1 else 0
+    free = sum(usable) * MB - slack * len(card_list)
+    weights = sum(layers) + _head_bytes(info) + extra_bytes
+    kv_mode = str(cfg.get("llama_kv_type", "auto")).lower()
+    kv_types = [kv_mode] if kv_mode in KV_BYTES else ["f16", "q8_0"]
+    result.update({
+        "n_layer": n_layer, "free_mb": int(free / MB), "tensor_split": _split(usable),
+        "weights_mb": int(weights / MB), "train_ctx": train_ctx,
+    })
+
+    def done(gpu_layers, ctx, kv_type, need):
+        result.update({"ok": True, "gpu_layers": gpu_layers, "n_ctx": ctx * parallel, "slot_ctx": ctx,
+                       "kv_type": kv_type, "need_mb": int(need / MB), "reason": None})
+        return result
+
+    # 1-2. Wszystkie warstwy + glowica na GPU, pelny kontekst; najpierw KV f16, potem q8_0.
+    for kv_type in kv_types:
+        need = weights + kv_bytes_per_token(info, kv_type) * slot_ctx * parallel
+        if need <= free:
+            return done(n_layer + 1, slot_ctx, kv_type, need)
+    # 3. Krotszy kontekst z najtanszym KV – szybciej niz wagi w RAM.
+    kv_type = kv_types[-1]
+    per_token = kv_bytes_per_token(info, kv_type) * parallel
+    if per_token and free > weights:
+        ctx = _round_ctx(min(slot_ctx, (free - weights) / per_token))
+        if ctx >= min_ctx:
+            return done(n_layer + 1, ctx, kv_type, weights + per_token * ctx)
+    # 4. Czesc warstw na CPU: KV tych warstw tez zostaje w RAM.
+    kv_layer = kv_bytes_per_token(info, kv_type, layers=1) * min_ctx * parallel
+    gpu_layers, need = 0, extra_bytes
+    for size in layers:
+        if need + size + kv_layer > free:
+            break
+        need += size + kv_layer
+        gpu_layers += 1
+    cpu_bytes = sum(layers[gpu_layers:]) + _head_bytes(info) + (n_layer - gpu_layers) * kv_layer
+    ram = ram_available_mb()
+    if ram is not None and cpu_bytes / MB > ram - RAM_RESERVE_MB:
+        result["reason"] = (f"model sie nie miesci: {int((weights + kv_layer * n_layer) / MB)} MB, "
+                            f"wolne VRAM {result['free_mb']} MB, RAM {ram} MB")
+        result["need_mb"] = int((weights + kv_layer * n_layer) / MB)
+        return result
+    done(gpu_layers, min_ctx, kv_type, need)
+    result["cpu_mb"] = int(cpu_bytes / MB)
+    return result
+
+
+def flash_attn_args(server_bin):
+    """Flaga flash attention (wymagana przez kwantyzowany V cache) w skladni danej wersji llama-server."""
+    try:
+        help_text = subprocess.run([str(server_bin), "--help"], capture_output=True, text=True, timeout=10).stdout
+    except Exception:
+        help_text = ""
+    # Nowsze wersje: -fa on|off|auto; starsze: sam przelacznik -fa.
+    return ["-fa", "on"] if "on|off|auto" in (help_text or "") else ["-fa"]
+
+
+def server_args(result, server_bin=None):
+    """Flagi llama-server z planu (bez -m/--port/--parallel)."""
+    args = ["--gpu-layers", str(result["gpu_layers"]), "-c", str(result["n_ctx"])]
+    if result.get("tensor_split"):
+        args += ["--tensor-split", result["tensor_split"]]
+    if result.get("kv_type") and result["kv_type"] != "f16":
+        args += ["-ctk", result["kv_type"], "-ctv", result["kv_type"]]
+        if server_bin:
+            args += flash_attn_args(server_bin)
+    return args
+
+
+def draft_bytes(extra_args):
+    """VRAM modelu draft (-md) z argumentow dekodowania spekulatywnego."""
+    if "-md" not in (extra_args or []):
+        return 0
+    size = gguf_index.total_bytes(extra_args[extra_args.index("-md") + 1])
+    return int((size or 0) * DRAFT_OVERHEAD)
+
+
+def full_offload(result):
+    return bool(result.get("ok") and result.get("gpu_layers", 0) > result.get("n_layer", 0))
+
+
+def describe(result):
+    """Jedna linia planu dla komunikatow agenta."""
+    if not result.get("ok"):
+        return f"plan VRAM: odmowa – {result.get('reason')}"
+    layers = "wszystkie warstwy" if full_offload(result) else \
+        f"{result['gpu_layers']}/{result['n_layer']} warstw (reszta ~{result.get('cpu_mb', 0)} MB w RAM)"
+    split = f" | split {result['tensor_split']}" if result.get("tensor_split") else ""
+    return (f"plan VRAM: {layers} | ctx {result['n_ctx']} ({result['slot_ctx']}/slot) | KV {result['kv_type']}"
+            f"{split} | ~{result['need_mb']}/{result['free_mb']} MB")
+
+
+def format_plan(model_name, model_path, parallel=1):
+    result = plan(model_path, parallel)
+    lines = [f"Plan VRAM dla {model_name}:", f"- {describe(result)}"]
+    for c in result.get("cards") or []:
+        lines.append(f"- {c['card']}: wolne {c['free_mb']}/{c['total_mb']} MB")
+    if result.get("ok"):
+        lines.append(f"- flagi: {' '.join(server_args(result))}")
+    return "\n".join(lines)
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from modules import async_router
+from modules import model_router
+from modules import request_scheduler
+
+# Tyle watkow ma domyslny executor asyncio (to_thread).
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+SLOTS = 2
+REPLY_SEC = 0.02
+
+
+def _fake_ollama(prompt, model=None, timeout=90, constraint=None):
+    """Synchroniczny backend: zajmuje watek puli na czas odpowiedzi (jak query_ollama bez httpx)."""
+    time.sleep(REPLY_SEC)
+    return f"ok: {prompt}"
+
+
+class ScheduledAsyncTest(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(async_router, "httpx", None),
+            mock.patch.object(async_router, "search_memory", lambda prompt: None),
+            mock.patch.object(async_router, "parallel_capacity", lambda backend=None: SLOTS),
+            mock.patch.object(model_router, "query_ollama", _fake_ollama),
+            mock.patch.object(model_router, "_read_mode", lambda: "offline"),
+            mock.patch.object(model_router, "_get_local_backend", lambda: "ollama"),
+            mock.patch.object(model_router, "_cached_response", lambda *a: (None, None)),
+            mock.patch.object(model_router, "_store_response", lambda *a: None),
+            mock.patch.object(request_scheduler, "_read_capacity", lambda: SLOTS),
+            mock.patch.object(request_scheduler, "_max_queue", lambda: 10000),
+            mock.patch.dict(request_scheduler._CAPACITY, {"value": None, "at": 0.0}),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _run(self, prompts, workers=DEFAULT_WORKERS):
+        async def main():
+            # Executor o rozmiarze domyslnym – wiecej promptow niz watkow.
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+            return await async_router.gather_models(prompts, "fake", config={"timeout": 20, "priority": "bulk"})
+
+        start = time.monotonic()
+        results = asyncio.run(main())
+        return results, time.monotonic() - start
+
+    def test_more_prompts_than_executor_threads(self):
+        prompts = [f"p{i}" for i in range(DEFAULT_WORKERS + 8)]
+        results, elapsed = self._run(prompts)
+        self.assertEqual([text for text, _ in results], [f"ok: {p}" for p in prompts])
+        # Bez zakleszczenia: ~len/SLOTS odpowiedzi po REPLY_SEC, daleko od timeoutu harmonogramu.
+        self.assertLess(elapsed, 10)
+
+    def test_identical_prompts_share_one_call(self):
+        prompts = ["ten sam"] * (DEFAULT_WORKERS + 8)
+        results, elapsed = self._run(prompts, workers=4)
+        self.assertEqual({text for text, _ in results}, {"ok: ten sam"})
+        self.assertLess(elapsed, 10)
+
+    def test_batch_bounded_to_capacity(self):
+        # Partia wieksza niz limit kolejki harmonogramu: zaden wiersz nie dostaje SchedulerBusy.
+        in_flight = {"now": 0, "max": 0}
+
+        def _counting(prompt, model=None, timeout=90, constraint=None):
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            try:
+                return _fake_ollama(prompt, model, timeout, constraint)
+            finally:
+                in_flight["now"] -= 1
+
+        requests = [{"prompt": f"r{i}", "model": "fake"} for i in range(40)]
+        with mock.patch.object(model_router, "query_ollama", _counting), \
+                mock.patch.object(request_scheduler, "_max_queue", lambda: 4):
+            results = asyncio.run(async_router.gather_requests(requests, config={"priority": "bulk"}))
+        self.assertEqual([text for text, _ in results], [f"ok: r{i}" for i in range(40)])
+        self.assertLessEqual(in_flight["max"], SLOTS)
+
+
+if __name__ == "__main__":
+    unittest.main()